@@ -0,0 +1,182 @@
+from contextlib import contextmanager
+from werkzeug.exceptions import abort
+from models import Plant, Observation
+from pagination import get_limit
+from versions import table_key, row_key
+import services
+
+
+'''
+API Requests and Responses
+
+Request arg parsing and JSON envelopes of the read API, shared by the
+Flask views and the asyncio read routes (asgi.py) so both answer alike.
+Args are the request's query args MultiDict. Malformed args abort with
+400, missing resources with 404.
+'''
+
+
+# headers added to every response
+ACCESS_CONTROL_HEADERS = [
+    ('Access-Control-Allow-Headers', 'Content-Type,Authorization,true'),
+    ('Access-Control-Allow-Methods', 'GET,PUT,PATCH,POST,DELETE,OPTIONS'),
+]
+
+# messages of the error responses
+ERROR_MESSAGES = {
+    400: 'bad request',
+    404: 'resource not found',
+    405: 'method not allowed',
+    422: 'unprocessable',
+}
+
+# size of the chunks a streamed listing is sent in
+STREAM_CHUNK_SIZE = 65536
+
+
+# version keys of the read routes' ETags
+def plants_keys():
+    return [table_key(Plant.__tablename__),
+            table_key(Observation.__tablename__)]
+
+
+def plant_keys(id):
+    return [row_key(Plant.__tablename__, id)]
+
+
+def observations_keys():
+    return [table_key(Observation.__tablename__),
+            table_key(Plant.__tablename__)]
+
+
+def observation_keys(id):
+    return [row_key(Observation.__tablename__, id),
+            table_key(Plant.__tablename__)]
+
+
+# 400 if parsing a request arg or a cursor raises ValueError
+@contextmanager
+def malformed_args():
+    try:
+        yield
+    except ValueError:
+        abort(400)
+
+
+# get plant fields and include request args
+def plant_fields_args(args):
+    with malformed_args():
+        fields, include_observations = services.parse_plant_fields(
+            args.get('fields'), args.get('include'))
+
+    return {'fields': fields,
+            'include_observations': include_observations}
+
+
+# get observation fields request arg
+def observation_fields_args(args):
+    with malformed_args():
+        fields = services.parse_observation_fields(args.get('fields'))
+
+    return {'fields': fields}
+
+
+# get observation area request args
+def observation_area_args(args):
+    with malformed_args():
+        area = services.parse_observation_area(
+            args.get('bbox'), args.get('near'), args.get('radius'))
+
+    return {'area': area}
+
+
+# get cursor and limit request args of a page
+def page_args(args):
+    with malformed_args():
+        limit = get_limit(args.get('limit'))
+
+    return {'cursor': args.get('cursor'), 'limit': limit}
+
+
+# 404 if the first page of a listing is empty, later pages may be
+def require_first_page(args, found):
+    if not found and 'cursor' not in args:
+        abort(404)
+
+
+# check if client asked for a streamed listing
+def stream_requested(args):
+    return args.get('stream', '').lower() in ('1', 'true')
+
+
+# request args of the next page, keeping the others e.g. limit, fields and q
+def next_page_args(args, next_cursor):
+    args = args.to_dict()
+    args['cursor'] = next_cursor
+    return args
+
+
+# body of a page of a listing
+def page_body(key, items, next_link):
+    return {
+        'success': True,
+        key: items,
+        'next': next_link
+    }
+
+
+# body of a single item, 404 if not found
+def item_body(key, item):
+    if item is None:
+        abort(404)
+
+    return {
+        'success': True,
+        key: item
+    }
+
+
+# body of an error response
+def error_body(code):
+    return {
+        'success': False,
+        'error': code,
+        'message': ERROR_MESSAGES[code]
+    }
+
+
+class StreamEnvelope:
+    '''
+    Joins the JSON encoded items of a streamed listing into one envelope,
+    sent in chunks of about STREAM_CHUNK_SIZE
+    '''
+
+    def __init__(self, key):
+        self.chunk = ['{"success": true, "next": null, "%s": [' % key]
+        self.size = 0
+        self.count = 0
+
+    def add(self, encoded):
+        '''
+        Adds an encoded item, returns a chunk to send once it's full
+        '''
+
+        self.chunk.append(',' + encoded if self.count else encoded)
+        self.count += 1
+        self.size += len(encoded)
+
+        if self.size >= STREAM_CHUNK_SIZE:
+            chunk = ''.join(self.chunk)
+            self.chunk = []
+            self.size = 0
+            return chunk
+
+        return None
+
+    def close(self):
+        '''
+        Returns the last chunk, closing the envelope
+        '''
+
+        self.chunk.append(']}')
+        return ''.join(self.chunk)
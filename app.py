@@ -1,16 +1,23 @@
-from flask import Flask, flash, request, abort, jsonify, render_template, redirect, url_for, session
+from flask import Flask, flash, request, abort, jsonify, render_template, redirect, url_for, session, Response, stream_with_context, json
 from functools import wraps
-from models import setup_db, Plant, Observation, User
+from models import setup_db, Plant, Observation
 from flask_cors import CORS
 from os import environ as env
 from authlib.integrations.flask_client import OAuth
 from six.moves.urllib.parse import urlencode
-from auth.auth import AuthError, requires_auth, create_login_link
+from auth.auth import (AuthError, requires_auth, create_login_link,
+                       token_cache)
+from auth.management import ManagementClient
+import services
+import api
+import geo
+from versions import version_store, table_key, row_key
 import constants
-import json
+import metrics
+import sqlwatch
 from dotenv import load_dotenv, find_dotenv
-import requests
-from datetime import datetime
+from itertools import chain
+import zlib
 
 
 def create_app(test_config=None):
@@ -33,6 +40,12 @@ def create_app(test_config=None):
     setup_db(app)
     app.secret_key = constants.SECRET_KEY
 
+    # record latency, SQL, template and Auth0 time of every view
+    metrics.init_app(app)
+
+    # report N+1 and slow queries if SQL_WATCH is set
+    sqlwatch.init_app(app)
+
     # set up OAuth
     oauth = OAuth(app)
     auth0 = oauth.register(
@@ -47,6 +60,11 @@ def create_app(test_config=None):
         },
     )
 
+    # set up Auth0 management API client
+    mgmt_client = ManagementClient(AUTH0_DOMAIN, AUTH0_CLIENT_ID,
+                                   AUTH0_CLIENT_SECRET,
+                                   observer=metrics.record_auth0_call)
+
     # set up CORS, allowing all origins
     CORS(app, resources={'/': {'origins': '*'}})
 
@@ -55,10 +73,8 @@ def create_app(test_config=None):
         '''
         Sets access control.
         '''
-        response.headers.add('Access-Control-Allow-Headers',
-                             'Content-Type,Authorization,true')
-        response.headers.add('Access-Control-Allow-Methods',
-                             'GET,PUT,PATCH,POST,DELETE,OPTIONS')
+        for name, value in api.ACCESS_CONTROL_HEADERS:
+            response.headers.add(name, value)
         return response
 
     def login_required(f):
@@ -71,99 +87,138 @@ def create_app(test_config=None):
                 return render_template('pages/login.html'), 200
         return wrap
 
+    def versioned(get_keys):
+        '''
+        Tags responses with an ETag built from the version counters of the
+        keys returned by get_keys, and answers a matching If-None-Match
+        with 304 before the view runs any query.
+        '''
+        def decorator(f):
+            @wraps(f)
+            def wrap(*args, **kwargs):
+                etag = version_store.etag(request.full_path,
+                                          *get_keys(**kwargs))
+
+                # client already has current representation
+                if request.if_none_match.contains(etag):
+                    response = Response(status=304)
+                    response.set_etag(etag)
+                    return response
+
+                response = f(*args, **kwargs)
+                if response.status_code == 200:
+                    response.set_etag(etag)
+                return response
+            return wrap
+        return decorator
+
     # add login link function to jinja context
     app.jinja_env.globals.update(create_login_link=create_login_link)
 
     # UTILITY FUNCTIONS
 
-    # plant formatting
-    def format_plants(plants):
-        return [plant.format() for plant in plants]
+    # get one page from a service using cursor and limit request args,
+    # 400 if malformed and 404 if first page is empty
+    def get_page(get_service_page, **kwargs):
 
-    # observation formatting
-    def format_observations(observations):
-        return [observation.format() for observation in observations]
+        with api.malformed_args():
+            items, next_cursor = get_service_page(
+                **api.page_args(request.args), **kwargs)
 
-    # get Auth0 management API token
-    def get_mgmt_token():
+        api.require_first_page(request.args, len(items) > 0)
+        return items, next_cursor
 
-        data = {
-            'grant_type': 'client_credentials',
-            'client_id': AUTH0_CLIENT_ID,
-            'client_secret': AUTH0_CLIENT_SECRET,
-            'audience': 'https://plant-survey.auth0.com/api/v2/'
-        }
+    # stream a listing from a service generator as one JSON envelope
+    def stream_listing(key, iter_service_items, **kwargs):
 
-        resp = requests.post('https://plant-survey.auth0.com/oauth/token',
-                             data=data,
-                             headers={'content-type': 'application/x-www-form-urlencoded'})
-        info = resp.json()
-        mgmt_token = info['access_token']
+        with api.malformed_args():
+            items = iter_service_items(cursor=request.args.get('cursor'),
+                                       **kwargs)
 
-        return mgmt_token
+            # read first item now so errors are raised before streaming
+            first = next(items, None)
 
-    # check if user is in database
-    def check_if_user_exists(user_id):
+        # 404 if listing is empty
+        api.require_first_page(request.args, first is not None)
 
-        # look in Users table for user
-        user = User.query.filter_by(user_id=user_id).one_or_none()
+        if first is not None:
+            items = chain([first], items)
 
-        # if user not found return false
-        if user is None:
-            return False
-        else:
-            return True
+        def generate():
+            envelope = api.StreamEnvelope(key)
+            for item in items:
+                chunk = envelope.add(json.dumps(item))
+                if chunk is not None:
+                    yield chunk
 
-    # add 'Public' role to user
-    def add_public_role(user_id, mgmt_token):
+            yield envelope.close()
 
-        # Auth0 public role ID
-        PUBLIC_ROLE_ID = 'rol_X9T29OUlO7kYdItp'
+        return Response(stream_with_context(generate()),
+                        mimetype='application/json')
 
-        # request body
-        data = {
-            "roles": [
-                PUBLIC_ROLE_ID
-            ]
-        }
+    # read a JSON array or NDJSON request body, gunzipping it if needed
+    def read_bulk_body():
 
-        # call management API with user_id and role
-        role_resp = requests.post(f'https://plant-survey.auth0.com/api/v2/users/{user_id}/roles',
-                                  headers={
-                                      'Authorization': f"Bearer {mgmt_token}"},
-                                  json=data)
+        data = request.get_data()
 
-        # raises exception for any 4xx or 5xx errors
-        role_resp.raise_for_status()
+        # decompress, refusing bodies that inflate past the size limit
+        if request.headers.get('Content-Encoding', '').lower() == 'gzip':
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = decompressor.decompress(
+                    data, services.MAX_BULK_BODY_SIZE)
+            except zlib.error:
+                abort(400)
+            if decompressor.unconsumed_tail:
+                abort(422)
 
-    # add user if not in database
-    def create_new_user(user):
+        try:
+            text = data.decode('utf-8')
 
-        # create new user
-        new_user = User(name=user['name'],
-                        username=user['username'],
-                        user_id=user['user_id'],
-                        date_added=user['date_added'],
-                        role=user['role'])
+            # one JSON document per line
+            if request.mimetype in ('application/x-ndjson',
+                                    'application/jsonlines'):
+                records = [json.loads(line) for line in text.splitlines()
+                           if line.strip()]
+            else:
+                records = json.loads(text)
+        except ValueError:
+            abort(400)
 
-        try:
-            # insert new user in Users table
-            new_user.insert()
-        except Exception as e:
-            print('ERROR: ', str(e))
-            abort(422)
+        # body must be a list of observations
+        if not isinstance(records, list):
+            abort(400)
+
+        return records
+
+    # link to the next page of an endpoint, None on the last page
+    def next_page_link(endpoint, next_cursor):
+        if next_cursor is None:
+            return None
+
+        return url_for(endpoint,
+                       **api.next_page_args(request.args, next_cursor))
+
+    # add 'Public' role to user
+    def add_public_role(user_id):
+
+        # Auth0 public role ID
+        PUBLIC_ROLE_ID = 'rol_X9T29OUlO7kYdItp'
 
-        return new_user.id
+        # call management API with user_id and role
+        mgmt_client.assign_roles(user_id, [PUBLIC_ROLE_ID])
 
     # AUTH ROUTES 
 
     @app.route('/callback')
     def callback_handling():
-        token = auth0.authorize_access_token()
+        with metrics.auth0_call('authorize_access_token'):
+            token = auth0.authorize_access_token()
         # print('TOKEN: ', token['access_token'])
 
         # get user info and store user id
-        resp = auth0.get('userinfo')
+        with metrics.auth0_call('userinfo'):
+            resp = auth0.get('userinfo')
         userinfo = resp.json()
         user_id = userinfo['sub']
         # print('ID: ', user_id)
@@ -173,40 +228,16 @@ def create_app(test_config=None):
             'user_id': user_id
         }
 
-        # check if user exists in Users table
-        if check_if_user_exists(user_id):
-
-            # get user info from Users table
-            user_table_id = User.query.filter_by(
-                user_id=user_id).one_or_none().id
-            name = User.query.filter_by(user_id=user_id).one_or_none().name
-            username = User.query.filter_by(
-                user_id=user_id).one_or_none().username
-            date_added = User.query.filter_by(
-                user_id=user_id).one_or_none().date_added
-            role = User.query.filter_by(user_id=user_id).one_or_none().role
-
-            # add to user info
-            user['user_table_id'] = user_table_id
-            user['name'] = name
-            user['username'] = username
-            user['date_added'] = date_added
-            user['role'] = role
-
-        # if no, create new user
-        else:
-            # get management API token
-            mgmt_token = get_mgmt_token()
-            # print('MGMT TOKEN: ', mgmt_token)
+        # get user from Users table in one query
+        row = services.get_user(user_id)
 
+        # if no user, create new user
+        if row is None:
             # set new user role to 'Public' on Auth0
-            add_public_role(user_id, mgmt_token)
-            user['role'] = 'Public'
+            add_public_role(user_id)
 
             # get additional user info from management api
-            user_resp = requests.get(f'https://plant-survey.auth0.com/api/v2/users/{user_id}',
-                                     headers={'Authorization': f"Bearer {mgmt_token}"})
-            id_info = user_resp.json()
+            id_info = mgmt_client.get_user(user_id)
 
             # get username from response
             if 'username' in id_info:
@@ -216,15 +247,21 @@ def create_app(test_config=None):
             else:
                 username = id_info['email']
 
-            user['username'] = username
-            user['name'] = id_info['name']
-
-            # set date added to now
-            user['date_added'] = datetime.utcnow()
+            try:
+                # add new user to Users table, or get it if another
+                # login created it first
+                row = services.create_user(user_id, id_info['name'],
+                                           username, 'Public')
+            except Exception as e:
+                print('ERROR: ', str(e))
+                abort(422)
 
-            # add new user to Users table, save user_table_id
-            user_table_id = create_new_user(user)
-            user['user_table_id'] = user_table_id
+        # add to user info
+        user['user_table_id'] = row.id
+        user['name'] = row.name
+        user['username'] = row.username
+        user['date_added'] = row.date_added
+        user['role'] = row.role
 
         # add session variables
         session['logged_in'] = True
@@ -241,6 +278,10 @@ def create_app(test_config=None):
 
     @app.route('/logout')
     def logout():
+        # forget verified session token
+        if constants.JWT in session:
+            token_cache.invalidate(session[constants.JWT])
+
         session.clear()
         params = {'returnTo': url_for(
             'home', _external=True), 'client_id': AUTH0_CLIENT_ID}
@@ -262,21 +303,11 @@ def create_app(test_config=None):
             return render_template('pages/login.html'), 200
 
         # get user from Users table
-        user_table_id = User.query.filter_by(
-            user_id=session['profile']['user_id']).one_or_none().id
+        user_table_id = services.get_user_id(session['profile']['user_id'])
 
-        # get all plants and observations that match user
-        plants = Plant.query.filter_by(
-            user_id=user_table_id).all()
-        observations = Observation.query.filter_by(
-            user_id=user_table_id).all()
-
-        # format all plants and observations
-        if (len(plants) != 0):
-            plants = format_plants(plants)
-
-        if (len(observations) != 0):
-            observations = format_observations(observations)
+        # get plants and observations added by user, cached until the
+        # user adds or changes one
+        plants, observations = services.get_dashboard(user_table_id)
 
         return render_template('/pages/dashboard.html',
                                userinfo=session[constants.PROFILE_KEY],
@@ -300,22 +331,25 @@ def create_app(test_config=None):
         Handles GET requests for getting all plants.
         '''
 
-        # get all plants from API
-        response = get_plants_api()
-        data = json.loads(response.data)
-        plants = data['plants']
+        # get page of plants, page doesn't show observations
+        plants, next_cursor = get_page(services.get_plants_page,
+                                       include_observations=False)
 
         # return template with plants
         return render_template('pages/plants.html',
-                               plants=plants), 200
+                               plants=plants,
+                               next_page=next_page_link('plants',
+                                                        next_cursor)), 200
 
     @app.route('/plants/<int:id>')
     def get_plant_by_id(id):
 
-        # get plant by id from API
-        response = get_plant_by_id_api(id)
-        data = json.loads(response.data)
-        plant = data['plant']
+        # get plant by id
+        plant = services.get_plant(id)
+
+        # 404 if no plant found
+        if plant is None:
+            abort(404)
 
         # serve plant page with plant result
         return render_template('pages/plant.html',
@@ -343,11 +377,15 @@ def create_app(test_config=None):
         id = kwargs['id']
 
         # get plant by id
-        plant = Plant.query.filter_by(id=id).one_or_none()
+        plant = services.get_plant(id)
+
+        # 404 if no plant found
+        if plant is None:
+            abort(404)
 
         # return edit plant template with plant info
         return render_template('forms/edit_plant.html',
-                               plant=plant.format()), 200
+                               plant=plant), 200
 
     @app.route('/observations')
     def get_plant_observations():
@@ -355,14 +393,15 @@ def create_app(test_config=None):
         Handles GET requests for getting all observations.
         '''
 
-        # get all plant observations from API
-        response = get_observations_api()
-        data = json.loads(response.data)
-        observations = data['observations']
+        # get page of plant observations
+        observations, next_cursor = get_page(services.get_observations_page)
 
         # return template with observations
         return render_template('pages/observations.html',
-                               observations=observations), 200
+                               observations=observations,
+                               next_page=next_page_link(
+                                   'get_plant_observations',
+                                   next_cursor)), 200
 
     @app.route('/observations/new')
     @login_required
@@ -380,7 +419,7 @@ def create_app(test_config=None):
         plant_id = request.args.get('plant')
 
         # get plant by id
-        plant = Plant.query.filter_by(id=plant_id).one_or_none()
+        plant = services.get_plant(plant_id)
 
         # abort 404 if not found
         if plant is None:
@@ -388,7 +427,7 @@ def create_app(test_config=None):
 
         # return new plant form
         return render_template('forms/new_observation.html',
-                               plant=plant.format()), 200
+                               plant=plant), 200
 
     @app.route('/observations/<int:id>/edit')
     @login_required
@@ -401,55 +440,78 @@ def create_app(test_config=None):
         # get id from kwargs
         id = kwargs['id']
 
-        # get plant by id
-        observation = Observation.query.filter_by(id=id).one_or_none()
+        # get observation by id
+        observation = services.get_observation(id)
 
-        # return edit plant template with plant info
+        # 404 if no observation found
+        if observation is None:
+            abort(404)
+
+        # return edit observation template with observation info
         return render_template('forms/edit_observation.html',
-                               observation=observation.format()), 200
+                               observation=observation), 200
 
     # API ROUTES
 
     @app.route('/api/plants')
+    @versioned(api.plants_keys)
     def get_plants_api():
         '''
-        Handles API GET requests for getting all plants. Returns JSON.
+        Handles API GET requests for getting all plants, one page at a
+        time. Returns JSON, streamed in full if stream=true is requested.
         '''
 
-        # get all plants from database
-        plants = Plant.query.all()
+        # get requested fields
+        fields_args = api.plant_fields_args(request.args)
 
-        # 404 if no plants found
-        if len(plants) == 0:
-            abort(404)
+        # stream all plants
+        if api.stream_requested(request.args):
+            return stream_listing('plants', services.iter_plants,
+                                  **fields_args)
+
+        # get page of plants, 404 if no plants found
+        plants, next_cursor = get_page(services.get_plants_page,
+                                       **fields_args)
+
+        # return plants and link to next page
+        return jsonify(api.page_body(
+            'plants', plants, next_page_link('get_plants_api', next_cursor)))
+
+    @app.route('/api/plants/suggest')
+    def suggest_plants_api():
+        '''
+        Handles API GET requests for plant name suggestions, used to pick
+        a plant while typing. Returns JSON.
+        '''
+
+        # prefix is required
+        prefix = request.args.get('prefix', '')
+        if prefix.strip() == '':
+            abort(400)
 
-        # format each plant
-        plants = format_plants(plants)
+        try:
+            limit = services.parse_suggest_limit(request.args.get('limit'))
+        except ValueError:
+            abort(400)
 
-        # return plants
+        # return matching plants, empty if none
         return jsonify({
             'success': True,
-            'plants': plants
+            'plants': services.suggest_plants(prefix, limit)
         })
 
     @app.route('/api/plants/<int:id>')
+    @versioned(api.plant_keys)
     def get_plant_by_id_api(id):
         '''
         Handles API GET requests for getting plant by ID. Returns JSON.
         '''
 
-        # get plant by ID
-        plant = Plant.query.filter_by(id=id).one_or_none()
-
-        # 404 if no plants found
-        if plant is None:
-            abort(404)
+        # get plant by ID with requested fields
+        plant = services.get_plant(id, **api.plant_fields_args(request.args))
 
-        # return formatted plant
-        return jsonify({
-            'success': True,
-            'plant': plant.format()
-        })
+        # return formatted plant, 404 if no plants found
+        return jsonify(api.item_body('plant', plant))
 
     @app.route('/api/plants/new', methods=['POST'])
     @requires_auth('post:plants')
@@ -462,9 +524,11 @@ def create_app(test_config=None):
         if 'profile' in session:
             user_id = session['profile']['user_table_id']
         else:
-            auth0_user_id = jwt['sub']
-            user_id = User.query.filter_by(
-                user_id=auth0_user_id).one_or_none().id
+            user_id = services.get_user_id(jwt['sub'])
+
+            # abort if token subject has no user account
+            if user_id is None:
+                abort(401)
 
         # load plant form data
         name = body.get('name')
@@ -545,7 +609,7 @@ def create_app(test_config=None):
 
             try:
                 # update plant in database
-                plant.insert()
+                plant.update()
             except Exception as e:
                 print('ERROR: ', str(e))
                 abort(422)
@@ -565,13 +629,8 @@ def create_app(test_config=None):
             # save plant name
             plant_name = plant.name
 
-            # first delete all observations related to plant
-            observations = Observation.query.filter_by(plant_id=id).all()
-            for observation in observations:
-                observation.delete()
-
             try:
-                # delete plant from the database
+                # delete plant and its observations in one transaction
                 plant.delete()
             except Exception as e:
                 print('ERROR: ', str(e))
@@ -588,45 +647,44 @@ def create_app(test_config=None):
             })
 
     @app.route('/api/observations')
+    @versioned(api.observations_keys)
     def get_observations_api():
         '''
-        Handles API GET requests for getting all observations. Returns JSON.
+        Handles API GET requests for getting all observations, one page at
+        a time. Returns JSON, streamed in full if stream=true is requested.
         '''
 
-        # get all observations from database
-        observations = Observation.query.all()
+        # get requested fields and area
+        fields_args = api.observation_fields_args(request.args)
+        fields_args.update(api.observation_area_args(request.args))
 
-        # 404 if no observations found
-        if len(observations) == 0:
-            abort(404)
+        # stream all observations
+        if api.stream_requested(request.args):
+            return stream_listing('observations',
+                                  services.iter_observations, **fields_args)
 
-        # format each observation
-        observations = format_observations(observations)
+        # get page of observations, 404 if no observations found
+        observations, next_cursor = get_page(services.get_observations_page,
+                                             **fields_args)
 
-        # return observations
-        return jsonify({
-            'success': True,
-            'observations': observations
-        })
+        # return observations and link to next page
+        return jsonify(api.page_body(
+            'observations', observations,
+            next_page_link('get_observations_api', next_cursor)))
 
     @app.route('/api/observations/<int:id>')
+    @versioned(api.observation_keys)
     def get_observation_by_id_api(id):
         '''
         Handles API GET requests for getting observation by id. Returns JSON.
         '''
 
-        # get observation from database by id
-        observation = Observation.query.filter_by(id=id).one_or_none()
+        # get observation from database by id with requested fields
+        observation = services.get_observation(
+            id, **api.observation_fields_args(request.args))
 
-        # 404 if no observation found
-        if observation is None:
-            abort(404)
-
-        # return formatted observation
-        return jsonify({
-            'success': True,
-            'observation': observation.format()
-        })
+        # return formatted observation, 404 if no observation found
+        return jsonify(api.item_body('observation', observation))
 
     @app.route('/api/observations/new', methods=['POST'])
     @requires_auth('post:observations')
@@ -642,9 +700,11 @@ def create_app(test_config=None):
         if 'profile' in session:
             user_id = session['profile']['user_table_id']
         else:
-            auth0_user_id = jwt['sub']
-            user_id = User.query.filter_by(
-                user_id=auth0_user_id).one_or_none().id
+            user_id = services.get_user_id(jwt['sub'])
+
+            # abort if token subject has no user account
+            if user_id is None:
+                abort(401)
 
         # load observation body data
         plant_id = body.get('plantID')
@@ -655,9 +715,26 @@ def create_app(test_config=None):
         if ((date == '') or (plant_id == '')):
             abort(422)
 
+        # parse date like bulk records, the column only takes datetimes on
+        # SQLite
+        try:
+            date = services.parse_observation_date(date)
+        except ValueError:
+            abort(422)
+
+        # load optional location
+        try:
+            latitude, longitude, accuracy = geo.validate_location(
+                body.get('latitude'), body.get('longitude'),
+                body.get('accuracy'))
+        except ValueError:
+            abort(422)
+
         # create a new observation
         observation = Observation(user_id=user_id, date=date,
-                                  plant_id=plant_id, notes=notes)
+                                  plant_id=plant_id, notes=notes,
+                                  latitude=latitude, longitude=longitude,
+                                  accuracy=accuracy)
 
         try:
             # add observation to the database
@@ -675,6 +752,45 @@ def create_app(test_config=None):
             'observation': observation.format()
         })
 
+    @app.route('/api/observations/bulk', methods=['POST'])
+    @requires_auth('post:observations')
+    def bulk_post_observations_api(jwt):
+        '''
+        Handles API POST requests for adding many observations at once.
+        Accepts a JSON array or NDJSON body, optionally gzip compressed.
+        '''
+
+        # get observation records from request body
+        records = read_bulk_body()
+
+        # limit number of observations per request
+        if len(records) > services.MAX_BULK_OBSERVATIONS:
+            abort(422)
+
+        # get user table id from session or jwt
+        if 'profile' in session:
+            user_id = session['profile']['user_table_id']
+        else:
+            user_id = services.get_user_id(jwt['sub'])
+
+            # abort if token subject has no user account
+            if user_id is None:
+                abort(401)
+
+        try:
+            # validate and insert observations in one transaction
+            results = services.bulk_create_observations(user_id, records)
+        except Exception as e:
+            print('ERROR: ', str(e))
+            abort(422)
+
+        # return result for each observation
+        return jsonify({
+            'success': True,
+            'created': sum(1 for result in results if result['success']),
+            'results': results
+        })
+
     @app.route('/api/observations/<int:id>/edit', methods=['PATCH', 'DELETE'])
     @requires_auth('edit_or_delete:observations')
     def edit_or_delete_observation_api(*args, **kwargs):
@@ -699,9 +815,11 @@ def create_app(test_config=None):
         if 'profile' in session:
             user_id = session['profile']['user_table_id']
         else:
-            auth0_user_id = jwt['sub']
-            user_id = User.query.filter_by(
-                user_id=auth0_user_id).one_or_none().id
+            user_id = services.get_user_id(jwt['sub'])
+
+            # abort if token subject has no user account
+            if user_id is None:
+                abort(401)
 
         # abort if request user_id doesn't match observation user_id
         # users can only edit/delete their own observations
@@ -725,14 +843,18 @@ def create_app(test_config=None):
 
             # update observation with data from body
             if body.get('date'):
-                observation.date = body.get('date')
+                try:
+                    observation.date = services.parse_observation_date(
+                        body.get('date'))
+                except ValueError:
+                    abort(422)
 
             if body.get('notes'):
                 observation.notes = body.get('notes')
 
             try:
                 # update observation in database
-                observation.insert()
+                observation.update()
             except Exception as e:
                 print('ERROR: ', str(e))
                 abort(422)
@@ -768,6 +890,62 @@ def create_app(test_config=None):
                 "observation_id": observation_id
             })
 
+    @app.route('/api/stats/plants/<int:id>/timeline')
+    @versioned(lambda id: [row_key(Plant.__tablename__, id)])
+    def get_plant_timeline_api(id):
+        '''
+        Handles API GET requests for the number of observations of a plant
+        per week or month. Returns JSON.
+        '''
+
+        # period is week or month
+        try:
+            period = services.parse_period(request.args.get('period'))
+        except ValueError:
+            abort(400)
+
+        timeline = services.get_plant_timeline(id, period=period)
+
+        # 404 if plant has no observations
+        if len(timeline) == 0:
+            abort(404)
+
+        return jsonify({
+            'success': True,
+            'plant_id': id,
+            'period': period,
+            'timeline': timeline
+        })
+
+    @app.route('/api/search')
+    @versioned(lambda: [table_key(Plant.__tablename__),
+                        table_key(Observation.__tablename__)])
+    def search_api():
+        '''
+        Handles API GET requests for searching plants and observation notes,
+        most relevant first, one page at a time. Returns JSON.
+        '''
+
+        # get page of results, 400 if no search terms, 404 if no matches
+        results, next_cursor = get_page(services.search,
+                                        q=request.args.get('q'))
+
+        # return results and link to next page
+        return jsonify({
+            'success': True,
+            'results': results,
+            'next': next_page_link('search_api', next_cursor)
+        })
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        '''
+        Serves request metrics of all workers in Prometheus text format
+        '''
+
+        return Response(metrics.registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
     @app.route('/api/key')
     def get_api_key():
         '''
@@ -782,44 +960,28 @@ def create_app(test_config=None):
     '''
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
-            "success": False,
-            "error": 422,
-            "message": "unprocessable"
-        }), 422
+        return jsonify(api.error_body(422)), 422
 
     '''
     Error handling for resource not found
     '''
     @app.errorhandler(404)
     def resource_not_found(error):
-        return jsonify({
-            "success": False,
-            "error": 404,
-            "message": "resource not found"
-        }), 404
+        return jsonify(api.error_body(404)), 404
 
     '''
     Error handling for method not allowed
     '''
     @app.errorhandler(405)
     def method_not_allowed(error):
-        return jsonify({
-            "success": False,
-            "error": 405,
-            "message": "method not allowed"
-        }), 405
+        return jsonify(api.error_body(405)), 405
 
     '''
     Error handling for bad request
     '''
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
-            "success": False,
-            "error": 400,
-            "message": "bad request"
-        }), 400
+        return jsonify(api.error_body(400)), 400
 
     '''
     Error handling for AuthError
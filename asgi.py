@@ -0,0 +1,923 @@
+import asyncio
+import io
+import logging
+import os
+import re
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from types import SimpleNamespace
+from flask import json
+from sqlalchemy import text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import Query
+from werkzeug.exceptions import HTTPException, InternalServerError
+from werkzeug.http import parse_etags, quote_etag
+from werkzeug.urls import url_decode, url_encode
+from models import (db, Plant, Observation, env_flag, statement_timeout,
+                    format_plants, PLANT_FIELDS, OBSERVATION_COLUMNS,
+                    OBSERVATION_PLANT_COLUMNS)
+from pagination import DEFAULT_LIMIT, order_by_key, encode_cursor
+from cache import cached_async
+from versions import version_store
+from metrics import RequestStats, finish_request
+import services
+import api
+import geo
+from app import app as flask_app
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+'''
+Asyncio Read API
+
+ASGI application serving the public read routes, GET /api/plants,
+/api/plants/<id>, /api/observations and /api/observations/<id>, from an
+event loop, so one process can keep thousands of readers waiting on the
+database without a thread each. Every other request is passed to the
+Flask app in a thread pool, so this module can be served on its own:
+
+    uvicorn asgi:app
+
+The routes behave like their Flask versions: request args are parsed
+and responses built by the api module both apps use, with the same ETags
+and read-through cache. Queries are built from the models with the
+pagination and area helpers the services use, and rows are formatted by
+the models' format methods. This module only holds the async I/O.
+
+On Postgres with asyncpg installed, queries run on an asyncpg pool of up
+to ASYNC_DB_POOL_SIZE connections. Otherwise (SQLite, or no asyncpg) they
+run on the SQLAlchemy engine in the thread pool, like the Flask app.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+# most connections in the asyncpg pool
+ASYNC_DB_POOL_SIZE = int(os.getenv('ASYNC_DB_POOL_SIZE', 20))
+
+# threads running Flask requests and, without asyncpg, queries. One pool
+# connection each, like gunicorn's gthread workers.
+THREADS = int(os.getenv('ASGI_THREADS', os.getenv('DB_POOL_SIZE', 5)))
+
+# SQLAlchemy renders parameters as :1, :2, ... asyncpg expects $1, $2, ...
+NUMERIC_DIALECT = postgresql.dialect(paramstyle='numeric')
+NUMERIC_PARAMETER = re.compile(r'(?<![:\w]):(\d+)')
+
+# observation columns in model order, and the label prefix of plant
+# columns read with observations
+OBSERVATION_COLUMN_NAMES = tuple(dict.fromkeys(OBSERVATION_COLUMNS.values()))
+PLANT_LABEL = 'plant__'
+
+# stats of the request being handled, read by the databases
+current_stats = ContextVar('request_stats', default=None)
+
+
+def record_statement(seconds):
+    stats = current_stats.get()
+    if stats is not None:
+        stats.db_statements += 1
+        stats.db_seconds += seconds
+
+
+def masked_url(url):
+    # database URL without its password
+    return re.sub(r'(://[^:/@]*:)[^@]*@', r'\1***@', url or '')
+
+
+def compile_query(query):
+    '''
+    Returns the statement of a Query with $n placeholders and its
+    parameters in order, as asyncpg takes them
+    '''
+
+    compiled = query.statement.compile(dialect=NUMERIC_DIALECT)
+    statement = NUMERIC_PARAMETER.sub(r'$\1', compiled.string)
+    parameters = [compiled.params[name] for name in compiled.positiontup]
+
+    return statement, parameters
+
+
+'''
+Databases
+'''
+
+
+class AsyncpgDatabase:
+    '''
+    Runs queries on an asyncpg connection pool, opened on first use
+    '''
+
+    def __init__(self, url, max_size=ASYNC_DB_POOL_SIZE):
+        # asyncpg doesn't take SQLAlchemy driver names
+        self.dsn = 'postgresql://' + url.split('://', 1)[1]
+        self.url = url
+        self.max_size = max_size
+        self.pool = None
+        self.postgis = False
+        self.pgbouncer = env_flag('DB_PGBOUNCER', False)
+        self._lock = None
+
+    def __repr__(self):
+        return f'<AsyncpgDatabase {masked_url(self.url)}>'
+
+    async def connect(self):
+        if self.pool is not None:
+            return
+
+        # created here so it belongs to the running loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            if self.pool is not None:
+                return
+
+            server_settings = {'application_name': os.getenv(
+                'DB_APPLICATION_NAME', 'plant-survey')}
+
+            # PgBouncer rejects startup options and can't keep prepared
+            # statements, statement_timeout is set per transaction instead
+            if statement_timeout() and not self.pgbouncer:
+                server_settings['statement_timeout'] = \
+                    str(statement_timeout())
+
+            pool = await asyncpg.create_pool(
+                self.dsn, min_size=1, max_size=self.max_size,
+                timeout=int(os.getenv('DB_CONNECT_TIMEOUT', 10)),
+                statement_cache_size=0 if self.pgbouncer else 100,
+                server_settings=server_settings)
+
+            async with pool.acquire() as connection:
+                self.postgis = await connection.fetchval(
+                    geo.POSTGIS_INSTALLED) is not None
+            self.pool = pool
+
+    async def close(self):
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    async def fetch(self, query):
+        '''
+        Returns the rows of a Query as mappings
+        '''
+
+        statement, parameters = compile_query(query)
+
+        # waits for a free connection like the SQLAlchemy pool
+        async with self.pool.acquire(
+                timeout=int(os.getenv('DB_POOL_TIMEOUT', 30))) as connection:
+            start = time.perf_counter()
+            if self.pgbouncer and statement_timeout():
+                async with connection.transaction():
+                    await connection.execute(
+                        f'SET LOCAL statement_timeout = '
+                        f'{statement_timeout()}')
+                    rows = await connection.fetch(statement, *parameters)
+            else:
+                rows = await connection.fetch(statement, *parameters)
+            record_statement(time.perf_counter() - start)
+
+        return rows
+
+
+class EngineDatabase:
+    '''
+    Runs queries on the Flask app's SQLAlchemy engine in a thread pool
+    '''
+
+    def __init__(self, app, executor):
+        self.app = app
+        self.executor = executor
+        self.engine = None
+        self.postgis = False
+
+    def __repr__(self):
+        url = self.app.config.get('SQLALCHEMY_DATABASE_URI')
+        return f'<EngineDatabase {masked_url(url)}>'
+
+    async def connect(self):
+        if self.engine is not None:
+            return
+
+        engine = db.get_engine(self.app)
+        if engine.dialect.name == 'postgresql':
+            self.postgis = await self.run(
+                lambda: engine.execute(text(geo.POSTGIS_INSTALLED))
+                .scalar() is not None)
+        self.engine = engine
+
+    async def close(self):
+        pass
+
+    async def fetch(self, query):
+        '''
+        Returns the rows of a Query as mappings
+        '''
+
+        def fetch_rows():
+            start = time.perf_counter()
+            rows = self.engine.execute(query.statement).fetchall()
+            return rows, time.perf_counter() - start
+
+        rows, seconds = await self.run(fetch_rows)
+        record_statement(seconds)
+        return rows
+
+    def run(self, f):
+        return asyncio.get_running_loop().run_in_executor(self.executor, f)
+
+
+def create_database(app, executor):
+    '''
+    Uses asyncpg on Postgres if it's installed, otherwise the app's engine
+    '''
+
+    url = app.config.get('SQLALCHEMY_DATABASE_URI') or ''
+    if asyncpg is not None and url.startswith('postgres'):
+        return AsyncpgDatabase(url)
+
+    return EngineDatabase(app, executor)
+
+
+'''
+Queries
+
+Column queries without a session, labelled with model attribute names so
+rows read the same from asyncpg and SQLAlchemy. Rows are wrapped in
+objects with the model format methods.
+'''
+
+
+class PlantRow:
+    '''
+    Plant read as columns, formatted by Plant.format
+    '''
+
+    format = Plant.format
+
+    def __init__(self, row):
+        self.__dict__.update(dict(row))
+        self.plant_observations = []
+
+
+class ObservationRow:
+    '''
+    Observation read as columns, formatted by Observation.format. The
+    plant is the plant row it was loaded with, or its labelled columns.
+    '''
+
+    format = Observation.format
+
+    def __init__(self, row, plant=None):
+        plant_columns = {}
+        for key, value in dict(row).items():
+            if key.startswith(PLANT_LABEL):
+                plant_columns[key[len(PLANT_LABEL):]] = value
+            else:
+                setattr(self, key, value)
+
+        self.plant = plant if plant is not None \
+            else SimpleNamespace(**plant_columns)
+
+
+# plant columns, limited to fields like models.plants_query
+def plants_query(fields=None, include_observations=True):
+    names = set(PLANT_FIELDS)
+    if fields is not None:
+        names = {'id'} | set(fields)
+
+        # embedded observations show the plant name and image
+        if include_observations:
+            names |= {'name', 'image_link'}
+
+    return Query([getattr(Plant, name).label(name) for name in PLANT_FIELDS
+                  if name in names])
+
+
+# observation columns with the plant columns its fields need, like
+# models.observations_query
+def observations_query(fields=None):
+    if fields is None:
+        names = set(OBSERVATION_COLUMN_NAMES)
+        plant_names = set(OBSERVATION_PLANT_COLUMNS.values())
+    else:
+        # id and date are the listing sort key
+        names = {'id', 'date'}
+        names |= {OBSERVATION_COLUMNS[field] for field in fields
+                  if field in OBSERVATION_COLUMNS}
+        plant_names = {OBSERVATION_PLANT_COLUMNS[field] for field in fields
+                       if field in OBSERVATION_PLANT_COLUMNS}
+
+    columns = [getattr(Observation, name).label(name)
+               for name in OBSERVATION_COLUMN_NAMES if name in names]
+    columns += [getattr(Plant, name).label(PLANT_LABEL + name)
+                for name in sorted(plant_names)]
+
+    query = Query(columns).select_from(Observation)
+    if plant_names:
+        query = query.join(Plant, Plant.id == Observation.plant_id)
+
+    return query
+
+
+async def load_observations(database, plants):
+    # observations of a page of plants in one SELECT ... IN, unordered
+    # like selectinload's so rows come back in the same order
+    if not plants:
+        return
+
+    plants_by_id = {plant.id: plant for plant in plants}
+    query = Query([getattr(Observation, name).label(name)
+                   for name in OBSERVATION_COLUMN_NAMES]) \
+        .filter(Observation.plant_id.in_(list(plants_by_id)))
+
+    for row in await database.fetch(query):
+        plant = plants_by_id[row['plant_id']]
+        plant.plant_observations.append(ObservationRow(row, plant))
+
+
+async def fetch_page(database, query, columns, limit):
+    '''
+    Returns one page of an ordered query and the next cursor, like
+    pagination.paginate
+    '''
+
+    # fetch one extra row to find out if there is a next page
+    rows = await database.fetch(query.limit(limit + 1))
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][column.key]
+                                     for column in columns])
+
+    return rows, next_cursor
+
+
+async def iter_rows(database, make_query, columns, cursor):
+    # yields rows of an ordered query after cursor, one keyset page of
+    # STREAM_BATCH_SIZE rows per round trip
+    while True:
+        rows, cursor = await fetch_page(database, make_query(cursor),
+                                        columns, services.STREAM_BATCH_SIZE)
+        yield rows
+        if cursor is None:
+            return
+
+
+'''
+Services
+
+Async versions of the services behind the routes, cached under the same
+version keys
+'''
+
+
+@cached_async(services.listing_keys)
+async def get_plants_page(database, cursor=None, limit=DEFAULT_LIMIT,
+                          fields=None, include_observations=True):
+    query = order_by_key(plants_query(fields, include_observations),
+                         services.PLANT_KEY, cursor=cursor)
+    rows, next_cursor = await fetch_page(database, query, services.PLANT_KEY,
+                                         limit)
+
+    plants = [PlantRow(row) for row in rows]
+    if include_observations:
+        await load_observations(database, plants)
+
+    return format_plants(plants, fields, include_observations), next_cursor
+
+
+async def iter_plants(database, cursor=None, fields=None,
+                      include_observations=True):
+    def make_query(cursor):
+        return order_by_key(plants_query(fields, include_observations),
+                            services.PLANT_KEY, cursor=cursor)
+
+    async for rows in iter_rows(database, make_query, services.PLANT_KEY,
+                                cursor):
+        plants = [PlantRow(row) for row in rows]
+        if include_observations:
+            await load_observations(database, plants)
+
+        for plant in plants:
+            yield plant.format(fields, include_observations)
+
+
+@cached_async(lambda database, id, **kwargs: api.plant_keys(id))
+async def get_plant(database, id, fields=None, include_observations=True):
+    rows = await database.fetch(
+        plants_query(fields, include_observations).filter(Plant.id == id))
+
+    if not rows:
+        return None
+
+    plant = PlantRow(rows[0])
+    if include_observations:
+        await load_observations(database, [plant])
+
+    return plant.format(fields, include_observations)
+
+
+@cached_async(services.listing_keys)
+async def get_observations_page(database, cursor=None, limit=DEFAULT_LIMIT,
+                                fields=None, area=None):
+    query = order_by_key(
+        services.filter_area(observations_query(fields), area,
+                             database.postgis),
+        services.OBSERVATION_KEY, cursor=cursor, descending=True)
+    rows, next_cursor = await fetch_page(database, query,
+                                         services.OBSERVATION_KEY, limit)
+
+    return [ObservationRow(row).format(fields) for row in rows], next_cursor
+
+
+async def iter_observations(database, cursor=None, fields=None, area=None):
+    def make_query(cursor):
+        return order_by_key(
+            services.filter_area(observations_query(fields), area,
+                                 database.postgis),
+            services.OBSERVATION_KEY, cursor=cursor, descending=True)
+
+    async for rows in iter_rows(database, make_query,
+                                services.OBSERVATION_KEY, cursor):
+        for row in rows:
+            yield ObservationRow(row).format(fields)
+
+
+@cached_async(lambda database, id, **kwargs: api.observation_keys(id))
+async def get_observation(database, id, fields=None):
+    rows = await database.fetch(
+        observations_query(fields).filter(Observation.id == id))
+
+    if not rows:
+        return None
+
+    return ObservationRow(rows[0]).format(fields)
+
+
+'''
+Requests and Responses
+'''
+
+
+class Request:
+    '''
+    The parts of an ASGI HTTP request the read routes use, parsed like
+    Flask's request
+    '''
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.root_path = scope.get('root_path', '')
+        self.path = '/' + scope['path'].lstrip('/')
+        self.query_string = scope.get('query_string', b'')
+        self.args = url_decode(self.query_string)
+
+        # repeated headers are joined like in WSGI
+        self.headers = {}
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').lower()
+            value = value.decode('latin-1')
+            if name in self.headers:
+                value = self.headers[name] + ',' + value
+            self.headers[name] = value
+
+    @property
+    def full_path(self):
+        # path and query string, as in the Flask app's ETags
+        return self.path + '?' + self.query_string.decode('utf-8', 'replace')
+
+
+class Response:
+    '''
+    Status, headers and either a body or an async iterator of str chunks
+    '''
+
+    def __init__(self, status, body=b'', content_type=None, stream=None):
+        self.status = status
+        self.body = body
+        self.stream = stream
+        self.headers = []
+        if content_type is not None:
+            self.headers.append(('Content-Type', content_type))
+
+
+# a read route: Flask rule, path pattern, view method name and the
+# version keys of its ETag
+Route = namedtuple('Route', 'rule pattern view get_keys')
+
+ROUTES = [
+    Route('/api/plants', re.compile(r'/api/plants'), 'get_plants_api',
+          api.plants_keys),
+    Route('/api/plants/<int:id>', re.compile(r'/api/plants/(?P<id>\d+)'),
+          'get_plant_by_id_api', api.plant_keys),
+    Route('/api/observations', re.compile(r'/api/observations'),
+          'get_observations_api', api.observations_keys),
+    Route('/api/observations/<int:id>',
+          re.compile(r'/api/observations/(?P<id>\d+)'),
+          'get_observation_by_id_api', api.observation_keys),
+]
+
+
+def match_route(path):
+    '''
+    Returns the read route matching path and its arguments, or
+    (None, None)
+    '''
+
+    for route in ROUTES:
+        match = route.pattern.fullmatch(path)
+        if match:
+            return route, {name: int(value)
+                           for name, value in match.groupdict().items()}
+
+    return None, None
+
+
+'''
+WSGI Mount
+'''
+
+
+def wsgi_environ(scope, body):
+    '''
+    Returns the WSGI environ of an ASGI HTTP request
+    '''
+
+    server = scope.get('server') or ('localhost', 80)
+    client = scope.get('client') or ('', 0)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '')
+        .encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+        'SERVER_NAME': server[0],
+        'SERVER_PORT': str(server[1]),
+        'SERVER_PROTOCOL': 'HTTP/' + scope.get('http_version', '1.1'),
+        'REMOTE_ADDR': client[0],
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        value = value.decode('latin-1')
+        if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+            name = 'HTTP_' + name
+
+        # repeated headers are joined, cookies with their own separator
+        if name in environ:
+            separator = '; ' if name == 'HTTP_COOKIE' else ','
+            value = environ[name] + separator + value
+        environ[name] = value
+
+    return environ
+
+
+class WSGIMount:
+    '''
+    Serves ASGI HTTP requests with a WSGI app in a thread pool. Request
+    and response bodies are buffered.
+    '''
+
+    def __init__(self, wsgi_app, executor):
+        self.wsgi_app = wsgi_app
+        self.executor = executor
+
+    async def __call__(self, scope, receive, send):
+        body = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            body.append(message.get('body', b''))
+            if not message.get('more_body', False):
+                break
+
+        environ = wsgi_environ(scope, b''.join(body))
+        status, headers, chunks = await asyncio.get_running_loop() \
+            .run_in_executor(self.executor, self.run, environ)
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': b''.join(chunks)})
+
+    def run(self, environ):
+        # runs the whole request in one thread, so Flask's context locals
+        # and teardown stay on it
+        response = {}
+        chunks = []
+
+        def start_response(status, headers, exc_info=None):
+            response['status'] = int(status.split(' ', 1)[0])
+            response['headers'] = headers
+            return chunks.append
+
+        iterable = self.wsgi_app(environ, start_response)
+        try:
+            chunks.extend(iterable)
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+
+        return response['status'], response['headers'], chunks
+
+
+'''
+ASGI App
+'''
+
+
+class ReadAPI:
+    '''
+    ASGI app serving the read routes from the event loop and everything
+    else with the Flask app
+    '''
+
+    def __init__(self, flask_app, threads=THREADS):
+        self.flask_app = flask_app
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.database = create_database(flask_app, self.executor)
+        self.fallback = WSGIMount(flask_app.wsgi_app, self.executor)
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+            return
+
+        # the Flask app only speaks HTTP
+        if scope['type'] != 'http':
+            return
+
+        route, kwargs = None, None
+        if scope['method'] in ('GET', 'HEAD'):
+            route, kwargs = match_route('/' + scope['path'].lstrip('/'))
+
+        if route is None:
+            await self.fallback(scope, receive, send)
+            return
+
+        request = Request(scope)
+        stats = RequestStats()
+        token = current_stats.set(stats)
+        response = await self.respond(request, route, kwargs)
+        try:
+            await self.send_response(request, response, send)
+        finally:
+            current_stats.reset(token)
+
+            # recorded once the body was sent, like the Flask app
+            finish_request(stats, route.rule, request.method,
+                           response.status)
+
+    async def lifespan(self, receive, send):
+        # open the pool at startup, close it at shutdown
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.database.connect()
+                except Exception as e:
+                    await send({'type': 'lifespan.startup.failed',
+                                'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def respond(self, request, route, kwargs):
+        '''
+        Returns the response of a read route, 304 if the client's ETag is
+        current, like the Flask app's versioned views
+        '''
+
+        try:
+            etag = await version_store.etag_async(request.full_path,
+                                                  *route.get_keys(**kwargs))
+
+            # client already has current representation
+            if parse_etags(request.headers.get('if-none-match')) \
+                    .contains(etag):
+                response = Response(304)
+            else:
+                # servers may not send lifespan events
+                await self.database.connect()
+                response = await getattr(self, route.view)(request,
+                                                           **kwargs)
+        except HTTPException as e:
+            response = self.error_response(e.code)
+        except Exception:
+            logger.exception('ERROR: %s %s', request.method,
+                             request.full_path)
+            response = Response(500, InternalServerError().get_body()
+                                .encode(), 'text/html; charset=utf-8')
+
+        if response.status in (200, 304):
+            response.headers.append(('ETag', quote_etag(etag)))
+        response.headers.extend(api.ACCESS_CONTROL_HEADERS)
+
+        return response
+
+    async def send_response(self, request, response, send):
+        headers = list(response.headers)
+        if response.stream is None and response.status != 304:
+            headers.append(('Content-Length', str(len(response.body))))
+
+        await send({'type': 'http.response.start',
+                    'status': response.status,
+                    'headers': [(name.lower().encode('latin-1'),
+                                 value.encode('latin-1'))
+                                for name, value in headers]})
+
+        # HEAD responses have the headers of GET without the body
+        if response.stream is None:
+            await send({'type': 'http.response.body',
+                        'body': b'' if request.method == 'HEAD'
+                        else response.body})
+            return
+
+        try:
+            if request.method != 'HEAD':
+                async for chunk in response.stream:
+                    await send({'type': 'http.response.body',
+                                'body': chunk.encode(), 'more_body': True})
+        finally:
+            await response.stream.aclose()
+        await send({'type': 'http.response.body', 'body': b''})
+
+    # JSON
+
+    def dumps(self, data, compact=True):
+        '''
+        Encodes data like jsonify, or like json.dumps if not compact
+        '''
+
+        if not compact:
+            return json.dumps(data, app=self.flask_app)
+
+        indent = None
+        separators = (',', ':')
+        if self.flask_app.config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+                self.flask_app.debug:
+            indent = 2
+            separators = (', ', ': ')
+
+        return json.dumps(data, app=self.flask_app, indent=indent,
+                          separators=separators) + '\n'
+
+    def jsonify(self, data, status=200):
+        return Response(status, self.dumps(data).encode(),
+                        self.flask_app.config['JSONIFY_MIMETYPE'])
+
+    def error_response(self, code):
+        return self.jsonify(api.error_body(code), code)
+
+    # UTILITY FUNCTIONS
+
+    # get one page from a service using cursor and limit request args,
+    # 400 if malformed and 404 if first page is empty
+    async def get_page(self, request, get_service_page, **kwargs):
+
+        with api.malformed_args():
+            items, next_cursor = await get_service_page(
+                self.database, **api.page_args(request.args), **kwargs)
+
+        api.require_first_page(request.args, len(items) > 0)
+        return items, next_cursor
+
+    # stream a listing from a service generator as one JSON envelope
+    async def stream_listing(self, request, key, iter_service_items,
+                             **kwargs):
+
+        items = iter_service_items(self.database,
+                                   cursor=request.args.get('cursor'),
+                                   **kwargs)
+        with api.malformed_args():
+            # read first item now so errors are raised before streaming
+            try:
+                first = await items.__anext__()
+            except StopAsyncIteration:
+                first = None
+
+        # 404 if listing is empty
+        api.require_first_page(request.args, first is not None)
+
+        async def generate():
+            envelope = api.StreamEnvelope(key)
+            if first is not None:
+                chunk = envelope.add(self.dumps(first, compact=False))
+                if chunk is not None:
+                    yield chunk
+
+                async for item in items:
+                    chunk = envelope.add(self.dumps(item, compact=False))
+                    if chunk is not None:
+                        yield chunk
+
+            yield envelope.close()
+
+        return Response(200, content_type='application/json',
+                        stream=generate())
+
+    # get link to next page with same request args, None on last page
+    def next_page_link(self, request, rule, next_cursor):
+        if next_cursor is None:
+            return None
+
+        args = api.next_page_args(request.args, next_cursor)
+        return request.root_path + rule + '?' + url_encode(args)
+
+    # API ROUTES
+
+    async def get_plants_api(self, request):
+        '''
+        Handles GET /api/plants like the Flask view
+        '''
+
+        # get requested fields
+        fields_args = api.plant_fields_args(request.args)
+
+        # stream all plants
+        if api.stream_requested(request.args):
+            return await self.stream_listing(request, 'plants', iter_plants,
+                                             **fields_args)
+
+        # get page of plants, 404 if no plants found
+        plants, next_cursor = await self.get_page(request, get_plants_page,
+                                                  **fields_args)
+
+        # return plants and link to next page
+        return self.jsonify(api.page_body(
+            'plants', plants,
+            self.next_page_link(request, '/api/plants', next_cursor)))
+
+    async def get_plant_by_id_api(self, request, id):
+        '''
+        Handles GET /api/plants/<id> like the Flask view
+        '''
+
+        # get plant by ID with requested fields
+        plant = await get_plant(self.database, id,
+                                **api.plant_fields_args(request.args))
+
+        # return formatted plant, 404 if no plants found
+        return self.jsonify(api.item_body('plant', plant))
+
+    async def get_observations_api(self, request):
+        '''
+        Handles GET /api/observations like the Flask view
+        '''
+
+        # get requested fields and area
+        fields_args = api.observation_fields_args(request.args)
+        fields_args.update(api.observation_area_args(request.args))
+
+        # stream all observations
+        if api.stream_requested(request.args):
+            return await self.stream_listing(request, 'observations',
+                                             iter_observations,
+                                             **fields_args)
+
+        # get page of observations, 404 if no observations found
+        observations, next_cursor = await self.get_page(
+            request, get_observations_page, **fields_args)
+
+        # return observations and link to next page
+        return self.jsonify(api.page_body(
+            'observations', observations,
+            self.next_page_link(request, '/api/observations', next_cursor)))
+
+    async def get_observation_by_id_api(self, request, id):
+        '''
+        Handles GET /api/observations/<id> like the Flask view
+        '''
+
+        # get observation from database by id with requested fields
+        observation = await get_observation(
+            self.database, id, **api.observation_fields_args(request.args))
+
+        # return formatted observation, 404 if no observation found
+        return self.jsonify(api.item_body('observation', observation))
+
+
+# ASGI application, serve with e.g. uvicorn asgi:app
+app = ReadAPI(flask_app)
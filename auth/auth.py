@@ -1,10 +1,11 @@
-import json
 import os
 from flask import request, session
 from functools import wraps
 from jose import jwt
-from urllib.request import urlopen
+from auth.jwks import JWKSCache
+from auth.token_cache import TokenCache
 import constants
+import metrics
 
 
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
@@ -13,6 +14,18 @@ AUTH0_AUDIENCE = os.getenv('AUTH0_AUDIENCE')
 AUTH0_CLIENT_ID = os.getenv('AUTH0_CLIENT_ID')
 AUTH0_CALLBACK_URL = os.getenv('AUTH0_CALLBACK_URL')
 
+# JWKS url, may be set to a local file:// url for testing
+JWKS_URL = os.getenv('JWKS_URL',
+                     f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+# process-wide cache of Auth0 public keys
+jwks_cache = JWKSCache(JWKS_URL, observer=metrics.record_auth0_call)
+
+# process-wide cache of already verified tokens
+token_cache = TokenCache(
+    maxsize=int(os.getenv('TOKEN_CACHE_SIZE', 1024)),
+    max_age=int(os.getenv('TOKEN_CACHE_MAX_AGE', 300)))
+
 # AuthError Exception
 '''
 AuthError Exception
@@ -98,16 +111,14 @@ def verify_decode_jwt(token):
 
     # print('TOKEN: ', token)
 
-    # get public key from Auth0
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
+    # skip verification if token was already verified and hasn't expired
+    payload = token_cache.get(token, valid_kids=jwks_cache.keys)
+    if payload is not None:
+        return dict(payload)
 
     # get header data from token
     unverified_header = jwt.get_unverified_header(token)
 
-    # choose rsa key
-    rsa_key = {}
-
     # validate token header contains kid
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -115,16 +126,9 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        # if kid match, build rsa key
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    # get public key matching kid from cached Auth0 JWKS
+    rsa_key = jwks_cache.get_key(unverified_header['kid'])
+
     if rsa_key:
         try:
             # validate the token
@@ -136,7 +140,10 @@ def verify_decode_jwt(token):
                 issuer='https://' + AUTH0_DOMAIN + '/'
             )
 
-            return payload
+            # remember token as verified until it expires
+            token_cache.set(token, payload, kid=rsa_key['kid'])
+
+            return dict(payload)
 
         # catch common errors
 
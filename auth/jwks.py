@@ -0,0 +1,194 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+JWKS Cache
+Process-wide cache of the Auth0 signing keys, indexed by kid
+'''
+
+
+# key fields needed to build an rsa key
+KEY_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
+
+def parse_cache_control(header):
+    """
+    Parses a Cache-Control header into a dict of directives
+    """
+
+    directives = {}
+    if not header:
+        return directives
+
+    for part in header.split(','):
+        name, _, value = part.strip().partition('=')
+        if name:
+            directives[name.lower()] = value.strip('"')
+
+    return directives
+
+
+class JWKSCache:
+    """
+    Caches the keys served from a JWKS url.
+
+    Keys are served from memory until the TTL from the endpoint's
+    Cache-Control header runs out. After that, stale keys keep being
+    served while a background thread refreshes them. An unknown kid
+    triggers at most one blocking refetch, and concurrent refreshes are
+    collapsed into a single fetch.
+
+    The url may be a file:// url pointing at a local JWKS file. If given,
+    observer is called with ('jwks', seconds) after each fetch.
+    """
+
+    def __init__(self, url, default_ttl=600, stale_ttl=3600,
+                 min_refetch_interval=30, timeout=5, clock=time.monotonic,
+                 observer=None):
+        self.url = url
+        self.observer = observer
+        self.default_ttl = default_ttl
+        self.stale_ttl = stale_ttl
+        self.min_refetch_interval = min_refetch_interval
+        self.timeout = timeout
+        self.clock = clock
+
+        # keys indexed by kid
+        self.keys = {}
+
+        # keys are fresh until expires_at and usable until stale_until
+        self.expires_at = 0
+        self.stale_until = 0
+        self.last_fetch = None
+
+        # number of fetches made, useful for tests and stats
+        self.fetch_count = 0
+
+        # in-flight fetch, shared by concurrent refreshes
+        self._lock = threading.Lock()
+        self._inflight = None
+
+    def get_key(self, kid):
+        """
+        Returns the rsa key for kid, or None if the JWKS has no such key
+        """
+
+        now = self.clock()
+
+        # no usable keys yet, block until fetched
+        if now >= self.stale_until:
+            self.refresh()
+
+        # keys expired but still usable, serve them and refresh in background
+        elif now >= self.expires_at:
+            self.refresh_in_background()
+
+        key = self.keys.get(kid)
+
+        # unknown kid, keys may have been rotated so refetch once
+        if key is None and self._can_refetch():
+            self.refresh()
+            key = self.keys.get(kid)
+
+        return key
+
+    def refresh(self):
+        """
+        Fetches the JWKS, or waits for a fetch already in flight
+        """
+
+        with self._lock:
+            event = self._inflight
+            leader = event is None
+            if leader:
+                event = self._inflight = threading.Event()
+
+        # another thread is already fetching, wait for its result
+        if not leader:
+            event.wait(self.timeout)
+            return
+
+        try:
+            self._fetch()
+        finally:
+            with self._lock:
+                self._inflight = None
+            event.set()
+
+    def refresh_in_background(self):
+        """
+        Starts a refresh in a daemon thread unless one is in flight
+        """
+
+        if self._inflight is not None:
+            return
+
+        thread = threading.Thread(target=self._refresh_quietly, daemon=True)
+        thread.start()
+
+    def clear(self):
+        """
+        Drops all cached keys
+        """
+
+        with self._lock:
+            self.keys = {}
+            self.expires_at = 0
+            self.stale_until = 0
+            self.last_fetch = None
+
+    def _refresh_quietly(self):
+        # keep serving stale keys if the background refresh fails
+        try:
+            self.refresh()
+        except Exception as e:
+            print('JWKS REFRESH ERROR: ', str(e))
+
+    def _can_refetch(self):
+        # rate limit refetches so unknown kids can't cause a fetch storm
+        if self.last_fetch is None:
+            return True
+        return self.clock() - self.last_fetch >= self.min_refetch_interval
+
+    def _fetch(self):
+        self.last_fetch = self.clock()
+
+        started = time.perf_counter()
+        try:
+            with urlopen(self.url, timeout=self.timeout) as response:
+                jwks = json.loads(response.read())
+                cache_control = response.headers.get('Cache-Control')
+        finally:
+            if self.observer is not None:
+                self.observer('jwks', time.perf_counter() - started)
+
+        self.fetch_count += 1
+
+        # index keys by kid
+        keys = {}
+        for key in jwks.get('keys', []):
+            if 'kid' not in key:
+                continue
+            keys[key['kid']] = {field: key.get(field)
+                                for field in KEY_FIELDS}
+
+        # use max-age from the endpoint if given
+        directives = parse_cache_control(cache_control)
+        try:
+            ttl = int(directives['max-age'])
+        except (KeyError, ValueError):
+            ttl = self.default_ttl
+
+        try:
+            stale_ttl = int(directives['stale-while-revalidate'])
+        except (KeyError, ValueError):
+            stale_ttl = self.stale_ttl
+
+        now = self.clock()
+        with self._lock:
+            self.keys = keys
+            self.expires_at = now + ttl
+            self.stale_until = now + ttl + stale_ttl
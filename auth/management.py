@@ -0,0 +1,153 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+
+
+'''
+Auth0 Management API Client
+Caches the client credentials token and reuses pooled keep-alive
+connections for all management API calls
+'''
+
+
+class ManagementClient:
+    """
+    Client for the Auth0 management API.
+
+    The access token is reused until leeway seconds before its expires_in
+    runs out. All calls go through one requests.Session with a connection
+    pool, and every call has connect/read timeouts. If given, observer is
+    called with (call name, seconds) after each call.
+    """
+
+    def __init__(self, domain, client_id, client_secret, audience=None,
+                 timeout=(3.05, 10), pool_maxsize=10, leeway=60,
+                 clock=time.monotonic, observer=None):
+        self.base_url = f'https://{domain}'
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.audience = audience or self.base_url + '/api/v2/'
+        self.timeout = timeout
+        self.leeway = leeway
+        self.clock = clock
+        self.observer = observer
+
+        # keep-alive session with a connection pool
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+
+        # cached token, shared by all threads
+        self._token = None
+        self._token_expires_at = 0
+        self._token_lock = threading.Lock()
+
+        # timing stats per call name
+        self._stats = {}
+        self._stats_lock = threading.Lock()
+
+    def get_token(self):
+        """
+        Returns a management API token, fetching a new one if expired
+        """
+
+        # one thread fetches while the others wait for its token
+        with self._token_lock:
+            if (self._token is None
+                    or self.clock() >= self._token_expires_at):
+                self._fetch_token()
+
+            return self._token
+
+    def clear_token(self):
+        """
+        Forgets the cached token
+        """
+
+        with self._token_lock:
+            self._token = None
+            self._token_expires_at = 0
+
+    def assign_roles(self, user_id, role_ids):
+        """
+        Adds roles to a user
+        """
+
+        resp = self._request('POST', f'/api/v2/users/{user_id}/roles',
+                             'assign_roles', json={'roles': role_ids})
+
+        # raises exception for any 4xx or 5xx errors
+        resp.raise_for_status()
+
+    def get_user(self, user_id):
+        """
+        Returns user info from the management API
+        """
+
+        resp = self._request('GET', f'/api/v2/users/{user_id}', 'get_user')
+
+        # raises exception for any 4xx or 5xx errors
+        resp.raise_for_status()
+
+        return resp.json()
+
+    def stats(self):
+        """
+        Returns call count, total and max time in seconds per call name
+        """
+
+        with self._stats_lock:
+            return {name: dict(stat) for name, stat in self._stats.items()}
+
+    def _fetch_token(self):
+        data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'audience': self.audience
+        }
+
+        started = self.clock()
+        resp = self._timed('token', self.session.post,
+                           self.base_url + '/oauth/token', data=data,
+                           timeout=self.timeout)
+        resp.raise_for_status()
+        info = resp.json()
+
+        # expire token a little early so it isn't used as it runs out
+        self._token = info['access_token']
+        self._token_expires_at = (started + info.get('expires_in', 0)
+                                  - self.leeway)
+
+    def _request(self, method, path, name, **kwargs):
+        resp = self._send(method, path, name, **kwargs)
+
+        # token may have been revoked, retry once with a new token
+        if resp.status_code == 401:
+            self.clear_token()
+            resp = self._send(method, path, name, **kwargs)
+
+        return resp
+
+    def _send(self, method, path, name, **kwargs):
+        headers = {'Authorization': f'Bearer {self.get_token()}'}
+        return self._timed(name, self.session.request, method,
+                           self.base_url + path, headers=headers,
+                           timeout=self.timeout, **kwargs)
+
+    def _timed(self, name, call, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return call(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            with self._stats_lock:
+                stat = self._stats.setdefault(
+                    name, {'count': 0, 'total_time': 0.0, 'max_time': 0.0})
+                stat['count'] += 1
+                stat['total_time'] += elapsed
+                stat['max_time'] = max(stat['max_time'], elapsed)
+
+            if self.observer is not None:
+                self.observer(name, elapsed)
@@ -0,0 +1,123 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+'''
+Verified Token Cache
+Bounded LRU of JWT payloads that already passed signature verification
+'''
+
+
+def hash_token(token):
+    """
+    Returns the cache key for a token, so raw tokens aren't kept in memory
+    """
+
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+class TokenCache:
+    """
+    LRU cache of verified token payloads.
+
+    Entries expire at the token's exp claim, or after max_age seconds if
+    that is sooner, so permission changes are picked up within max_age.
+    Tokens without an exp claim are never cached.
+    """
+
+    def __init__(self, maxsize=1024, max_age=300, clock=time.time):
+        self.maxsize = maxsize
+        self.max_age = max_age
+        self.clock = clock
+
+        # token hash -> (payload, kid, expires_at), oldest first
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        # hit/miss counters
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token, valid_kids=None):
+        """
+        Returns the cached payload for token, or None on a miss.
+        If valid_kids is given, entries signed by a kid no longer in it
+        are dropped.
+        """
+
+        key = hash_token(token)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None:
+                payload, kid, expires_at = entry
+
+                # drop expired entries and entries whose key was rotated out
+                if (self.clock() >= expires_at
+                        or (valid_kids is not None
+                            and kid not in valid_kids)):
+                    del self._entries[key]
+                    entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+
+            return payload
+
+    def set(self, token, payload, kid=None):
+        """
+        Caches the payload of a verified token until it expires
+        """
+
+        # don't cache tokens that never expire
+        exp = payload.get('exp')
+        if not isinstance(exp, (int, float)):
+            return
+
+        key = hash_token(token)
+        expires_at = min(exp, self.clock() + self.max_age)
+
+        with self._lock:
+            self._entries[key] = (payload, kid, expires_at)
+            self._entries.move_to_end(key)
+
+            # evict least recently used entries
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, token):
+        """
+        Removes a token from the cache, e.g. on logout
+        """
+
+        with self._lock:
+            self._entries.pop(hash_token(token), None)
+
+    def clear(self):
+        """
+        Removes all tokens from the cache
+        """
+
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Returns cache size and hit/miss counters
+        """
+
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses
+            }
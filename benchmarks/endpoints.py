@@ -0,0 +1,691 @@
+import argparse
+import base64
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from http.client import HTTPConnection
+from benchmarks.suggest import percentile
+
+
+'''
+Endpoint Benchmark
+
+Seeds a synthetic dataset and drives every route, first through the Flask
+test client (no network, one request at a time) and then through a real
+WSGI server with concurrent clients. For each endpoint it reports
+throughput, p50/p95/p99 latency, SQL statements per request and peak RSS,
+and saves the run as JSON so runs can be compared across commits. The run
+fails if any endpoint answers with a 4xx or 5xx status, since its numbers
+would time the error path.
+
+Tokens are signed with a key generated for the run and served from a
+local JWKS file, so no Auth0 tenant is needed. The database defaults to a
+temporary SQLite file. Pass --database-url to benchmark Postgres; a
+database that already has seeded rows is reused, so a large dataset is
+only generated once.
+
+Run from the repository root:
+    python -m benchmarks.endpoints --plants 1000 --observations 10000
+    python -m benchmarks.endpoints --database-url postgresql:///bench \\
+        --plants 100000 --observations 1000000
+    python -m benchmarks.endpoints compare before.json after.json
+'''
+
+
+# key id of the signing key generated for the run
+KID = 'benchmark'
+
+# claims of the benchmark tokens
+AUTH0_DOMAIN = 'benchmark.invalid'
+AUTH0_AUDIENCE = 'benchmark'
+PERMISSIONS = ['post:plants', 'edit_or_delete:plants', 'post:observations',
+               'edit_or_delete:observations']
+
+# observations per bulk request
+BULK_SIZE = 50
+
+# routes that can't run without a real Auth0 tenant
+SKIPPED = {'/callback': 'needs an Auth0 authorization code'}
+
+# areas of the bbox and near requests, around a seeded region center
+BBOX = '-105.4,39.9,-105.1,40.1'
+NEAR = '40.01,-105.27'
+RADIUS = '5000'
+
+# located observations added inside both areas if the data has none
+AREA_OBSERVATIONS = 100
+
+
+def base64url_int(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def write_jwks(directory):
+    '''
+    Generates an RSA key, writes its public half as a JWKS file and
+    returns (jwks url, private key PEM)
+    '''
+
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(65537, 2048, default_backend())
+    numbers = key.public_key().public_numbers()
+    jwks = {'keys': [{'kty': 'RSA', 'kid': KID, 'use': 'sig', 'alg': 'RS256',
+                      'n': base64url_int(numbers.n),
+                      'e': base64url_int(numbers.e)}]}
+
+    path = os.path.join(directory, 'jwks.json')
+    with open(path, 'w') as f:
+        json.dump(jwks, f)
+
+    pem = key.private_bytes(serialization.Encoding.PEM,
+                            serialization.PrivateFormat.TraditionalOpenSSL,
+                            serialization.NoEncryption())
+
+    return 'file://' + path, pem
+
+
+def make_token(pem, subject):
+    from jose import jwt
+
+    now = int(time.time())
+    claims = {'iss': f'https://{AUTH0_DOMAIN}/', 'sub': subject,
+              'aud': AUTH0_AUDIENCE, 'iat': now, 'exp': now + 24 * 3600,
+              'permissions': PERMISSIONS}
+
+    return jwt.encode(claims, pem, algorithm='RS256', headers={'kid': KID})
+
+
+def configure_environment(database_url, jwks_url, cache):
+    # the app and auth modules read these at import time, and dotenv
+    # doesn't override variables that are already set
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['JWKS_URL'] = jwks_url
+    os.environ['AUTH0_DOMAIN'] = AUTH0_DOMAIN
+    os.environ['AUTH0_AUDIENCE'] = AUTH0_AUDIENCE
+    os.environ['ALGORITHMS'] = 'RS256'
+    os.environ.setdefault('AUTH0_CLIENT_ID', 'benchmark')
+    os.environ.setdefault('AUTH0_CLIENT_SECRET', 'benchmark')
+    os.environ.setdefault('AUTH0_CALLBACK_URL',
+                          'http://localhost/callback')
+    if not cache:
+        os.environ['CACHE_MAX_ENTRIES'] = '0'
+
+
+class QueryCounter:
+    '''
+    Counts SQL statements sent to the database, from any thread
+    '''
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, conn, cursor, statement, parameters, context,
+                 executemany):
+        with self._lock:
+            self.count += 1
+
+
+def peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'],
+                                capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain'],
+                                    capture_output=True, text=True,
+                                    check=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+    return commit, dirty
+
+
+class Dataset:
+    '''
+    Ids and credentials the endpoint requests are built from
+    '''
+
+    def __init__(self, plant_ids, observation_ids, user, token,
+                 session_cookie):
+        self.plant_ids = plant_ids
+        self.observation_ids = observation_ids
+        self.user = user
+        self.token = token
+        self.session_cookie = session_cookie
+
+
+def prepare_dataset(app, args, pem):
+    '''
+    Creates the tables, seeds them unless already seeded, and returns the
+    Dataset of the run
+    '''
+
+    from models import db, Plant, Observation
+    from seed import first_seeded_subject, seed_database
+    import services
+
+    db.create_all()
+
+    # seed unless an earlier run already did
+    if first_seeded_subject() is None:
+        start = time.perf_counter()
+        seed_database(args.users, args.plants, args.observations,
+                      seed=args.seed)
+        print(f'seeded {args.users} users, {args.plants} plants and '
+              f'{args.observations} observations in '
+              f'{time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+    # requests are made as the first seeded user
+    subject = first_seeded_subject()
+    user = services.get_user(subject)
+    token = make_token(pem, subject)
+
+    # make sure the area requests find observations
+    rng = random.Random(args.seed)
+    seed_area_observations(user, rng)
+
+    # signed session cookie of a logged in user
+    profile = {'user_id': subject, 'user_table_id': user.id,
+               'name': user.name, 'username': user.username,
+               'date_added': user.date_added, 'role': user.role}
+    serializer = app.session_interface.get_signing_serializer(app)
+    session_cookie = app.session_cookie_name + '=' + serializer.dumps({
+        'logged_in': True, 'JWT': token, 'profile': profile,
+        'jwt_payload': {'sub': subject}})
+
+    # sample ids from the whole table
+    plant_ids = [id for (id,) in db.session.query(Plant.id)]
+    observation_ids = [id for (id,) in db.session.query(Observation.id)]
+
+    return Dataset(rng.sample(plant_ids, min(len(plant_ids), 1000)),
+                   rng.sample(observation_ids,
+                              min(len(observation_ids), 1000)),
+                   user, token, session_cookie)
+
+
+def seed_area_observations(user, rng):
+    '''
+    Adds located observations inside the bbox and near areas unless the
+    seeded data already has some there
+    '''
+
+    from models import db, Plant, Observation
+    import services
+
+    areas = [services.parse_observation_area(BBOX, None, None),
+             services.parse_observation_area(None, NEAR, RADIUS)]
+    if all(services.filter_area(Observation.query, area).first()
+           for area in areas):
+        return
+
+    # points within a kilometer of the near center are inside both
+    latitude, longitude = (float(value) for value in NEAR.split(','))
+    plant_ids = [id for (id,) in db.session.query(Plant.id).limit(100)]
+    for i in range(AREA_OBSERVATIONS):
+        observation = Observation(
+            user_id=user.id, date=datetime(2019, 6, 1 + i % 30),
+            plant_id=rng.choice(plant_ids), notes='Benchmark area.',
+            latitude=latitude + rng.uniform(-0.005, 0.005),
+            longitude=longitude + rng.uniform(-0.005, 0.005),
+            accuracy=10)
+        observation.insert()
+
+
+def new_plant(dataset):
+    # plant owned by the benchmark user, for edit and delete requests
+    from models import Plant
+
+    plant = Plant(user_id=dataset.user.id, name='Benchmark plant',
+                  latin_name='Benchmarkia plantae',
+                  description='Created by the endpoint benchmark.',
+                  image_link='https://example.com/benchmark.jpg')
+    plant.insert()
+
+    return plant.id
+
+
+def new_observation(dataset):
+    from models import Observation
+
+    observation = Observation(user_id=dataset.user.id,
+                              date=datetime(2019, 6, 1),
+                              plant_id=dataset.plant_ids[0],
+                              notes='Created by the endpoint benchmark.')
+    observation.insert()
+
+    return observation.id
+
+
+def plant_body():
+    return {'name': 'Benchmark plant', 'latinName': 'Benchmarkia plantae',
+            'description': 'Created by the endpoint benchmark.',
+            'imageLink': 'https://example.com/benchmark.jpg'}
+
+
+def observation_body(dataset, rng):
+    return {'plantID': rng.choice(dataset.plant_ids), 'date': '2019-06-01',
+            'notes': 'wild sage meadow', 'latitude': 40.01,
+            'longitude': -105.27, 'accuracy': 10}
+
+
+class Endpoint:
+    '''
+    A benchmarked route. build(dataset, rng) returns the (path, JSON body)
+    of one request and may write rows the request needs, untimed, so it
+    runs in an app context.
+    '''
+
+    def __init__(self, name, route, build, method='GET', auth=None):
+        self.name = name
+        self.route = route
+        self.build = build
+        self.method = method
+        # None, 'session' for login pages or 'bearer' for API writes
+        self.auth = auth
+
+
+def endpoints():
+    from seed import WORDS
+
+    def plant(dataset, rng):
+        return rng.choice(dataset.plant_ids)
+
+    def observation(dataset, rng):
+        return rng.choice(dataset.observation_ids)
+
+    def page(path):
+        return lambda dataset, rng: (path, None)
+
+    return [
+        Endpoint('home', '/', page('/')),
+        Endpoint('about', '/about', page('/about')),
+        Endpoint('favicon', '/favicon.ico', page('/favicon.ico')),
+        Endpoint('login', '/login', page('/login')),
+        Endpoint('logout', '/logout', page('/logout'), auth='session'),
+        Endpoint('api key', '/api/key', page('/api/key')),
+        Endpoint('dashboard', '/dashboard', page('/dashboard'),
+                 auth='session'),
+        Endpoint('plants page', '/plants', page('/plants')),
+        Endpoint('plant page', '/plants/<id>', lambda dataset, rng: (
+            f'/plants/{plant(dataset, rng)}', None)),
+        Endpoint('new plant form', '/plants/new', page('/plants/new'),
+                 auth='session'),
+        Endpoint('edit plant form', '/plants/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/plants/{plant(dataset, rng)}/edit', None),
+                 auth='session'),
+        Endpoint('observations page', '/observations',
+                 page('/observations')),
+        Endpoint('new observation form', '/observations/new',
+                 lambda dataset, rng: (
+                     f'/observations/new?plant={plant(dataset, rng)}',
+                     None),
+                 auth='session'),
+        Endpoint('edit observation form', '/observations/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/observations/{observation(dataset, rng)}/edit',
+                     None),
+                 auth='session'),
+        Endpoint('list plants', '/api/plants', page('/api/plants')),
+        Endpoint('stream plants', '/api/plants?stream=true',
+                 page('/api/plants?stream=true&limit=1000')),
+        Endpoint('suggest plants', '/api/plants/suggest',
+                 lambda dataset, rng: (
+                     f'/api/plants/suggest?prefix='
+                     f'{rng.choice(WORDS)[:rng.randint(1, 4)]}', None)),
+        Endpoint('get plant', '/api/plants/<id>', lambda dataset, rng: (
+            f'/api/plants/{plant(dataset, rng)}', None)),
+        Endpoint('create plant', '/api/plants/new',
+                 lambda dataset, rng: ('/api/plants/new', plant_body()),
+                 method='POST', auth='bearer'),
+        Endpoint('edit plant', '/api/plants/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/api/plants/{new_plant(dataset)}/edit',
+                     plant_body()),
+                 method='PATCH', auth='bearer'),
+        Endpoint('delete plant', '/api/plants/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/api/plants/{new_plant(dataset)}/edit', None),
+                 method='DELETE', auth='bearer'),
+        Endpoint('list observations', '/api/observations',
+                 page('/api/observations')),
+        Endpoint('observations in bbox', '/api/observations?bbox=',
+                 page(f'/api/observations?bbox={BBOX}')),
+        Endpoint('observations near', '/api/observations?near=',
+                 page(f'/api/observations?near={NEAR}&radius={RADIUS}')),
+        Endpoint('get observation', '/api/observations/<id>',
+                 lambda dataset, rng: (
+                     f'/api/observations/{observation(dataset, rng)}',
+                     None)),
+        Endpoint('create observation', '/api/observations/new',
+                 lambda dataset, rng: ('/api/observations/new',
+                                       observation_body(dataset, rng)),
+                 method='POST', auth='bearer'),
+        Endpoint('bulk create observations', '/api/observations/bulk',
+                 lambda dataset, rng: (
+                     '/api/observations/bulk',
+                     [observation_body(dataset, rng)
+                      for i in range(BULK_SIZE)]),
+                 method='POST', auth='bearer'),
+        Endpoint('edit observation', '/api/observations/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/api/observations/{new_observation(dataset)}/edit',
+                     {'date': '2019-07-01', 'notes': 'edited'}),
+                 method='PATCH', auth='bearer'),
+        Endpoint('delete observation', '/api/observations/<id>/edit',
+                 lambda dataset, rng: (
+                     f'/api/observations/{new_observation(dataset)}/edit',
+                     None),
+                 method='DELETE', auth='bearer'),
+        Endpoint('plant timeline', '/api/stats/plants/<id>/timeline',
+                 lambda dataset, rng: (
+                     f'/api/stats/plants/{plant(dataset, rng)}/timeline',
+                     None)),
+        Endpoint('search', '/api/search', lambda dataset, rng: (
+            f'/api/search?q={rng.choice(WORDS)}', None)),
+    ]
+
+
+def request_headers(endpoint, dataset, body):
+    headers = {}
+    if endpoint.auth == 'session':
+        headers['Cookie'] = dataset.session_cookie
+    elif endpoint.auth == 'bearer':
+        headers['Authorization'] = f'Bearer {dataset.token}'
+    if body is not None:
+        headers['Content-Type'] = 'application/json'
+
+    return headers
+
+
+def summarize(endpoint, mode, latencies, statuses, queries, seconds):
+    # latencies in seconds, throughput over the wall time of the run
+    latencies = [latency * 1000 for latency in latencies]
+
+    return {
+        'endpoint': endpoint.name,
+        'route': endpoint.route,
+        'method': endpoint.method,
+        'mode': mode,
+        'requests': len(latencies),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items())},
+        'throughput_rps': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+        'queries_per_request': round(queries / len(latencies), 2),
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def run_test_client(app, endpoint, dataset, counter, args, rng):
+    '''
+    Runs an endpoint's requests one at a time through the test client
+    '''
+
+    client = app.test_client(use_cookies=False)
+
+    latencies = []
+    statuses = Counter()
+    queries = 0
+    for i in range(args.warmup + args.requests):
+        with app.app_context():
+            path, body = endpoint.build(dataset, rng)
+        headers = request_headers(endpoint, dataset, body)
+
+        before = counter.count
+        start = time.perf_counter()
+        response = client.open(path, method=endpoint.method,
+                               headers=headers,
+                               data=None if body is None
+                               else json.dumps(body))
+        # streamed responses run their queries while being read
+        response.get_data()
+        elapsed = time.perf_counter() - start
+
+        if i >= args.warmup:
+            latencies.append(elapsed)
+            statuses[response.status_code] += 1
+            queries += counter.count - before
+
+    return summarize(endpoint, 'test_client', latencies, statuses, queries,
+                     sum(latencies))
+
+
+def run_server(app, port, endpoint, dataset, counter, args, rng):
+    '''
+    Runs an endpoint's requests from concurrent clients against the WSGI
+    server
+    '''
+
+    # build requests up front so writes they need aren't timed
+    with app.app_context():
+        requests = [endpoint.build(dataset, rng)
+                    for i in range(args.warmup + args.requests)]
+
+    def send(request):
+        path, body = request
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        try:
+            start = time.perf_counter()
+            connection.request(endpoint.method, path,
+                               body=None if body is None
+                               else json.dumps(body),
+                               headers=request_headers(endpoint, dataset,
+                                                       body))
+            response = connection.getresponse()
+            response.read()
+            return time.perf_counter() - start, response.status
+        finally:
+            connection.close()
+
+    with ThreadPoolExecutor(args.concurrency) as executor:
+        list(executor.map(send, requests[:args.warmup]))
+
+        before = counter.count
+        start = time.perf_counter()
+        results = list(executor.map(send, requests[args.warmup:]))
+        seconds = time.perf_counter() - start
+        queries = counter.count - before
+
+    latencies = [latency for latency, status in results]
+    statuses = Counter(status for latency, status in results)
+
+    return summarize(endpoint, 'server', latencies, statuses, queries,
+                     seconds)
+
+
+def run(args):
+    directory = tempfile.mkdtemp(prefix='plant-survey-benchmark-')
+    jwks_url, pem = write_jwks(directory)
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    configure_environment(database_url, jwks_url, args.cache)
+
+    # import after configuring, the app reads settings at import time
+    from sqlalchemy import event
+    from werkzeug.serving import make_server
+    from app import create_app
+    from models import db
+
+    app = create_app()
+    modes = args.modes.split(',')
+    selected = [endpoint for endpoint in endpoints()
+                if not args.endpoints
+                or any(name in endpoint.name
+                       for name in args.endpoints.split(','))]
+
+    # requests push their own app context, so each gets a fresh session
+    with app.app_context():
+        dataset = prepare_dataset(app, args, pem)
+        counter = QueryCounter()
+        event.listen(db.engine, 'before_cursor_execute', counter)
+
+    results = []
+    rng = random.Random(args.seed)
+
+    if 'test_client' in modes:
+        for endpoint in selected:
+            results.append(run_test_client(app, endpoint, dataset, counter,
+                                           args, rng))
+            print_result(results[-1])
+
+    if 'server' in modes:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            for endpoint in selected:
+                results.append(run_server(app, server.server_address[1],
+                                          endpoint, dataset, counter, args,
+                                          rng))
+                print_result(results[-1])
+        finally:
+            server.shutdown()
+
+    commit, dirty = git_commit()
+    report = {
+        'commit': commit,
+        'dirty': dirty,
+        'created': datetime.utcnow().isoformat() + 'Z',
+        'python': sys.version.split()[0],
+        'database': database_url.split(':', 1)[0],
+        'dataset': {'users': args.users, 'plants': args.plants,
+                    'observations': args.observations, 'seed': args.seed},
+        'settings': {'requests': args.requests, 'warmup': args.warmup,
+                     'concurrency': args.concurrency, 'cache': args.cache},
+        'skipped': SKIPPED,
+        'results': results,
+    }
+
+    output = args.output or f'benchmark-{(commit or "unknown")[:12]}.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'saved {output}', file=sys.stderr)
+
+    # numbers of endpoints answering with errors time the error path
+    failed = [result for result in results if error_statuses(result)]
+    if failed:
+        sys.exit(f'{len(failed)} endpoint runs answered with error '
+                 f'statuses, their numbers don\'t measure the route')
+
+
+def error_statuses(result):
+    # 4xx and 5xx responses, 2xx and 3xx are expected
+    return {status: count for status, count in result['statuses'].items()
+            if int(status) >= 400}
+
+
+def print_result(result):
+    print(f'{result["mode"]:<12} {result["method"]:<7} '
+          f'{result["endpoint"]:<26} {result["throughput_rps"]:>9.1f}/s '
+          f'p50 {result["p50_ms"]:>8.2f}ms p95 {result["p95_ms"]:>8.2f}ms '
+          f'p99 {result["p99_ms"]:>8.2f}ms '
+          f'{result["queries_per_request"]:>6.1f} queries '
+          f'{result["peak_rss_kb"] // 1024:>5} MB')
+
+    errors = error_statuses(result)
+    if errors:
+        print(f'WARNING: {result["endpoint"]} answered with statuses '
+              f'{errors}', file=sys.stderr)
+
+
+def compare(before_path, after_path):
+    '''
+    Prints the change in latency, throughput and queries per endpoint
+    between two saved runs
+    '''
+
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+
+    def key(result):
+        return result['mode'], result['method'], result['endpoint']
+
+    previous = {key(result): result for result in before['results']}
+
+    def change(old, new):
+        if not old:
+            return '     n/a'
+        return f'{(new - old) / old * 100:>+7.1f}%'
+
+    print(f'{(before["commit"] or "unknown")[:12]} -> '
+          f'{(after["commit"] or "unknown")[:12]}')
+    print(f'{"mode":<12} {"method":<7} {"endpoint":<26} {"p50":>8} '
+          f'{"p99":>8} {"rps":>8} {"queries":>8}')
+    for result in after['results']:
+        old = previous.get(key(result))
+        if old is None:
+            continue
+        changes = [change(old[name], result[name])
+                   for name in ('p50_ms', 'p99_ms', 'throughput_rps',
+                                'queries_per_request')]
+        print(f'{result["mode"]:<12} {result["method"]:<7} '
+              f'{result["endpoint"]:<26} ' + ' '.join(changes))
+
+
+def main():
+    if sys.argv[1:2] == ['compare']:
+        parser = argparse.ArgumentParser(
+            prog='python -m benchmarks.endpoints compare',
+            description='Compares two saved endpoint benchmark runs')
+        parser.add_argument('before')
+        parser.add_argument('after')
+        args = parser.parse_args(sys.argv[2:])
+        compare(args.before, args.after)
+        return
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks every route against a seeded dataset')
+    parser.add_argument('--database-url',
+                        help='database to seed and use, defaults to a '
+                             'temporary SQLite file')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--plants', type=int, default=1000)
+    parser.add_argument('--observations', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200,
+                        help='timed requests per endpoint and mode')
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='untimed requests before each endpoint')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='concurrent clients against the server')
+    parser.add_argument('--modes', default='test_client,server',
+                        help='comma separated: test_client, server')
+    parser.add_argument('--endpoints',
+                        help='comma separated endpoint name filters')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='disable the read-through cache')
+    parser.add_argument('--output', help='JSON report path')
+    args = parser.parse_args()
+
+    if args.users < 1 or args.plants < 1 or args.observations < 1:
+        parser.error('the dataset needs at least one row of each kind')
+
+    run(args)
+
+
+if __name__ == '__main__':
+    main()
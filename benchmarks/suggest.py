@@ -0,0 +1,95 @@
+import argparse
+import random
+import time
+from suggest import SuggestIndex
+
+
+'''
+Plant Suggestion Benchmark
+
+Measures lookup and incremental update latency of the plant name prefix
+index as the catalog grows. Doesn't need a database.
+
+Run from the repository root:
+    python -m benchmarks.suggest
+'''
+
+
+SYLLABLES = ['al', 'be', 'ca', 'do', 'er', 'fi', 'go', 'ha', 'in', 'ju',
+             'ka', 'lo', 'mi', 'nu', 'or', 'pe', 'qu', 'ri', 'sa', 'tu']
+
+
+def random_word(rng):
+    return ''.join(rng.choice(SYLLABLES) for i in range(rng.randint(2, 5)))
+
+
+def random_plant(rng):
+    name = ' '.join(random_word(rng) for i in range(rng.randint(1, 3)))
+    latin_name = random_word(rng).capitalize() + ' ' + random_word(rng)
+    return name, latin_name
+
+
+def percentile(samples, fraction):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+def run(size, queries, rng):
+    # build index of size plants
+    rows = [(id,) + random_plant(rng) for id in range(1, size + 1)]
+    start = time.perf_counter()
+    index = SuggestIndex()
+    index.rebuild(rows, version=0)
+    rebuild_seconds = time.perf_counter() - start
+
+    # look up 1 to 4 character prefixes of random names
+    lookups = []
+    for i in range(queries):
+        id, name, latin_name = rng.choice(rows)
+        prefix = rng.choice([name, latin_name])[:rng.randint(1, 4)]
+        start = time.perf_counter_ns()
+        index.suggest(prefix)
+        lookups.append(time.perf_counter_ns() - start)
+
+    # replace names of random plants
+    updates = []
+    for version in range(1, queries // 10 + 1):
+        id = rng.randint(1, size)
+        name, latin_name = random_plant(rng)
+        start = time.perf_counter_ns()
+        index.update(id, name, latin_name, version)
+        updates.append(time.perf_counter_ns() - start)
+
+    return {
+        'size': size,
+        'rebuild_ms': rebuild_seconds * 1000,
+        'lookup_p50_us': percentile(lookups, 0.50) / 1000,
+        'lookup_p99_us': percentile(lookups, 0.99) / 1000,
+        'update_p99_us': percentile(updates, 0.99) / 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the plant name suggestion index')
+    parser.add_argument('--sizes', default='1000,10000,100000',
+                        help='comma separated catalog sizes')
+    parser.add_argument('--queries', type=int, default=20000,
+                        help='lookups per catalog size')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+
+    print(f'{"plants":>8} {"rebuild ms":>11} {"lookup p50 us":>14} '
+          f'{"lookup p99 us":>14} {"update p99 us":>14}')
+    for size in [int(size) for size in args.sizes.split(',')]:
+        result = run(size, args.queries, rng)
+        print(f'{result["size"]:>8} {result["rebuild_ms"]:>11.1f} '
+              f'{result["lookup_p50_us"]:>14.1f} '
+              f'{result["lookup_p99_us"]:>14.1f} '
+              f'{result["update_p99_us"]:>14.1f}')
+
+
+if __name__ == '__main__':
+    main()
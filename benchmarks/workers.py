@@ -0,0 +1,242 @@
+import argparse
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.client import HTTPConnection
+from benchmarks.endpoints import configure_environment, write_jwks
+from benchmarks.suggest import percentile
+
+
+'''
+Worker Model Benchmark
+
+Starts gunicorn with each worker model (sync, gthread and, if installed,
+gevent) using gunicorn.conf.py, and measures throughput and latency of a
+mix of read requests from concurrent clients. The database is seeded as
+for the endpoint benchmark. Use Postgres for meaningful numbers, SQLite
+serializes writers and has no connection pool.
+
+Run from the repository root:
+    python -m benchmarks.workers --database-url postgresql:///bench \\
+        --workers 4 --concurrency 64
+'''
+
+
+def worker_models(args):
+    # (name, gunicorn arguments) of each worker model
+    models = [
+        ('sync', ['--worker-class', 'sync', '--threads', '1']),
+        ('gthread', ['--worker-class', 'gthread',
+                     '--threads', str(args.threads)]),
+    ]
+
+    try:
+        import gevent  # noqa: F401
+    except ImportError:
+        print('gevent is not installed, skipping the gevent worker',
+              file=sys.stderr)
+    else:
+        models.append(('gevent', ['--worker-class', 'gevent',
+                                  '--worker-connections',
+                                  str(args.worker_connections)]))
+
+    return [(name, arguments) for name, arguments in models
+            if not args.models or name in args.models.split(',')]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_serving(port, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('gunicorn exited while starting')
+        try:
+            connection = HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/about')
+            connection.getresponse().read()
+            connection.close()
+            return
+        except OSError:
+            time.sleep(0.2)
+
+    raise RuntimeError('gunicorn did not start')
+
+
+def request_paths(plant_ids, rng, count):
+    # mix of read requests, weighted like browsing traffic
+    paths = []
+    for i in range(count):
+        plant_id = rng.choice(plant_ids)
+        paths.append(rng.choices([
+            '/api/plants',
+            f'/api/plants/{plant_id}',
+            '/api/observations',
+            '/api/observations?bbox=-105.4,39.9,-105.1,40.1',
+            f'/api/stats/plants/{plant_id}/timeline',
+            f'/api/search?q={rng.choice(["sage", "lily", "pine"])}',
+            '/plants',
+        ], weights=[3, 4, 3, 1, 1, 1, 2])[0])
+
+    return paths
+
+
+def load(port, paths, concurrency, duration):
+    '''
+    Sends requests from concurrent clients for duration seconds, and
+    returns (latencies, statuses, seconds)
+    '''
+
+    latencies = []
+    statuses = Counter()
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+
+    def client(offset):
+        # keep-alive connection per client, reconnecting if closed
+        connection = HTTPConnection('127.0.0.1', port, timeout=60)
+        i = offset
+        while time.perf_counter() < deadline:
+            path = paths[i % len(paths)]
+            i += concurrency
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                status = response.status
+            except OSError:
+                connection.close()
+                connection = HTTPConnection('127.0.0.1', port, timeout=60)
+                status = 'error'
+            elapsed = time.perf_counter() - start
+
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] += 1
+        connection.close()
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=client, args=(offset,))
+               for offset in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+
+    return latencies, statuses, time.perf_counter() - start
+
+
+def run_model(name, arguments, paths, args):
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '--config', 'gunicorn.conf.py',
+         '--bind', f'127.0.0.1:{port}', '--workers', str(args.workers),
+         '--log-level', 'warning'] + arguments + ['app:app'])
+    try:
+        wait_until_serving(port, process)
+
+        # warm caches and pools, then measure
+        load(port, paths, args.concurrency, args.warmup)
+        latencies, statuses, seconds = load(port, paths, args.concurrency,
+                                            args.duration)
+    finally:
+        process.terminate()
+        process.wait()
+
+    latencies = [latency * 1000 for latency in latencies]
+    return {
+        'model': name,
+        'workers': args.workers,
+        'arguments': arguments,
+        'concurrency': args.concurrency,
+        'requests': len(latencies),
+        'statuses': {str(status): count
+                     for status, count in sorted(statuses.items(),
+                                                 key=str)},
+        'throughput_rps': round(len(latencies) / seconds, 1),
+        'p50_ms': round(percentile(latencies, 0.50), 3),
+        'p95_ms': round(percentile(latencies, 0.95), 3),
+        'p99_ms': round(percentile(latencies, 0.99), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compares gunicorn worker models under load')
+    parser.add_argument('--database-url',
+                        help='database to seed and use, defaults to a '
+                             'temporary SQLite file')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--plants', type=int, default=1000)
+    parser.add_argument('--observations', type=int, default=10000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--models',
+                        help='comma separated: sync, gthread, gevent')
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int,
+                        default=int(os.getenv('DB_POOL_SIZE', 5)),
+                        help='threads per gthread worker')
+    parser.add_argument('--worker-connections', type=int, default=15,
+                        help='greenlets per gevent worker')
+    parser.add_argument('--concurrency', type=int, default=32,
+                        help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=20,
+                        help='seconds of load per worker model')
+    parser.add_argument('--warmup', type=float, default=3)
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help='disable the read-through cache')
+    parser.add_argument('--output', help='JSON report path')
+    args = parser.parse_args()
+
+    # gunicorn workers inherit the environment
+    directory = tempfile.mkdtemp(prefix='plant-survey-benchmark-')
+    jwks_url, pem = write_jwks(directory)
+    database_url = args.database_url or \
+        'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    configure_environment(database_url, jwks_url, args.cache)
+
+    # seed once before starting servers
+    from app import create_app
+    from benchmarks.endpoints import prepare_dataset
+
+    app = create_app()
+    with app.app_context():
+        dataset = prepare_dataset(app, args, pem)
+
+    paths = request_paths(dataset.plant_ids, random.Random(args.seed), 1000)
+
+    results = []
+    for name, arguments in worker_models(args):
+        result = run_model(name, arguments, paths, args)
+        results.append(result)
+        print(f'{name:<8} {result["throughput_rps"]:>9.1f}/s '
+              f'p50 {result["p50_ms"]:>8.2f}ms p95 {result["p95_ms"]:>8.2f}ms '
+              f'p99 {result["p99_ms"]:>8.2f}ms {result["statuses"]}')
+
+    report = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'database': database_url.split(':', 1)[0],
+        'pool': {'size': int(os.getenv('DB_POOL_SIZE', 5)),
+                 'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10))},
+        'results': results,
+    }
+    output = args.output or 'benchmark-workers.json'
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'saved {output}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
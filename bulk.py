@@ -0,0 +1,96 @@
+import io
+from datetime import datetime
+from sqlalchemy import text
+
+
+'''
+Bulk Writes
+
+Set-based inserts that run inside the caller's transaction. On Postgres,
+ids are reserved from the table's sequence in one query and rows are
+written with COPY, which is much faster than one INSERT per row.
+'''
+
+
+# NULL marker used in COPY data, strings are always quoted so they can't
+# be mistaken for it
+COPY_NULL = r'\N'
+
+
+def is_postgres(session):
+    return session.get_bind().dialect.name == 'postgresql'
+
+
+def allocate_ids(session, table, count):
+    '''
+    Reserves count ids from the id sequence of table in one query
+    '''
+
+    result = session.execute(
+        text("SELECT nextval(pg_get_serial_sequence(:table, 'id')) "
+             "FROM generate_series(1, :count)"),
+        {'table': f'"{table.name}"', 'count': count})
+
+    return [row[0] for row in result]
+
+
+def format_copy_value(value):
+    # format a value as a COPY csv field
+    if value is None:
+        return COPY_NULL
+    if isinstance(value, str):
+        return '"' + value.replace('"', '""') + '"'
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    return str(value)
+
+
+def copy_rows(session, table, columns, rows):
+    '''
+    copy_rows(session, table, columns, rows)
+    writes rows (sequences of values in column order) to table with
+    COPY ... FROM STDIN on the session's connection
+    '''
+
+    data = io.StringIO()
+    for row in rows:
+        data.write(','.join(format_copy_value(value) for value in row))
+        data.write('\n')
+    data.seek(0)
+
+    column_list = ', '.join(f'"{column}"' for column in columns)
+    sql = (f'COPY "{table.name}" ({column_list}) FROM STDIN '
+           f"WITH (FORMAT csv, NULL '{COPY_NULL}')")
+
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.copy_expert(sql, data)
+    finally:
+        cursor.close()
+
+
+def insert_rows(session, table, columns, rows):
+    '''
+    insert_rows(session, table, columns, rows)
+    inserts rows (sequences of values in column order, without id) in the
+    session's transaction and returns their new ids in row order
+    '''
+
+    if not rows:
+        return []
+
+    # reserve ids and COPY rows with them
+    if is_postgres(session):
+        ids = allocate_ids(session, table, len(rows))
+        copy_rows(session, table, ['id'] + list(columns),
+                  [[id] + list(row) for id, row in zip(ids, rows)])
+        return ids
+
+    # other databases insert row by row to learn the ids
+    ids = []
+    for row in rows:
+        result = session.execute(table.insert().values(
+            dict(zip(columns, row))))
+        ids.append(result.inserted_primary_key[0])
+
+    return ids
@@ -0,0 +1,263 @@
+import asyncio
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from functools import partial, wraps
+from versions import version_store
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+'''
+Read-through Cache
+
+Caches service results in a process-local LRU, optionally backed by a
+shared backend (Redis). Cache keys embed the version counters the result
+depends on, so the model insert/update/delete methods invalidate exactly
+the entries they affect by bumping those counters. Entries that can no
+longer be reached age out of the LRU.
+'''
+
+
+# sentinel for cache misses, since None is a valid cached result
+MISSING = object()
+
+
+class LRUCacheBackend:
+    '''
+    In-process LRU bounded by number of entries
+    '''
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is not MISSING:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+
+            # evict least recently used entries
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class RedisCacheBackend:
+    '''
+    Shared backend storing pickled values in Redis with a TTL, so
+    unreachable entries expire on their own
+    '''
+
+    def __init__(self, client, ttl=3600, prefix='cache:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        data = self.client.get(self.prefix + key)
+        if data is None:
+            return MISSING
+        return pickle.loads(data)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=self.ttl)
+
+    def clear(self):
+        for key in self.client.scan_iter(self.prefix + '*'):
+            self.client.delete(key)
+
+
+class ReadThroughCache:
+    '''
+    Looks up values in the local LRU, then the shared backend if any,
+    and computes and stores them on a miss
+    '''
+
+    def __init__(self, local=None, shared=None):
+        self.local = local if local is not None else LRUCacheBackend()
+        self.shared = shared
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_or_set(self, key, compute):
+        value = self.lookup(key)
+        if value is MISSING:
+            value = compute()
+            self.store(key, value)
+
+        return value
+
+    def lookup(self, key):
+        '''
+        Returns the cached value of key, or MISSING
+        '''
+
+        value = self.local.get(key)
+
+        # fall back to shared backend and keep a local copy
+        if value is MISSING and self.shared is not None:
+            value = self.shared.get(key)
+            if value is not MISSING:
+                self.local.set(key, value)
+
+        self._count(hit=value is not MISSING)
+        return value
+
+    def store(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            self.shared.set(key, value)
+
+    async def lookup_async(self, key):
+        '''
+        Returns the cached value of key, or MISSING, from a coroutine. The
+        shared backend is read in the event loop's default executor.
+        '''
+
+        value = self.local.get(key)
+
+        # fall back to shared backend and keep a local copy
+        if value is MISSING and self.shared is not None:
+            value = await run_blocking(self.shared.get, key)
+            if value is not MISSING:
+                self.local.set(key, value)
+
+        self._count(hit=value is not MISSING)
+        return value
+
+    async def store_async(self, key, value):
+        self.local.set(key, value)
+        if self.shared is not None:
+            await run_blocking(self.shared.set, key, value)
+
+    def clear(self):
+        self.local.clear()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def stats(self):
+        '''
+        Returns hit/miss counters, hit ratio and local size
+        '''
+
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_ratio': self.hits / total if total else 0.0,
+            'size': len(self.local),
+            'max_entries': self.local.max_entries
+        }
+
+    def _count(self, hit):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+
+def create_cache():
+    '''
+    Creates the process-wide cache. CACHE_MAX_ENTRIES bounds the local
+    LRU, and REDIS_URL adds Redis as a shared backend if redis is
+    installed.
+    '''
+
+    local = LRUCacheBackend(int(os.getenv('CACHE_MAX_ENTRIES', 1024)))
+
+    shared = None
+    redis_url = os.getenv('REDIS_URL')
+    if redis_url and redis is not None:
+        shared = RedisCacheBackend(redis.Redis.from_url(redis_url))
+
+    return ReadThroughCache(local, shared)
+
+
+# process-wide read-through cache
+read_cache = create_cache()
+
+
+def run_blocking(f, *args):
+    # runs a call that may wait on I/O off the event loop
+    return asyncio.get_running_loop().run_in_executor(None, partial(f, *args))
+
+
+def call_key(f, get_keys, args, kwargs):
+    # key changes whenever a dependency's version is bumped
+    call = repr((f.__module__, f.__name__, args, sorted(kwargs.items())))
+    return version_store.etag(call, *get_keys(*args, **kwargs))
+
+
+async def call_key_async(f, get_keys, args, kwargs):
+    # call_key without blocking the event loop on the version backend
+    call = repr((f.__module__, f.__name__, args, sorted(kwargs.items())))
+    return await version_store.etag_async(call, *get_keys(*args, **kwargs))
+
+
+def cached(get_keys):
+    '''
+    cached(get_keys)
+    caches the results of a service function. get_keys is called with the
+    function's arguments and returns the version keys the result depends
+    on.
+    '''
+
+    def decorator(f):
+        @wraps(f)
+        def wrap(*args, **kwargs):
+
+            # caching disabled
+            if read_cache.local.max_entries <= 0:
+                return f(*args, **kwargs)
+
+            key = call_key(f, get_keys, args, kwargs)
+            return read_cache.get_or_set(key, lambda: f(*args, **kwargs))
+        return wrap
+    return decorator
+
+
+def cached_async(get_keys):
+    '''
+    cached_async(get_keys)
+    caches the results of a coroutine function like cached, without
+    blocking the event loop on Redis or the shared counters file
+    '''
+
+    def decorator(f):
+        @wraps(f)
+        async def wrap(*args, **kwargs):
+
+            # caching disabled
+            if read_cache.local.max_entries <= 0:
+                return await f(*args, **kwargs)
+
+            key = await call_key_async(f, get_keys, args, kwargs)
+            value = await read_cache.lookup_async(key)
+            if value is MISSING:
+                value = await f(*args, **kwargs)
+                await read_cache.store_async(key, value)
+
+            return value
+        return wrap
+    return decorator
@@ -0,0 +1,244 @@
+import math
+from sqlalchemy import text
+
+
+'''
+Observation Locations
+
+Observations may have a latitude and longitude (WGS 84 degrees) and the
+accuracy of the fix in meters. Each located observation also stores its
+geohash, a string where nearby points share a prefix. An area query is
+turned into a few geohash prefixes covering the area, each prefix is one
+B-tree range scan, and the exact bounds are checked on the rows found.
+
+On Postgres with PostGIS installed, a GiST index over the location is
+used instead.
+'''
+
+
+# geohash alphabet, in ascending ASCII order
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+
+# stored geohash length, a cell of about 4 x 2 cm
+GEOHASH_PRECISION = 12
+
+# most geohash cells used to cover a query area
+MAX_COVER_CELLS = 32
+
+# sorts after every geohash character, so prefix + END_OF_PREFIX bounds
+# all geohashes starting with prefix
+END_OF_PREFIX = '~'
+
+# meters per degree of latitude
+METERS_PER_DEGREE = 111320.0
+
+# largest radius of near queries in meters
+MAX_RADIUS = 100000.0
+
+# location expression of the PostGIS GiST index, queries must use it as is
+POSTGIS_LOCATION = ('(ST_SetSRID(ST_MakePoint("Observations".longitude, '
+                    '"Observations".latitude), 4326)::geography)')
+
+
+# bits of latitude and of longitude in a full length geohash
+CELL_BITS = 5 * GEOHASH_PRECISION // 2
+
+# geohash character pairs by 10 bit value
+BASE32_PAIRS = [first + second for first in BASE32 for second in BASE32]
+
+
+def spread_bits(value):
+    # bits of an 8 bit value moved to the even bits of a 16 bit value
+    spread = 0
+    for bit in range(8):
+        spread |= ((value >> bit) & 1) << (2 * bit)
+    return spread
+
+
+SPREAD_BITS = [spread_bits(value) for value in range(256)]
+
+
+def quantize(value, low, span):
+    # index of the cell containing value when low to low + span is split
+    # into 2 ** CELL_BITS cells, computed exactly from the float's ratio
+    numerator, denominator = value.as_integer_ratio()
+    cell = ((numerator - low * denominator) << CELL_BITS) \
+        // (span * denominator)
+    return min(cell, (1 << CELL_BITS) - 1)
+
+
+def interleave(cell):
+    # spread the CELL_BITS bits of cell over every other bit
+    return (SPREAD_BITS[cell & 255] | SPREAD_BITS[(cell >> 8) & 255] << 16
+            | SPREAD_BITS[(cell >> 16) & 255] << 32
+            | SPREAD_BITS[cell >> 24] << 48)
+
+
+def encode(latitude, longitude, precision=GEOHASH_PRECISION):
+    '''
+    Returns the geohash of a point, up to GEOHASH_PRECISION characters
+    '''
+
+    # bits alternate between longitude and latitude, longitude first
+    code = interleave(quantize(longitude, -180, 360)) << 1 \
+        | interleave(quantize(latitude, -90, 180))
+
+    geohash = (BASE32_PAIRS[code >> 50] + BASE32_PAIRS[(code >> 40) & 1023]
+               + BASE32_PAIRS[(code >> 30) & 1023]
+               + BASE32_PAIRS[(code >> 20) & 1023]
+               + BASE32_PAIRS[(code >> 10) & 1023]
+               + BASE32_PAIRS[code & 1023])
+
+    return geohash[:precision]
+
+
+def cell_counts(precision):
+    # number of geohash cells of a precision along latitude and longitude
+    return 2 ** (5 * precision // 2), 2 ** ((5 * precision + 1) // 2)
+
+
+def cell_indexes(low, high, origin, size, count):
+    # indexes of the cells of a given size overlapping low to high
+    first = int((low - origin) // size)
+    last = min(int((high - origin) // size), count - 1)
+    return range(first, last + 1)
+
+
+def cover(south, west, north, east, max_cells=MAX_COVER_CELLS):
+    '''
+    Returns geohash prefixes of the cells covering a bounding box, using
+    the longest prefixes that need at most max_cells cells
+    '''
+
+    prefixes = ['']
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        rows, columns = cell_counts(precision)
+        height, width = 180.0 / rows, 360.0 / columns
+
+        latitudes = cell_indexes(south, north, -90.0, height, rows)
+        longitudes = cell_indexes(west, east, -180.0, width, columns)
+        if len(latitudes) * len(longitudes) > max_cells:
+            break
+
+        # geohash of the center of each overlapped cell
+        prefixes = sorted(
+            encode(-90.0 + (row + 0.5) * height,
+                   -180.0 + (column + 0.5) * width, precision)
+            for row in latitudes for column in longitudes)
+
+    return prefixes
+
+
+def validate_location(latitude, longitude, accuracy=None):
+    '''
+    Validates an optional location, given as numbers or number strings.
+    Returns (latitude, longitude, accuracy) as floats or Nones, raises
+    ValueError if out of range or only one coordinate is given.
+    '''
+
+    if latitude is None and longitude is None:
+        if accuracy is not None:
+            raise ValueError('accuracy without location')
+        return None, None, None
+
+    if latitude is None or longitude is None:
+        raise ValueError('latitude and longitude must be given together')
+
+    latitude, longitude = parse_number(latitude), parse_number(longitude)
+    if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+        raise ValueError('location out of range')
+
+    if accuracy is not None:
+        accuracy = parse_number(accuracy)
+        if accuracy < 0:
+            raise ValueError('accuracy must not be negative')
+
+    return latitude, longitude, accuracy
+
+
+def parse_number(value):
+    # booleans are ints in Python but not numbers in JSON
+    if isinstance(value, bool):
+        raise ValueError('not a number')
+
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError('not a number')
+
+    return number
+
+
+def parse_bbox(value):
+    '''
+    Parses a bbox parameter, 'west,south,east,north' in degrees, into
+    (south, west, north, east). Raises ValueError if malformed.
+    '''
+
+    parts = value.split(',')
+    if len(parts) != 4:
+        raise ValueError('malformed bbox')
+
+    west, south, east, north = [parse_number(part) for part in parts]
+    if not -90 <= south <= north <= 90:
+        raise ValueError('malformed bbox')
+    if not -180 <= west <= east <= 180:
+        # boxes crossing the antimeridian aren't supported
+        raise ValueError('malformed bbox')
+
+    return south, west, north, east
+
+
+def parse_near(value, radius):
+    '''
+    Parses near ('latitude,longitude') and radius (meters) parameters into
+    (latitude, longitude, radius). Raises ValueError if malformed.
+    '''
+
+    parts = value.split(',')
+    if len(parts) != 2 or radius is None:
+        raise ValueError('malformed near')
+
+    latitude, longitude, accuracy = validate_location(*parts)
+    radius = parse_number(radius)
+    if not 0 < radius <= MAX_RADIUS:
+        raise ValueError('radius out of range')
+
+    return latitude, longitude, radius
+
+
+def near_bbox(latitude, longitude, radius):
+    '''
+    Returns the (south, west, north, east) box around a circle, clamped to
+    valid coordinates
+    '''
+
+    height = radius / METERS_PER_DEGREE
+    width = height / max(math.cos(math.radians(latitude)), 0.01)
+
+    return (max(latitude - height, -90.0), max(longitude - width, -180.0),
+            min(latitude + height, 90.0), min(longitude + width, 180.0))
+
+
+# PostGIS availability by database URL
+postgis_installed = {}
+
+# returns a row if PostGIS is installed
+POSTGIS_INSTALLED = "SELECT 1 FROM pg_extension WHERE extname = 'postgis'"
+
+
+def has_postgis(session):
+    '''
+    Returns True if the session's database is Postgres with PostGIS
+    installed. Checked once per database.
+    '''
+
+    bind = session.get_bind()
+    if bind.dialect.name != 'postgresql':
+        return False
+
+    url = str(bind.url)
+    if url not in postgis_installed:
+        postgis_installed[url] = session.execute(
+            text(POSTGIS_INSTALLED)).scalar() is not None
+
+    return postgis_installed[url]
@@ -0,0 +1,121 @@
+import glob
+import multiprocessing
+import os
+import tempfile
+
+
+'''
+Gunicorn Configuration
+
+Sizes the workers against the database pool set with DB_POOL_SIZE and
+DB_MAX_OVERFLOW (see models.engine_options). Each worker process has its
+own pool, so the database sees up to
+workers * (DB_POOL_SIZE + DB_MAX_OVERFLOW) connections.
+
+GUNICORN_WORKER_CLASS picks the worker model:
+
+* gthread (default): GUNICORN_THREADS threads per worker, one pool
+  connection each, so requests don't wait for a connection
+* gevent: greenlets instead of threads, for many slow clients or Auth0
+  calls. Needs the gevent and psycogreen packages.
+* sync: one request at a time per worker
+
+Compare them on your data with python -m benchmarks.workers.
+
+Workers share version counters and metrics through files under the temp
+directory unless VERSION_COUNTERS_PATH, METRICS_DIR or REDIS_URL are set,
+so a write in one worker invalidates the caches and ETags of the others
+and /metrics sums every worker.
+'''
+
+
+def env_int(name, default):
+    return int(os.getenv(name, default))
+
+
+pool_size = env_int('DB_POOL_SIZE', 5)
+max_overflow = env_int('DB_MAX_OVERFLOW', 10)
+
+bind = '0.0.0.0:' + os.getenv('PORT', '8000')
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+
+# Heroku sets WEB_CONCURRENCY from the dyno size
+workers = env_int('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1)
+
+# share version counters and metrics between workers, set before the app
+# is imported so every worker inherits them
+shared_dir = os.path.join(tempfile.gettempdir(),
+                          'plant-survey-' + bind.rsplit(':', 1)[-1])
+if not os.getenv('REDIS_URL'):
+    os.makedirs(shared_dir, exist_ok=True)
+    os.environ.setdefault('VERSION_COUNTERS_PATH',
+                          os.path.join(shared_dir, 'versions'))
+os.environ.setdefault('METRICS_DIR', os.path.join(shared_dir, 'metrics'))
+
+# a thread holds at most one connection, overflow covers streamed
+# responses finishing while the next request starts
+threads = env_int('GUNICORN_THREADS', pool_size)
+
+# concurrent greenlets per gevent worker, beyond the pool they'd queue for
+# a connection
+worker_connections = env_int('GUNICORN_WORKER_CONNECTIONS',
+                             pool_size + max_overflow)
+
+# longer than the database statement timeout, so slow queries fail before
+# their worker is killed
+timeout = env_int('GUNICORN_TIMEOUT', 30)
+graceful_timeout = env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = env_int('GUNICORN_KEEPALIVE', 5)
+
+# restart workers after this many requests to cap slow leaks, 0 never
+max_requests = env_int('GUNICORN_MAX_REQUESTS', 0)
+max_requests_jitter = env_int('GUNICORN_MAX_REQUESTS_JITTER', 0)
+
+# import the app before forking, sharing memory between workers
+preload_app = os.getenv('GUNICORN_PRELOAD', '').lower() in ('1', 'true')
+
+
+def on_starting(server):
+    # settings given on the command line override the ones above
+    cfg = server.cfg
+
+    # warn if every pool filling up would pass the database's limit
+    limit = os.getenv('DB_MAX_CONNECTIONS')
+    concurrency = {'gthread': cfg.threads,
+                   'gevent': cfg.worker_connections}.get(
+                       cfg.worker_class_str, 1)
+    connections = cfg.workers * min(pool_size + max_overflow, concurrency)
+    if limit and connections > int(limit):
+        server.log.warning(
+            f'{cfg.workers} workers may open {connections} database '
+            f'connections, over DB_MAX_CONNECTIONS={limit}')
+
+    # per-process counters would serve stale reads and ETags
+    if cfg.workers > 1 and not os.getenv('REDIS_URL') and \
+            not os.getenv('VERSION_COUNTERS_PATH'):
+        server.log.warning(
+            f'{cfg.workers} workers keep separate version counters, set '
+            'VERSION_COUNTERS_PATH or REDIS_URL')
+
+    # metrics of the previous run's workers would be summed in
+    metrics_dir = os.getenv('METRICS_DIR')
+    if metrics_dir:
+        for path in glob.glob(os.path.join(metrics_dir, 'worker-*.json')):
+            os.remove(path)
+
+
+def post_fork(server, worker):
+    # psycopg2 blocks the event loop unless patched to yield to gevent
+    if server.cfg.worker_class_str == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+        except ImportError:
+            server.log.warning('psycogreen is not installed, database '
+                               'calls will block gevent workers')
+        else:
+            patch_psycopg()
+
+    # connections opened before the fork can't be shared with the master
+    if server.cfg.preload_app:
+        from models import db
+        db.engine.dispose()
@@ -1,8 +1,19 @@
+import os
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 
+# maintenance commands like reindex, rollups and explain --analyze run
+# statements over every row, don't cancel them at the request timeout
+os.environ['DB_STATEMENT_TIMEOUT'] = '0'
+
 from app import app
-from models import db
+from models import (db, Plant, Observation, User, plants_query,
+                    observations_query, rebuild_rollups)
+from services import PLANT_KEY, OBSERVATION_KEY, filter_area
+from pagination import DEFAULT_LIMIT, order_by_key
+from search import rebuild_index
+from seed import CHUNK_SIZE, seed_database
+from versions import version_store, row_key
 
 migrate = Migrate(app, db)
 manager = Manager(app)
@@ -10,5 +21,89 @@ manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
 
+def hot_queries():
+    '''
+    Returns (name, query) pairs for the queries behind the busiest routes
+    '''
+
+    # sample ids, any value exercises the same plan
+    plant = db.session.query(Plant.id, Plant.user_id).first()
+    plant_id, user_id = plant if plant is not None else (1, 1)
+    sub = db.session.query(User.user_id).scalar() or 'auth0|sample'
+
+    return [
+        ('plants page', order_by_key(plants_query(), PLANT_KEY)
+         .limit(DEFAULT_LIMIT + 1)),
+        ('observations page', order_by_key(
+            observations_query(), OBSERVATION_KEY, descending=True)
+         .limit(DEFAULT_LIMIT + 1)),
+        ('observations in area', order_by_key(
+            filter_area(observations_query(),
+                        ('bbox', 39.9, -105.3, 40.1, -105.1)),
+            OBSERVATION_KEY, descending=True).limit(DEFAULT_LIMIT + 1)),
+        ('observations of plant', Observation.query
+         .filter_by(plant_id=plant_id).order_by(Observation.date)),
+        ('observations of user', Observation.query.filter_by(user_id=user_id)),
+        ('plants of user', Plant.query.filter_by(user_id=user_id)),
+        ('user by auth0 subject', User.query.filter_by(user_id=sub)),
+    ]
+
+
+@manager.command
+def explain(analyze=False):
+    '''Prints EXPLAIN plans of the hot queries to confirm index usage'''
+
+    # small tables are often cheaper to scan, so check plans on real data
+    prefix = 'EXPLAIN ANALYZE ' if analyze else 'EXPLAIN '
+
+    for name, query in hot_queries():
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+
+        print(f'-- {name}')
+        for row in db.engine.execute(prefix + str(compiled), compiled.params):
+            print(row[0])
+        print()
+
+
+@manager.command
+def reindex():
+    '''Rebuilds the full-text search index'''
+
+    rebuild_index(db.session)
+
+
+@manager.command
+def rollups():
+    '''Rebuilds the observation rollups from the observations'''
+
+    rebuild_rollups()
+    db.session.commit()
+
+    # expire cached timelines
+    version_store.bump(*[row_key(Plant.__tablename__, id)
+                         for (id,) in db.session.query(Plant.id)])
+
+
+@manager.option('-u', '--users', dest='users', type=int, default=1000)
+@manager.option('-p', '--plants', dest='plants', type=int, default=5000)
+@manager.option('-o', '--observations', dest='observations', type=int,
+                default=100000)
+@manager.option('-s', '--seed', dest='seed', type=int, default=0)
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=CHUNK_SIZE)
+def seed(users, plants, observations, seed, chunk_size):
+    '''Adds generated users, plants and observations for scale testing'''
+
+    def progress(table, written, total, seconds):
+        # print about every tenth of a table
+        if written == total or \
+                written * 10 // total != (written - chunk_size) * 10 // total:
+            print(f'{table}: {written}/{total} rows in {seconds:.1f}s '
+                  f'({written / max(seconds, 1e-9):.0f} rows/s)')
+
+    seed_database(users, plants, observations, seed=seed,
+                  chunk_size=chunk_size, progress=progress)
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,384 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from flask import g, has_app_context, request
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Request Metrics
+
+Records per-route request latency, SQL statement count and time, template
+render time and Auth0 call time, and renders them in the Prometheus text
+format for /metrics.
+
+Each worker process keeps its metrics in memory. When METRICS_DIR is set,
+every worker also writes a snapshot to its own file in that directory
+every few seconds, and /metrics sums the files of all workers, so any
+worker can answer a scrape. Files of exited workers are kept so counters
+never go down; clear the directory when the server starts.
+'''
+
+
+# latency histogram bucket bounds in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+
+# seconds between snapshots written to METRICS_DIR
+FLUSH_INTERVAL = 5
+
+# exported metrics: type and help text
+METRICS = {
+    'http_requests_total': (
+        'counter', 'Requests handled, by route, method and status.'),
+    'http_request_duration_seconds': (
+        'histogram', 'Time from request start until the response was sent.'),
+    'http_request_db_statements_total': (
+        'counter', 'SQL statements executed while handling requests.'),
+    'http_request_db_seconds_total': (
+        'counter', 'Time spent executing SQL statements.'),
+    'http_request_template_seconds_total': (
+        'counter', 'Time spent rendering templates.'),
+    'http_request_auth0_seconds_total': (
+        'counter', 'Time spent waiting for Auth0.'),
+    'auth0_request_duration_seconds': (
+        'histogram', 'Auth0 call latency, by call.'),
+}
+
+
+class MetricsRegistry:
+    '''
+    Counters and histograms of one process, keyed by metric name and
+    label values. Thread safe.
+    '''
+
+    def __init__(self, directory=None, flush_interval=FLUSH_INTERVAL):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def _reset(self):
+        # state is per process, a forked worker starts empty
+        self.pid = os.getpid()
+        self._counters = {}
+        self._histograms = {}
+        self._flusher = None
+
+    def inc(self, name, labels, value=1):
+        '''
+        Adds value to a counter
+        '''
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        '''
+        Records value in a histogram
+        '''
+
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._check_process()
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = {
+                    'buckets': list(buckets), 'counts': [0] * len(buckets),
+                    'sum': 0.0, 'count': 0}
+
+            for i, bound in enumerate(histogram['buckets']):
+                if value <= bound:
+                    histogram['counts'][i] += 1
+                    break
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def snapshot(self):
+        '''
+        Returns this process's metrics as a JSON serializable dict
+        '''
+
+        with self._lock:
+            return {
+                'counters': [[name, labels, value] for (name, labels), value
+                             in self._counters.items()],
+                'histograms': [[name, labels, dict(histogram,
+                                                   counts=list(
+                                                       histogram['counts']))]
+                               for (name, labels), histogram
+                               in self._histograms.items()],
+            }
+
+    def flush(self):
+        '''
+        Writes this process's snapshot to its file in the metrics directory
+        '''
+
+        if self.directory is None:
+            return
+
+        path = os.path.join(self.directory, f'worker-{os.getpid()}.json')
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+
+        # readers only ever see whole files
+        os.replace(temporary, path)
+
+    def collect(self):
+        '''
+        Returns (counters, histograms) summed over all workers, or for this
+        process only if there is no metrics directory
+        '''
+
+        if self.directory is None:
+            snapshots = [self.snapshot()]
+        else:
+            self.flush()
+            snapshots = []
+            for path in glob.glob(os.path.join(self.directory,
+                                               'worker-*.json')):
+                try:
+                    with open(path) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    # removed or replaced while listing
+                    continue
+
+        counters = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot['counters']:
+                key = (name, tuple(tuple(label) for label in labels))
+                counters[key] = counters.get(key, 0) + value
+
+            for name, labels, histogram in snapshot['histograms']:
+                key = (name, tuple(tuple(label) for label in labels))
+                total = histograms.get(key)
+                if total is None:
+                    histograms[key] = dict(histogram,
+                                           counts=list(histogram['counts']))
+                    continue
+
+                total['counts'] = [a + b for a, b in zip(total['counts'],
+                                                         histogram['counts'])]
+                total['sum'] += histogram['sum']
+                total['count'] += histogram['count']
+
+        return counters, histograms
+
+    def render(self):
+        '''
+        Returns all metrics in the Prometheus text exposition format
+        '''
+
+        counters, histograms = self.collect()
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+            for (metric, labels), value in sorted(counters.items()):
+                if metric == name:
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+
+            for (metric, labels), histogram in sorted(histograms.items()):
+                if metric != name:
+                    continue
+
+                # bucket counts are cumulative
+                cumulative = 0
+                for bound, count in zip(histogram['buckets'],
+                                        histogram['counts']):
+                    cumulative += count
+                    le = labels + (('le', repr(float(bound))),)
+                    lines.append(f'{name}_bucket{format_labels(le)} '
+                                 f'{cumulative}')
+                le = labels + (('le', '+Inf'),)
+                lines.append(f'{name}_bucket{format_labels(le)} '
+                             f'{histogram["count"]}')
+                lines.append(f'{name}_sum{format_labels(labels)} '
+                             f'{histogram["sum"]}')
+                lines.append(f'{name}_count{format_labels(labels)} '
+                             f'{histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def _check_process(self):
+        # called with the lock held
+        if os.getpid() != self.pid:
+            self._reset()
+
+        # snapshot in the background so idle workers are current too
+        if self.directory is not None and self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_forever,
+                                             daemon=True)
+            self._flusher.start()
+
+    def _flush_forever(self):
+        pid = os.getpid()
+        while os.getpid() == pid:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except OSError as e:
+                print('ERROR: ', str(e))
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', r'\\').replace('"', r'\"') \
+            .replace('\n', r'\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"'
+                          for name, value in labels) + '}'
+
+
+# process-wide registry
+registry = MetricsRegistry(os.getenv('METRICS_DIR'))
+
+
+class RequestStats:
+    '''
+    Time and statement totals of the request being handled
+    '''
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.db_statements = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+        self.auth0_seconds = 0.0
+
+
+def current_stats():
+    # stats of the current request, None outside requests
+    if has_app_context():
+        return g.get('request_stats')
+    return None
+
+
+def record_auth0_call(name, seconds):
+    '''
+    Records the duration of an outbound Auth0 call, also counted for the
+    current request if there is one
+    '''
+
+    registry.observe('auth0_request_duration_seconds', {'call': name},
+                     seconds)
+
+    stats = current_stats()
+    if stats is not None:
+        stats.auth0_seconds += seconds
+
+
+@contextmanager
+def auth0_call(name):
+    '''
+    Times the Auth0 call made in the with block
+    '''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_auth0_call(name, time.perf_counter() - start)
+
+
+class TimedTemplate(Template):
+    '''
+    Template adding its render time to the current request
+    '''
+
+    def render(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            stats = current_stats()
+            if stats is not None:
+                stats.template_seconds += time.perf_counter() - start
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+
+    stats = current_stats()
+    if stats is not None:
+        stats.db_statements += 1
+        stats.db_seconds += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(exception_context):
+    # failed statements never reach after_cursor_execute
+    connection = exception_context.connection
+    if connection is not None and connection.info.get('statement_start'):
+        connection.info['statement_start'].pop()
+
+
+def finish_request(stats, route, method, status):
+    # record a request once its response has been sent
+    labels = {'route': route, 'method': method}
+    registry.inc('http_requests_total', dict(labels, status=str(status)))
+    registry.observe('http_request_duration_seconds', labels,
+                     time.perf_counter() - stats.start)
+    registry.inc('http_request_db_statements_total', labels,
+                 stats.db_statements)
+    registry.inc('http_request_db_seconds_total', labels, stats.db_seconds)
+    registry.inc('http_request_template_seconds_total', labels,
+                 stats.template_seconds)
+    registry.inc('http_request_auth0_seconds_total', labels,
+                 stats.auth0_seconds)
+
+
+def init_app(app):
+    '''
+    Instruments every view of app
+    '''
+
+    # templates loaded from now on are timed
+    app.jinja_env.template_class = TimedTemplate
+
+    @app.before_request
+    def start_request():
+        g.request_stats = RequestStats()
+
+    @app.after_request
+    def record_request(response):
+        stats = g.get('request_stats')
+        if stats is None:
+            return response
+
+        # route template keeps label values few, unmatched urls share one
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        method = request.method
+        status = response.status_code
+
+        # streamed bodies are still being generated, record on close
+        response.call_on_close(
+            lambda: finish_request(stats, route, method, status))
+        return response
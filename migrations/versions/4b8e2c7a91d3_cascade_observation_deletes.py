@@ -0,0 +1,33 @@
+"""cascade observation deletes with their plant
+
+Revision ID: 4b8e2c7a91d3
+Revises: 1f34cbf6d5da
+Create Date: 2026-10-18 10:12:31.402118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4b8e2c7a91d3'
+down_revision = '1f34cbf6d5da'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # recreate plant foreign key with ON DELETE CASCADE, so deleting a
+    # plant removes its observations in the same statement
+    op.drop_constraint('Observations_plant_id_fkey', 'Observations',
+                       type_='foreignkey')
+    op.create_foreign_key('Observations_plant_id_fkey', 'Observations',
+                          'Plants', ['plant_id'], ['id'],
+                          ondelete='CASCADE')
+
+
+def downgrade():
+    op.drop_constraint('Observations_plant_id_fkey', 'Observations',
+                       type_='foreignkey')
+    op.create_foreign_key('Observations_plant_id_fkey', 'Observations',
+                          'Plants', ['plant_id'], ['id'])
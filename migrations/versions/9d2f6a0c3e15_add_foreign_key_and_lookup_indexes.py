@@ -0,0 +1,45 @@
+"""add foreign key and lookup indexes
+
+Revision ID: 9d2f6a0c3e15
+Revises: 4b8e2c7a91d3
+Create Date: 2026-10-18 11:02:47.913355
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9d2f6a0c3e15'
+down_revision = '4b8e2c7a91d3'
+branch_labels = None
+depends_on = None
+
+
+# (name, table, columns, unique)
+INDEXES = [
+    ('ix_Users_user_id', 'Users', ['user_id'], True),
+    ('ix_Plants_user_id', 'Plants', ['user_id'], False),
+    ('ix_Observations_plant_id_date', 'Observations', ['plant_id', 'date'],
+     False),
+    ('ix_Observations_user_id', 'Observations', ['user_id'], False),
+    ('ix_Observations_date_id', 'Observations', ['date', 'id'], False),
+]
+
+
+def upgrade():
+    # CREATE INDEX CONCURRENTLY doesn't block writes but can't run inside
+    # a transaction. If a build fails it leaves an INVALID index behind,
+    # drop it and rerun the upgrade. ix_Users_user_id fails if duplicate
+    # Auth0 subjects exist.
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in INDEXES:
+            op.create_index(name, table, columns, unique=unique,
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for name, table, columns, unique in reversed(INDEXES):
+            op.drop_index(name, table_name=table,
+                          postgresql_concurrently=True)
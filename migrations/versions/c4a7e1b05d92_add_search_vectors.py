@@ -0,0 +1,67 @@
+"""add search vectors
+
+Revision ID: c4a7e1b05d92
+Revises: 9d2f6a0c3e15
+Create Date: 2026-10-18 14:26:05.118742
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4a7e1b05d92'
+down_revision = '9d2f6a0c3e15'
+branch_labels = None
+depends_on = None
+
+
+# (table, trigger function, searched columns with weights)
+SEARCH_TABLES = [
+    ('Plants', 'plants_search_vector_update',
+     [('name', 'A'), ('latin_name', 'A'), ('description', 'B')]),
+    ('Observations', 'observations_search_vector_update',
+     [('notes', 'A')]),
+]
+
+
+def upgrade():
+    for table, function, columns in SEARCH_TABLES:
+        vector = ' || '.join(
+            f"setweight(to_tsvector('english', coalesce(NEW.{name}, '')), "
+            f"'{weight}')" for name, weight in columns)
+        column_list = ', '.join(name for name, weight in columns)
+
+        op.add_column(table, sa.Column('search_vector',
+                                       postgresql.TSVECTOR()))
+        op.execute(f'CREATE OR REPLACE FUNCTION {function}() '
+                   f'RETURNS trigger AS $$ BEGIN '
+                   f'NEW.search_vector := {vector}; '
+                   f'RETURN NEW; END $$ LANGUAGE plpgsql')
+        op.execute(f'CREATE TRIGGER {function} BEFORE INSERT OR UPDATE OF '
+                   f'{column_list} ON "{table}" FOR EACH ROW '
+                   f'EXECUTE PROCEDURE {function}()')
+
+        # fill in existing rows through the trigger
+        name = columns[0][0]
+        op.execute(f'UPDATE "{table}" SET {name} = {name}')
+
+    # build GIN indexes without blocking writes
+    with op.get_context().autocommit_block():
+        for table, function, columns in SEARCH_TABLES:
+            op.create_index(f'ix_{table}_search_vector', table,
+                            ['search_vector'], postgresql_using='gin',
+                            postgresql_concurrently=True)
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        for table, function, columns in SEARCH_TABLES:
+            op.drop_index(f'ix_{table}_search_vector', table_name=table,
+                          postgresql_concurrently=True)
+
+    for table, function, columns in SEARCH_TABLES:
+        op.execute(f'DROP TRIGGER {function} ON "{table}"')
+        op.execute(f'DROP FUNCTION {function}()')
+        op.drop_column(table, 'search_vector')
@@ -0,0 +1,62 @@
+"""add observation locations
+
+Revision ID: e81f3c6b2a47
+Revises: c4a7e1b05d92
+Create Date: 2026-10-18 16:41:52.307611
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e81f3c6b2a47'
+down_revision = 'c4a7e1b05d92'
+branch_labels = None
+depends_on = None
+
+
+# GiST index expression, must match the queries in services.filter_area
+LOCATION = ('(ST_SetSRID(ST_MakePoint(longitude, latitude), 4326)'
+            '::geography)')
+
+
+def postgis_installed():
+    # the extension is left for the database owner to install
+    return op.get_bind().execute(
+        "SELECT 1 FROM pg_extension WHERE extname = 'postgis'"
+    ).scalar() is not None
+
+
+def upgrade():
+    op.add_column('Observations', sa.Column('latitude', sa.Float(),
+                                            nullable=True))
+    op.add_column('Observations', sa.Column('longitude', sa.Float(),
+                                            nullable=True))
+    op.add_column('Observations', sa.Column('accuracy', sa.Float(),
+                                            nullable=True))
+    op.add_column('Observations', sa.Column(
+        'geohash', sa.String(length=12, collation='C'), nullable=True))
+
+    # build indexes without blocking writes
+    with op.get_context().autocommit_block():
+        op.create_index('ix_Observations_geohash', 'Observations',
+                        ['geohash'], postgresql_concurrently=True)
+
+        if postgis_installed():
+            op.execute(f'CREATE INDEX CONCURRENTLY "ix_Observations_location" '
+                       f'ON "Observations" USING gist ({LOCATION}) '
+                       f'WHERE latitude IS NOT NULL')
+
+
+def downgrade():
+    with op.get_context().autocommit_block():
+        op.execute('DROP INDEX CONCURRENTLY IF EXISTS '
+                   '"ix_Observations_location"')
+        op.drop_index('ix_Observations_geohash', table_name='Observations',
+                      postgresql_concurrently=True)
+
+    op.drop_column('Observations', 'geohash')
+    op.drop_column('Observations', 'accuracy')
+    op.drop_column('Observations', 'longitude')
+    op.drop_column('Observations', 'latitude')
@@ -0,0 +1,44 @@
+"""add observation rollups
+
+Revision ID: f27b9d4e8c10
+Revises: e81f3c6b2a47
+Create Date: 2026-10-18 18:05:13.640298
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f27b9d4e8c10'
+down_revision = 'e81f3c6b2a47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('ObservationRollups',
+    sa.Column('plant_id', sa.Integer(), nullable=False),
+    sa.Column('period', sa.String(length=5), nullable=False),
+    sa.Column('bucket', sa.Date(), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.Column('first_seen', sa.DateTime(), nullable=False),
+    sa.Column('last_seen', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['plant_id'], ['Plants.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('plant_id', 'period', 'bucket')
+    )
+
+    # fill in rollups of existing observations, weeks start on Monday
+    for period in ['week', 'month']:
+        op.execute(f'''
+            INSERT INTO "ObservationRollups"
+                (plant_id, period, bucket, count, first_seen, last_seen)
+            SELECT plant_id, '{period}', date_trunc('{period}', date)::date,
+                count(*), min(date), max(date)
+            FROM "Observations"
+            GROUP BY plant_id, date_trunc('{period}', date)
+        ''')
+
+
+def downgrade():
+    op.drop_table('ObservationRollups')
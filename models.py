@@ -1,8 +1,15 @@
 import os
-from sqlalchemy import Column, String, Integer
+from sqlalchemy import (Column, String, Integer, bindparam, event, inspect,
+                        text)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import (joinedload, selectinload, load_only,
+                            configure_mappers)
 from flask_sqlalchemy import SQLAlchemy
-from datetime import datetime
+from datetime import datetime, timedelta
 from dotenv import load_dotenv, find_dotenv
+from versions import version_store, table_key, row_key, owner_key
+from suggest import plant_suggestions
+import geo
 
 # set up environment variables using dotenv
 ENV_FILE = find_dotenv()
@@ -15,6 +22,70 @@ database_path = os.getenv('DATABASE_URL')
 db = SQLAlchemy()
 
 
+def env_flag(name, default):
+    # boolean environment variable
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def engine_options(database_path):
+    '''
+    engine_options(database_path)
+    returns the SQLAlchemy engine options for a database, set with DB_*
+    environment variables
+    '''
+
+    # SQLite uses its own pools, without these options
+    if not database_path or database_path.startswith('sqlite'):
+        return {}
+
+    options = {
+        # connections kept open per worker process, and opened on top of
+        # them during bursts
+        'pool_size': int(os.getenv('DB_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        # seconds a request waits for a free connection before failing
+        'pool_timeout': int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        # test connections on checkout so ones broken by a failover or an
+        # idle timeout are replaced instead of failing a request
+        'pool_pre_ping': env_flag('DB_POOL_PRE_PING', True),
+        # replace connections older than this many seconds
+        'pool_recycle': int(os.getenv('DB_POOL_RECYCLE', 1800)),
+    }
+
+    if database_path.startswith('postgres'):
+        connect_args = {
+            'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 10)),
+            'application_name': os.getenv('DB_APPLICATION_NAME',
+                                          'plant-survey'),
+        }
+
+        # PgBouncer rejects startup options, statement_timeout is set per
+        # transaction instead (see setup_db)
+        if statement_timeout() and not env_flag('DB_PGBOUNCER', False):
+            connect_args['options'] = \
+                f'-c statement_timeout={statement_timeout()}'
+
+        options['connect_args'] = connect_args
+
+    return options
+
+
+def statement_timeout():
+    # milliseconds a statement may run, 0 for no limit. Below the gunicorn
+    # worker timeout so a slow query fails before its worker is killed.
+    return int(os.getenv('DB_STATEMENT_TIMEOUT', 20000))
+
+
+def set_local_statement_timeout(conn):
+    # with PgBouncer transaction pooling, consecutive transactions may use
+    # different server connections, so settings only last a transaction
+    if conn.dialect.name == 'postgresql':
+        conn.execute(f'SET LOCAL statement_timeout = {statement_timeout()}')
+
+
 def setup_db(app, database_path=database_path):
     '''
     setup_db(app)
@@ -23,9 +94,19 @@ def setup_db(app, database_path=database_path):
 
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
 
+    # create backref attributes like Observation.plant before the first
+    # query reads them
+    configure_mappers()
+
+    # PgBouncer compatible statement timeout
+    if env_flag('DB_PGBOUNCER', False) and statement_timeout() and \
+            not event.contains(Engine, 'begin', set_local_statement_timeout):
+        event.listen(Engine, 'begin', set_local_statement_timeout)
+
 
 # format datetime utility
 def format_datetime(datetime):
@@ -33,13 +114,103 @@ def format_datetime(datetime):
 
 
 # format plant_observations
-def format_plant_observations(plant_observations):
-    return [observation.format() for observation in plant_observations]
+def format_plant_observations(plant_observations, fields=None):
+    return [observation.format(fields) for observation in plant_observations]
 
 
 # format plants
-def format_plants(plants):
-    return [plant.format() for plant in plants]
+def format_plants(plants, fields=None, include_observations=True):
+    return [plant.format(fields, include_observations) for plant in plants]
+
+
+# plant fields that can be requested
+PLANT_FIELDS = ('id', 'user_id', 'name', 'latin_name', 'description',
+                'image_link')
+
+# observation fields that can be requested, and how each is formatted
+OBSERVATION_FIELDS = {
+    'id': lambda observation: observation.id,
+    'user_id': lambda observation: observation.user_id,
+    'datetime': lambda observation: observation.date,
+    'date': lambda observation: format_datetime(observation.date),
+    'plant_name': lambda observation: observation.plant.name,
+    'plant_image': lambda observation: observation.plant.image_link,
+    'plant_id': lambda observation: observation.plant_id,
+    'notes': lambda observation: observation.notes,
+    'latitude': lambda observation: observation.latitude,
+    'longitude': lambda observation: observation.longitude,
+    'accuracy': lambda observation: observation.accuracy,
+}
+
+# observation columns each observation field is read from
+OBSERVATION_COLUMNS = {
+    'id': 'id',
+    'user_id': 'user_id',
+    'datetime': 'date',
+    'date': 'date',
+    'plant_id': 'plant_id',
+    'notes': 'notes',
+    'latitude': 'latitude',
+    'longitude': 'longitude',
+    'accuracy': 'accuracy',
+}
+
+# plant columns read by observation fields
+OBSERVATION_PLANT_COLUMNS = {
+    'plant_name': 'name',
+    'plant_image': 'image_link',
+}
+
+
+# plant query that loads observations in one extra SELECT ... IN per page
+# so Plant.format() doesn't lazy load them one plant at a time.
+# if fields are given, only those columns are loaded
+def plants_query(fields=None, include_observations=True):
+    query = Plant.query
+
+    if fields is not None:
+        columns = {'id'} | set(fields)
+
+        # embedded observations show the plant name and image
+        if include_observations:
+            columns |= {'name', 'image_link'}
+
+        query = query.options(load_only(*columns))
+
+    if include_observations:
+        query = query.options(selectinload(Plant.plant_observations))
+
+    return query
+
+
+# observation query that joins the observed plant so Observation.format()
+# reads plant name and image from the identity map instead of the database.
+# if fields are given, only those columns are loaded and the plant is only
+# joined if a plant field is requested
+def observations_query(fields=None):
+    if fields is None:
+        return Observation.query.options(joinedload(Observation.plant))
+
+    # id and date are the listing sort key
+    columns = {'id', 'date'}
+    columns |= {OBSERVATION_COLUMNS[field] for field in fields
+                if field in OBSERVATION_COLUMNS}
+    query = Observation.query.options(load_only(*columns))
+
+    plant_columns = {OBSERVATION_PLANT_COLUMNS[field] for field in fields
+                     if field in OBSERVATION_PLANT_COLUMNS}
+    if plant_columns:
+        query = query.options(
+            joinedload(Observation.plant).load_only(*plant_columns))
+
+    return query
+
+
+# user query that eager loads plants and observations for User.format()
+def users_query():
+    return User.query.options(
+        selectinload(User.plants).selectinload(Plant.plant_observations),
+        selectinload(User.observations).joinedload(Observation.plant))
 
 
 '''
@@ -52,13 +223,16 @@ class Plant(db.Model):
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, db.ForeignKey(
-        'Users.id'), nullable=False)
+        'Users.id'), nullable=False, index=True)
     name = Column(String(120), nullable=False)
     latin_name = Column(String(120), nullable=False)
     description = Column(String(2500), nullable=False)
     image_link = Column(String(500), nullable=False)
+    # observations are deleted by the database with ON DELETE CASCADE,
+    # passive_deletes stops them being loaded and deleted one by one
     plant_observations = db.relationship(
-        'Observation', backref='plant', lazy=True)
+        'Observation', backref='plant', lazy=True,
+        cascade='save-update, merge, delete', passive_deletes=True)
 
     def __init__(self, user_id, name, latin_name, description, image_link):
         self.user_id = user_id
@@ -70,28 +244,56 @@ class Plant(db.Model):
     def __repr__(self):
         return f'<Plant {self.id} {self.name}>'
 
+    def version_keys(self):
+        return [table_key(self.__tablename__),
+                row_key(self.__tablename__, self.id),
+                owner_key(self.user_id)]
+
+    def table_version(self):
+        return version_store.get(table_key(self.__tablename__))[0]
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        version_store.bump(*self.version_keys())
+        plant_suggestions.update(self.id, self.name, self.latin_name,
+                                 self.table_version())
 
     def update(self):
         db.session.commit()
+        version_store.bump(*self.version_keys())
+        plant_suggestions.update(self.id, self.name, self.latin_name,
+                                 self.table_version())
 
     def delete(self):
+        # plant's observations are deleted with it
+        id = self.id
+        keys = self.version_keys() + [table_key(Observation.__tablename__)]
+
+        # delete observations and their rollups with set-based statements,
+        # in the same transaction as the plant, and forget any that were
+        # loaded
+        Observation.query.filter_by(plant_id=self.id).delete(
+            synchronize_session=False)
+        ObservationRollup.query.filter_by(plant_id=self.id).delete(
+            synchronize_session=False)
+        db.session.expire(self, ['plant_observations'])
+
         db.session.delete(self)
         db.session.commit()
+        version_store.bump(*keys)
+        plant_suggestions.remove(id, self.table_version())
 
-    def format(self):
-        return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'name': self.name,
-            'latin_name': self.latin_name,
-            'description': self.description,
-            'image_link': self.image_link,
-            'plant_observations':
+    def format(self, fields=None, include_observations=True):
+        # only read requested fields so deferred columns aren't loaded
+        data = {field: getattr(self, field)
+                for field in (fields or PLANT_FIELDS)}
+
+        if include_observations:
+            data['plant_observations'] = \
                 format_plant_observations(self.plant_observations)
-        }
+
+        return data
 
 
 '''
@@ -101,49 +303,276 @@ Plant Observations
 
 class Observation(db.Model):
     __tablename__ = 'Observations'
+    __table_args__ = (
+        # observations of a plant, in date order
+        db.Index('ix_Observations_plant_id_date', 'plant_id', 'date'),
+        # observation listing sort key
+        db.Index('ix_Observations_date_id', 'date', 'id'),
+        # area queries
+        db.Index('ix_Observations_geohash', 'geohash'),
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, db.ForeignKey(
-        'Users.id'), nullable=False)
+        'Users.id'), nullable=False, index=True)
     date = Column(db.DateTime, nullable=False,
                   default=datetime.utcnow)
     plant_id = Column(Integer, db.ForeignKey(
-        'Plants.id'), nullable=False)
+        'Plants.id', ondelete='CASCADE'), nullable=False)
     notes = Column(String(2500))
-
-    def __init__(self, user_id, date, plant_id, notes):
+    # optional location in degrees, and its accuracy in meters
+    latitude = Column(db.Float)
+    longitude = Column(db.Float)
+    accuracy = Column(db.Float)
+    # geohash of the location, compared byte by byte for prefix ranges
+    geohash = Column(String(12).with_variant(
+        String(12, collation='C'), 'postgresql'))
+
+    def __init__(self, user_id, date, plant_id, notes, latitude=None,
+                 longitude=None, accuracy=None):
         self.user_id = user_id
         self.date = date
         self.plant_id = plant_id
         self.notes = notes
+        self.latitude = latitude
+        self.longitude = longitude
+        self.accuracy = accuracy
+        if latitude is not None and longitude is not None:
+            self.geohash = geo.encode(latitude, longitude)
 
     def __repr__(self):
         return f'<Observation: User ID {self.user_id}, Date {self.date}, Plant ID {self.plant_id}>'
 
+    def version_keys(self):
+        # plant row key covers the plant's observations
+        return [table_key(self.__tablename__),
+                row_key(self.__tablename__, self.id),
+                row_key(Plant.__tablename__, self.plant_id),
+                owner_key(self.user_id)]
+
+    def rollup_values(self):
+        # date and plant id set from request bodies may be strings, read
+        # them back from the flushed row
+        if not isinstance(self.date, datetime) or \
+                not isinstance(self.plant_id, int):
+            db.session.refresh(self, ['date', 'plant_id'])
+        return self.plant_id, self.date
+
     def insert(self):
+        # count observation in rollups in the same transaction
         db.session.add(self)
+        db.session.flush()
+        add_to_rollups([self.rollup_values()])
+
         db.session.commit()
+        version_store.bump(*self.version_keys())
 
     def update(self):
+        # move observation between rollup buckets if date or plant changed
+        state = inspect(self)
+        date_history = state.attrs.date.history
+        plant_history = state.attrs.plant_id.history
+
+        if date_history.has_changes() or plant_history.has_changes():
+            old_dates = date_history.deleted or date_history.unchanged
+            old_plant_ids = plant_history.deleted or plant_history.unchanged
+            db.session.flush()
+
+            if old_dates and old_plant_ids:
+                remove_from_rollups([(old_plant_ids[0], old_dates[0])])
+                add_to_rollups([self.rollup_values()])
+            else:
+                # old values weren't loaded, recount the plant
+                rebuild_rollups(self.rollup_values()[0])
+
         db.session.commit()
+        version_store.bump(*self.version_keys())
 
     def delete(self):
+        keys = self.version_keys()
+        plant_id, date = self.plant_id, self.date
+
         db.session.delete(self)
+        db.session.flush()
+        remove_from_rollups([(plant_id, date)])
+
         db.session.commit()
+        version_store.bump(*keys)
+
+    def format(self, fields=None):
+        # only read requested fields so deferred columns and the plant
+        # aren't loaded unless needed
+        return {field: OBSERVATION_FIELDS[field](self)
+                for field in (fields or OBSERVATION_FIELDS)}
+
+
+'''
+Observation Rollups
+
+Observation counts per plant and week or month, with the first and last
+observation date in each. They are updated in the same transaction as
+the observations, so charts read a few rollup rows instead of grouping
+all observations.
+'''
+
+
+def start_of_week(date):
+    # weeks start on Monday
+    return date.date() - timedelta(days=date.weekday())
+
+
+def start_of_month(date):
+    return date.date().replace(day=1)
+
+
+def end_of_week(bucket):
+    return bucket + timedelta(days=7)
+
+
+def end_of_month(bucket):
+    return (bucket + timedelta(days=32)).replace(day=1)
+
+
+# rollup periods, with the first day of the bucket containing a date and
+# the first day after a bucket
+ROLLUP_PERIODS = {
+    'week': (start_of_week, end_of_week),
+    'month': (start_of_month, end_of_month),
+}
+
+
+class ObservationRollup(db.Model):
+    __tablename__ = 'ObservationRollups'
+
+    plant_id = Column(Integer, db.ForeignKey(
+        'Plants.id', ondelete='CASCADE'), primary_key=True)
+    period = Column(String(5), primary_key=True)
+    bucket = Column(db.Date, primary_key=True)
+    count = Column(Integer, nullable=False)
+    first_seen = Column(db.DateTime, nullable=False)
+    last_seen = Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<ObservationRollup: Plant ID {self.plant_id}, {self.period} {self.bucket}, Count {self.count}>'
 
     def format(self):
         return {
-            'id': self.id,
-            'user_id': self.user_id,
-            'datetime': self.date,
-            'date': format_datetime(self.date),
-            'plant_name': Plant.query.filter_by(id=self.plant_id).one_or_none().name,
-            'plant_image': Plant.query.filter_by(id=self.plant_id).one_or_none().image_link,
-            'plant_id': self.plant_id,
-            'notes': self.notes,
+            'bucket': self.bucket.isoformat(),
+            'count': self.count,
+            'first_seen': self.first_seen,
+            'last_seen': self.last_seen
         }
 
 
+# adds counts to rollup rows atomically, creating them if needed
+ROLLUP_UPSERT = text('''
+    INSERT INTO "ObservationRollups"
+        (plant_id, period, bucket, count, first_seen, last_seen)
+    VALUES
+        (:plant_id, :period, :bucket, :count, :first_seen, :last_seen)
+    ON CONFLICT (plant_id, period, bucket) DO UPDATE SET
+        count = "ObservationRollups".count + excluded.count,
+        first_seen = CASE
+            WHEN excluded.first_seen < "ObservationRollups".first_seen
+            THEN excluded.first_seen
+            ELSE "ObservationRollups".first_seen END,
+        last_seen = CASE
+            WHEN excluded.last_seen > "ObservationRollups".last_seen
+            THEN excluded.last_seen
+            ELSE "ObservationRollups".last_seen END
+''').bindparams(bindparam('bucket', type_=db.Date),
+                 bindparam('first_seen', type_=db.DateTime),
+                 bindparam('last_seen', type_=db.DateTime))
+
+# drops rollup rows left without observations
+ROLLUP_DELETE = text('''
+    DELETE FROM "ObservationRollups"
+    WHERE plant_id = :plant_id AND period = :period AND bucket = :bucket
+        AND count <= :count
+''').bindparams(bindparam('bucket', type_=db.Date))
+
+# subtracts counts and recomputes the first and last dates of a bucket
+ROLLUP_SUBTRACT = text('''
+    UPDATE "ObservationRollups" SET
+        count = count - :count,
+        first_seen = (SELECT min(date) FROM "Observations"
+                      WHERE plant_id = :plant_id
+                      AND date >= :start AND date < :end),
+        last_seen = (SELECT max(date) FROM "Observations"
+                     WHERE plant_id = :plant_id
+                     AND date >= :start AND date < :end)
+    WHERE plant_id = :plant_id AND period = :period AND bucket = :bucket
+''').bindparams(bindparam('bucket', type_=db.Date),
+                 bindparam('start', type_=db.DateTime),
+                 bindparam('end', type_=db.DateTime))
+
+
+def group_rollups(observations):
+    # count (plant_id, date) pairs per rollup bucket, with first and last
+    # dates
+    groups = {}
+    for plant_id, date in observations:
+        for period, (start, end) in ROLLUP_PERIODS.items():
+            key = (plant_id, period, start(date))
+            count, first_seen, last_seen = groups.get(key, (0, date, date))
+            groups[key] = (count + 1, min(first_seen, date),
+                           max(last_seen, date))
+
+    return [{'plant_id': plant_id, 'period': period, 'bucket': bucket,
+             'count': count, 'first_seen': first_seen,
+             'last_seen': last_seen}
+            for (plant_id, period, bucket), (count, first_seen, last_seen)
+            in groups.items()]
+
+
+def add_to_rollups(observations):
+    '''
+    add_to_rollups(observations)
+    counts new observations, given as (plant_id, date) pairs, in the
+    rollups. Runs in the caller's transaction.
+    '''
+
+    rows = group_rollups(observations)
+    if rows:
+        db.session.execute(ROLLUP_UPSERT, rows)
+
+
+def remove_from_rollups(observations):
+    '''
+    remove_from_rollups(observations)
+    uncounts observations, given as (plant_id, date) pairs, that were
+    already deleted or moved in the caller's transaction
+    '''
+
+    rows = group_rollups(observations)
+    for row in rows:
+        end = ROLLUP_PERIODS[row['period']][1]
+        row['start'] = datetime.combine(row['bucket'], datetime.min.time())
+        row['end'] = datetime.combine(end(row['bucket']),
+                                      datetime.min.time())
+
+    if rows:
+        db.session.execute(ROLLUP_DELETE, rows)
+        db.session.execute(ROLLUP_SUBTRACT, rows)
+
+
+def rebuild_rollups(plant_id=None):
+    '''
+    rebuild_rollups(plant_id=None)
+    recomputes the rollups of one plant, or all plants, from their
+    observations. Runs in the caller's transaction.
+    '''
+
+    rollups = ObservationRollup.query
+    observations = db.session.query(Observation.plant_id, Observation.date)
+    if plant_id is not None:
+        rollups = rollups.filter_by(plant_id=plant_id)
+        observations = observations.filter_by(plant_id=plant_id)
+
+    rollups.delete(synchronize_session=False)
+    add_to_rollups(observations.yield_per(1000))
+
+
 '''
 User
 '''
@@ -155,7 +584,7 @@ class User(db.Model):
     id = Column(Integer, primary_key=True)
     name = Column(String(120), nullable=False)
     username = Column(String(120), nullable=False)
-    user_id = Column(String(120), nullable=False)
+    user_id = Column(String(120), nullable=False, unique=True, index=True)
     date_added = Column(db.DateTime, nullable=False,
                         default=datetime.utcnow)
     role = Column(String(120), nullable=False)
@@ -174,16 +603,24 @@ class User(db.Model):
     def __repr__(self):
         return f'<User: Name {self.name}, Username {self.username}, Date Added {self.date_added}, Role {self.role}>'
 
+    def version_keys(self):
+        return [table_key(self.__tablename__),
+                row_key(self.__tablename__, self.id)]
+
     def insert(self):
         db.session.add(self)
         db.session.commit()
+        version_store.bump(*self.version_keys())
 
     def update(self):
         db.session.commit()
+        version_store.bump(*self.version_keys())
 
     def delete(self):
+        keys = self.version_keys()
         db.session.delete(self)
         db.session.commit()
+        version_store.bump(*keys)
 
     def format(self):
         return {
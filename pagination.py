@@ -0,0 +1,127 @@
+import base64
+import json
+from datetime import datetime
+from sqlalchemy import tuple_
+
+
+# default and maximum number of rows returned per page
+DEFAULT_LIMIT = 50
+MAX_LIMIT = 200
+
+
+'''
+Keyset (cursor) pagination
+
+Pages are fetched with WHERE (sort key) > (last key seen) instead of OFFSET,
+so every page costs the same index range scan no matter how deep it is.
+The sort key of the last row on a page is handed to the client as an opaque
+cursor string.
+'''
+
+
+def get_limit(limit):
+    '''
+    Parses the limit query parameter, capped at MAX_LIMIT
+    '''
+
+    # use default if no limit requested
+    if limit is None:
+        return DEFAULT_LIMIT
+
+    # raises ValueError if limit isn't an integer
+    limit = int(limit)
+
+    # limit must be positive
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    return min(limit, MAX_LIMIT)
+
+
+def encode_cursor(values):
+    '''
+    Encodes the sort key values of a row as an opaque cursor
+    '''
+
+    # datetimes aren't JSON serializable, store them as ISO strings
+    values = [value.isoformat() if isinstance(value, datetime) else value
+              for value in values]
+
+    data = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(data).decode().rstrip('=')
+
+
+def decode_cursor(cursor, columns):
+    '''
+    Decodes a cursor into sort key values for the given columns.
+    Raises ValueError if the cursor is malformed.
+    '''
+
+    # restore base64 padding stripped by encode_cursor
+    padded = cursor + '=' * (-len(cursor) % 4)
+
+    try:
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError):
+        raise ValueError('malformed cursor')
+
+    # cursor must hold one value per sort column
+    if not isinstance(values, list) or len(values) != len(columns):
+        raise ValueError('malformed cursor')
+
+    # convert values back to the column types
+    decoded = []
+    for column, value in zip(columns, values):
+        python_type = column.type.python_type
+        if python_type is datetime:
+            if not isinstance(value, str):
+                raise ValueError('malformed cursor')
+            value = datetime.fromisoformat(value)
+        elif not isinstance(value, python_type):
+            raise ValueError('malformed cursor')
+        decoded.append(value)
+
+    return decoded
+
+
+def order_by_key(query, columns, cursor=None, descending=False):
+    '''
+    order_by_key(query, columns)
+    orders query by the sort key columns, starting after cursor if given
+    '''
+
+    # only return rows after the cursor
+    if cursor is not None:
+        after = tuple_(*decode_cursor(cursor, columns))
+        key = tuple_(*columns)
+        query = query.filter(key < after if descending else key > after)
+
+    # order by the sort key
+    if descending:
+        return query.order_by(*[column.desc() for column in columns])
+
+    return query.order_by(*columns)
+
+
+def paginate(query, columns, cursor=None, limit=DEFAULT_LIMIT,
+             descending=False):
+    '''
+    paginate(query, columns)
+    returns one page of query results ordered by columns, and the cursor
+    for the next page (None on the last page)
+    '''
+
+    query = order_by_key(query, columns, cursor=cursor,
+                         descending=descending)
+
+    # fetch one extra row to find out if there is a next page
+    rows = query.limit(limit + 1).all()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([getattr(last, column.key)
+                                     for column in columns])
+
+    return rows, next_cursor
@@ -0,0 +1,183 @@
+import re
+from sqlalchemy import (DDL, Float, Integer, cast, column, event, func,
+                        literal, literal_column, select, table, union_all)
+from models import Plant, Observation
+
+
+'''
+Full-text Search
+
+Searches plant names, latin names and descriptions, and observation notes.
+
+On Postgres each searched table has a search_vector tsvector column with a
+GIN index, kept up to date by a trigger. On SQLite an FTS5 table per
+searched table indexes the same columns, kept in sync by triggers. Since
+both are maintained by triggers, rows written with COPY or raw SQL are
+indexed too.
+
+The migration adds the Postgres objects to existing databases.
+db.create_all() adds them for either backend.
+'''
+
+
+# text search configuration used for indexing and queries on Postgres
+TEXT_SEARCH_CONFIG = 'english'
+
+# searched tables: result type, and searched columns with their Postgres
+# weight and SQLite bm25 weight
+SEARCH_TABLES = {
+    Plant: ('plant', [('name', 'A', 10.0),
+                      ('latin_name', 'A', 10.0),
+                      ('description', 'B', 1.0)]),
+    Observation: ('observation', [('notes', 'A', 1.0)]),
+}
+
+
+def postgres_ddl(table_name, columns):
+    '''
+    Returns the statements adding the search_vector column, its trigger
+    and GIN index to a table
+    '''
+
+    function = f'{table_name.lower()}_search_vector_update'
+    vector = ' || '.join(
+        f"setweight(to_tsvector('{TEXT_SEARCH_CONFIG}', "
+        f"coalesce(NEW.{name}, '')), '{weight}')"
+        for name, weight, bm25_weight in columns)
+    column_list = ', '.join(name for name, *weights in columns)
+
+    return [
+        f'ALTER TABLE "{table_name}" ADD COLUMN search_vector tsvector',
+        f'CREATE OR REPLACE FUNCTION {function}() '
+        f'RETURNS trigger AS $$ BEGIN NEW.search_vector := {vector}; '
+        f'RETURN NEW; END $$ LANGUAGE plpgsql',
+        f'CREATE TRIGGER {function} BEFORE INSERT OR '
+        f'UPDATE OF {column_list} ON "{table_name}" FOR EACH ROW '
+        f'EXECUTE PROCEDURE {function}()',
+        f'CREATE INDEX "ix_{table_name}_search_vector" ON "{table_name}" '
+        f'USING gin (search_vector)',
+    ]
+
+
+def sqlite_ddl(table_name, columns):
+    '''
+    Returns the statements creating an external content FTS5 table for a
+    table and the triggers keeping it in sync
+    '''
+
+    fts = f'{table_name}_fts'
+    names = [name for name, *weights in columns]
+    column_list = ', '.join(names)
+    new_values = ', '.join(f'new.{name}' for name in names)
+    old_values = ', '.join(f'old.{name}' for name in names)
+
+    insert = (f'INSERT INTO "{fts}"(rowid, {column_list}) '
+              f'VALUES (new.id, {new_values});')
+    delete = (f'INSERT INTO "{fts}"("{fts}", rowid, {column_list}) '
+              f"VALUES ('delete', old.id, {old_values});")
+
+    return [
+        f'CREATE VIRTUAL TABLE "{fts}" USING fts5({column_list}, '
+        f"content='{table_name}', content_rowid='id', "
+        f"tokenize='porter unicode61')",
+        f'CREATE TRIGGER "{fts}_insert" AFTER INSERT ON "{table_name}" '
+        f'BEGIN {insert} END',
+        f'CREATE TRIGGER "{fts}_delete" AFTER DELETE ON "{table_name}" '
+        f'BEGIN {delete} END',
+        f'CREATE TRIGGER "{fts}_update" AFTER UPDATE ON "{table_name}" '
+        f'BEGIN {delete} {insert} END',
+    ]
+
+
+# create search objects along with the tables in db.create_all()
+for model, (kind, columns) in SEARCH_TABLES.items():
+    for statement in postgres_ddl(model.__tablename__, columns):
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement).execute_if(dialect='postgresql'))
+    for statement in sqlite_ddl(model.__tablename__, columns):
+        event.listen(model.__table__, 'after_create',
+                     DDL(statement).execute_if(dialect='sqlite'))
+
+
+def postgres_matches(q):
+    # one select per table: result type, row id and rank
+    tsquery = func.websearch_to_tsquery(TEXT_SEARCH_CONFIG, q)
+
+    selects = []
+    for model, (kind, columns) in SEARCH_TABLES.items():
+        searched = model.__table__
+        vector = literal_column(f'"{searched.name}".search_vector')
+
+        selects.append(select([
+            literal(kind).label('kind'),
+            searched.c.id.label('id'),
+            # double precision so cursors round trip exactly
+            cast(func.ts_rank(vector, tsquery), Float).label('rank')
+        ]).where(vector.op('@@')(tsquery)))
+
+    return selects
+
+
+def sqlite_matches(q):
+    # quote each word so FTS5 query syntax in user input is ignored
+    words = re.findall(r'\w+', q)
+    if not words:
+        raise ValueError('empty search')
+    match = ' '.join(f'"{word}"' for word in words)
+
+    selects = []
+    for model, (kind, columns) in SEARCH_TABLES.items():
+        fts = table(f'{model.__tablename__}_fts', column('rowid', Integer))
+        fts_name = literal_column(f'"{fts.name}"')
+        weights = [bm25_weight for name, weight, bm25_weight in columns]
+
+        # bm25 is lower for better matches, negate it to rank descending
+        selects.append(select([
+            literal(kind).label('kind'),
+            fts.c.rowid.label('id'),
+            cast(-func.bm25(fts_name, *weights), Float).label('rank')
+        ]).where(fts_name.op('MATCH')(match)))
+
+    return selects
+
+
+def search_matches(session, q):
+    '''
+    search_matches(session, q)
+    returns a subquery of the plants and observations matching q, with
+    columns kind ('plant' or 'observation'), id and rank (higher is more
+    relevant). Raises ValueError if q has nothing to search for.
+    '''
+
+    if q is None or not q.strip():
+        raise ValueError('empty search')
+
+    dialect = session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        selects = postgres_matches(q)
+    elif dialect == 'sqlite':
+        selects = sqlite_matches(q)
+    else:
+        raise RuntimeError(f'search not supported on {dialect}')
+
+    return union_all(*selects).alias('matches')
+
+
+def rebuild_index(session):
+    '''
+    Rebuilds the search index from the searched tables
+    '''
+
+    dialect = session.get_bind().dialect.name
+    for model, (kind, columns) in SEARCH_TABLES.items():
+        if dialect == 'postgresql':
+            # touching a searched column fires the update trigger
+            name = columns[0][0]
+            session.execute(
+                f'UPDATE "{model.__tablename__}" SET {name} = {name}')
+        elif dialect == 'sqlite':
+            fts = f'{model.__tablename__}_fts'
+            session.execute(
+                f'INSERT INTO "{fts}"("{fts}") VALUES (\'rebuild\')')
+
+    session.commit()
@@ -0,0 +1,272 @@
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import func, text
+from bulk import copy_rows, is_postgres
+from models import db, Plant, Observation, User, add_to_rollups
+from versions import version_store, table_key, owner_key
+import geo
+
+
+'''
+Synthetic Data
+
+Fills the database with generated users, plants and observations for
+benchmarks and scale testing. The data is skewed like real survey data: a
+few plants get most observations, a few users make most of them, and
+observations follow the growing season. The same seed and sizes always
+generate the same rows on an empty database.
+
+Ids are assigned here instead of by the database, so each chunk is one
+COPY on Postgres (one executemany elsewhere) in its own transaction, and
+the id sequences are moved past the new rows at the end. Don't seed a
+database that is being written to. The search index is kept up to date by
+its triggers and the rollups are updated with each chunk.
+'''
+
+
+# rows written per transaction
+CHUNK_SIZE = 10000
+
+# seeded users have Auth0 subjects SEED_SUBJECT_PREFIX + user id
+SEED_SUBJECT_PREFIX = 'seed|'
+
+# observations fall in the YEARS years before END_DATE
+END_DATE = datetime(2020, 1, 1)
+YEARS = 3
+
+# Zipf exponents of plant popularity and user activity, higher is more
+# skewed
+PLANT_SKEW = 1.1
+USER_SKEW = 1.2
+
+# share of users with the Admin role
+ADMIN_SHARE = 0.01
+
+# share of observations with notes, and with a location
+NOTES_SHARE = 0.7
+LOCATED_SHARE = 0.5
+
+WORDS = ['aster', 'blue', 'bush', 'creeping', 'desert', 'dwarf', 'fern',
+         'golden', 'grass', 'lily', 'marsh', 'meadow', 'mint', 'moss',
+         'mountain', 'oak', 'orchid', 'pine', 'prairie', 'red', 'rose',
+         'sage', 'sedge', 'silver', 'star', 'sun', 'thistle', 'violet',
+         'white', 'wild', 'willow', 'wood']
+
+GENERA = ['Acer', 'Allium', 'Artemisia', 'Aster', 'Carex', 'Dryopteris',
+          'Erigeron', 'Helianthus', 'Iris', 'Juncus', 'Lupinus', 'Mentha',
+          'Penstemon', 'Pinus', 'Quercus', 'Rosa', 'Salix', 'Salvia',
+          'Solidago', 'Trillium', 'Viola']
+
+# Colorado survey areas observations are scattered around, as
+# (latitude, longitude, weight)
+REGIONS = [(40.01, -105.27, 5), (39.74, -104.99, 3), (40.59, -105.08, 2),
+           (38.83, -104.82, 2), (37.28, -107.88, 1), (39.06, -108.55, 1),
+           (39.48, -106.04, 1)]
+
+# spread of observations around a region center, in degrees
+REGION_SPREAD = 0.3
+
+
+class Skewed:
+    '''
+    Draws ids with Zipf-distributed frequencies. Popularity ranks are
+    shuffled so popular ids are spread over the id range.
+    '''
+
+    def __init__(self, rng, ids, exponent):
+        self.ids = list(ids)
+        rng.shuffle(self.ids)
+
+        # cumulative weights of ranks 1 to n
+        total = 0.0
+        self.cum_weights = []
+        for rank in range(1, len(self.ids) + 1):
+            total += rank ** -exponent
+            self.cum_weights.append(total)
+
+    def sample(self, rng, count):
+        return rng.choices(self.ids, cum_weights=self.cum_weights, k=count)
+
+
+# weight of each day of the year, low in winter and peaking in early
+# summer
+DAY_WEIGHTS = [0.05 + max(0.0, math.sin(math.pi * (day - 90) / 200)) ** 2
+               for day in range(365)]
+
+
+def random_dates(rng, count):
+    # seasonal observation dates, during daylight
+    days = rng.choices(range(365), weights=DAY_WEIGHTS, k=count)
+    first_year = END_DATE.year - YEARS
+    return [datetime(first_year + rng.randrange(YEARS), 1, 1)
+            + timedelta(days=day, seconds=rng.randrange(7 * 3600,
+                                                        19 * 3600))
+            for day in days]
+
+
+def random_words(rng, low, high):
+    return ' '.join(rng.choices(WORDS, k=rng.randint(low, high)))
+
+
+def user_rows(rng, first_id, count):
+    rows = []
+    for id in range(first_id, first_id + count):
+        rows.append([f'Seed User {id}', f'seed{id}',
+                     f'{SEED_SUBJECT_PREFIX}{id}',
+                     END_DATE - timedelta(days=rng.randrange(YEARS * 365)),
+                     'Admin' if rng.random() < ADMIN_SHARE else 'Public'])
+
+    return rows
+
+
+def plant_rows(rng, count, users):
+    rows = []
+    for user_id in users.sample(rng, count):
+        latin_name = rng.choice(GENERA) + ' ' + rng.choice(WORDS) + 'ia'
+        rows.append([user_id, random_words(rng, 1, 3).capitalize(),
+                     latin_name,
+                     random_words(rng, 10, 40).capitalize() + '.',
+                     f'https://example.com/plants/{rng.randrange(10 ** 6)}'
+                     '.jpg'])
+
+    return rows
+
+
+def observation_rows(rng, count, users, plants):
+    centers = rng.choices(REGIONS, weights=[region[2] for region in REGIONS],
+                          k=count)
+    rows = []
+    for user_id, plant_id, date, (latitude, longitude, weight) in zip(
+            users.sample(rng, count), plants.sample(rng, count),
+            random_dates(rng, count), centers):
+        notes = None
+        if rng.random() < NOTES_SHARE:
+            notes = random_words(rng, 3, 20)
+
+        location = [None, None, None, None]
+        if rng.random() < LOCATED_SHARE:
+            latitude += rng.gauss(0, REGION_SPREAD)
+            longitude += rng.gauss(0, REGION_SPREAD)
+            location = [latitude, longitude, round(rng.uniform(3, 50), 1),
+                        geo.encode(latitude, longitude)]
+
+        rows.append([user_id, date, plant_id, notes] + location)
+
+    return rows
+
+
+def next_id(table):
+    return (db.session.query(func.max(table.c.id)).scalar() or 0) + 1
+
+
+def write_rows(table, columns, first_id, rows):
+    '''
+    write_rows(table, columns, first_id, rows)
+    writes rows with ids first_id, first_id + 1, ... in the session's
+    transaction
+    '''
+
+    if is_postgres(db.session):
+        copy_rows(db.session, table, ['id'] + columns,
+                  [[id] + row for id, row in enumerate(rows, first_id)])
+    else:
+        db.session.execute(table.insert(), [
+            dict(zip(columns, row), id=id)
+            for id, row in enumerate(rows, first_id)])
+
+
+def sync_sequence(table):
+    # move the id sequence past ids written by write_rows
+    if is_postgres(db.session):
+        db.session.execute(text(
+            f"SELECT setval(pg_get_serial_sequence(:table, 'id'), "
+            f'coalesce(max(id), 0) + 1, false) FROM "{table.name}"'),
+            {'table': f'"{table.name}"'})
+
+
+def seed_table(model, columns, count, make_rows, chunk_size, progress):
+    # write count rows generated by make_rows(first id, count) in chunks
+    # and return their id range
+    table = model.__table__
+    first_id = next_id(table)
+    start = time.perf_counter()
+
+    for offset in range(0, count, chunk_size):
+        rows = make_rows(first_id + offset, min(chunk_size, count - offset))
+        try:
+            write_rows(table, columns, first_id + offset, rows)
+            if model is Observation:
+                add_to_rollups([(row[2], row[1]) for row in rows])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        if progress is not None:
+            progress(table.name, offset + len(rows), count,
+                     time.perf_counter() - start)
+
+    sync_sequence(table)
+    if is_postgres(db.session):
+        # refresh planner statistics for the new rows
+        db.session.execute(f'ANALYZE "{table.name}"')
+    db.session.commit()
+
+    return range(first_id, first_id + count)
+
+
+def seed_database(users, plants, observations, seed=0,
+                  chunk_size=CHUNK_SIZE, progress=None):
+    '''
+    seed_database(users, plants, observations, seed=0)
+    adds the given numbers of generated rows and returns the id ranges of
+    the new users, plants and observations. progress, if given, is called
+    after each chunk with (table name, rows written, rows total, seconds).
+    '''
+
+    if plants and not users or observations and not plants:
+        raise ValueError('plants need users and observations need plants')
+
+    rng = random.Random(seed)
+
+    user_ids = seed_table(
+        User, ['name', 'username', 'user_id', 'date_added', 'role'],
+        users, lambda first_id, count: user_rows(rng, first_id, count),
+        chunk_size, progress)
+    active_users = Skewed(rng, user_ids, USER_SKEW)
+
+    plant_ids = seed_table(
+        Plant, ['user_id', 'name', 'latin_name', 'description',
+                'image_link'],
+        plants, lambda first_id, count: plant_rows(rng, count, active_users),
+        chunk_size, progress)
+    hot_plants = Skewed(rng, plant_ids, PLANT_SKEW)
+
+    observation_ids = seed_table(
+        Observation, ['user_id', 'date', 'plant_id', 'notes', 'latitude',
+                      'longitude', 'accuracy', 'geohash'],
+        observations,
+        lambda first_id, count: observation_rows(rng, count, active_users,
+                                                 hot_plants),
+        chunk_size, progress)
+
+    # expire cached listings, the suggest index and dashboards
+    version_store.bump(table_key(User.__tablename__),
+                       table_key(Plant.__tablename__),
+                       table_key(Observation.__tablename__),
+                       *[owner_key(id) for id in user_ids])
+
+    return user_ids, plant_ids, observation_ids
+
+
+def first_seeded_subject():
+    '''
+    Returns the Auth0 subject of the first seeded user, or None if the
+    database wasn't seeded
+    '''
+
+    return db.session.query(User.user_id) \
+        .filter(User.user_id.like(SEED_SUBJECT_PREFIX + '%')) \
+        .order_by(User.id).limit(1).scalar()
@@ -0,0 +1,641 @@
+import math
+from datetime import datetime, timezone
+from sqlalchemy import and_, or_, text
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from werkzeug.http import parse_date
+from models import (db, Plant, Observation, User, ObservationRollup,
+                    ROLLUP_PERIODS, add_to_rollups, plants_query,
+                    observations_query, format_plants,
+                    format_plant_observations, format_datetime,
+                    PLANT_FIELDS, OBSERVATION_FIELDS)
+from pagination import DEFAULT_LIMIT, order_by_key, paginate
+from cache import cached, LRUCacheBackend, MISSING
+from versions import version_store, table_key, row_key, owner_key
+from bulk import insert_rows, is_postgres
+from search import search_matches
+import geo
+from suggest import (plant_suggestions, DEFAULT_SUGGESTIONS,
+                     MAX_SUGGESTIONS)
+
+
+'''
+Services
+
+Queries shared by the API and page routes. Services return plain Python
+structures, so JSON encoding only happens in the API routes. Malformed
+cursors raise ValueError, missing rows return None.
+
+Results of the get_* services are cached, keyed on the version counters
+of the tables and rows they read.
+'''
+
+
+# rows fetched per round trip when streaming listings
+STREAM_BATCH_SIZE = 500
+
+# most observations and (decompressed) bytes accepted in one bulk request
+MAX_BULK_OBSERVATIONS = 10000
+MAX_BULK_BODY_SIZE = 50 * 1024 * 1024
+
+
+# most Auth0 subjects kept in the per-process user id cache
+USER_ID_CACHE_SIZE = 4096
+
+
+# sort keys for plant and observation listings
+PLANT_KEY = [Plant.id]
+OBSERVATION_KEY = [Observation.date, Observation.id]
+
+
+def parse_fields(fields, allowed):
+    '''
+    Parses a comma separated fields parameter into a sorted tuple.
+    Returns None (all fields) if not given, raises ValueError on unknown
+    fields.
+    '''
+
+    if fields is None:
+        return None
+
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    if not names:
+        return None
+
+    if not names <= set(allowed):
+        raise ValueError('unknown field')
+
+    return tuple(sorted(names))
+
+
+def parse_plant_fields(fields, include):
+    '''
+    Parses the fields and include parameters of plant requests into plant
+    fields and whether to embed observations. Without either parameter
+    plants are returned in full with their observations.
+    '''
+
+    fields = parse_fields(fields, PLANT_FIELDS)
+
+    # observations embedded by default unless fields were picked
+    if include is None:
+        return fields, fields is None
+
+    names = {name.strip() for name in include.split(',') if name.strip()}
+    if not names <= {'observations'}:
+        raise ValueError('unknown include')
+
+    return fields, 'observations' in names
+
+
+def parse_observation_fields(fields):
+    '''
+    Parses the fields parameter of observation requests
+    '''
+
+    return parse_fields(fields, OBSERVATION_FIELDS)
+
+
+# version keys of plant and observation listings
+def listing_keys(*args, **kwargs):
+    return [table_key(Plant.__tablename__),
+            table_key(Observation.__tablename__)]
+
+
+@cached(listing_keys)
+def get_plants_page(cursor=None, limit=DEFAULT_LIMIT, fields=None,
+                    include_observations=True):
+    '''
+    Returns a page of formatted plants ordered by id, and the next cursor.
+    Only the given fields are loaded, and observations only if included.
+    '''
+
+    query = plants_query(fields, include_observations)
+    plants, next_cursor = paginate(query, PLANT_KEY,
+                                   cursor=cursor, limit=limit)
+
+    return format_plants(plants, fields, include_observations), next_cursor
+
+
+def iter_plants(cursor=None, fields=None, include_observations=True):
+    '''
+    Yields formatted plants ordered by id, starting after cursor.
+    Rows are read from a server-side cursor in batches, so memory use
+    doesn't grow with the table.
+    '''
+
+    query = order_by_key(plants_query(fields, include_observations),
+                         PLANT_KEY, cursor=cursor)
+
+    for plant in query.yield_per(STREAM_BATCH_SIZE):
+        yield plant.format(fields, include_observations)
+
+
+@cached(lambda id, **kwargs: [row_key(Plant.__tablename__, id)])
+def get_plant(id, fields=None, include_observations=True):
+    '''
+    Returns formatted plant by id, or None if not found
+    '''
+
+    query = plants_query(fields, include_observations)
+    plant = query.filter_by(id=id).one_or_none()
+
+    if plant is None:
+        return None
+
+    return plant.format(fields, include_observations)
+
+
+def parse_observation_area(bbox, near, radius):
+    '''
+    Parses the bbox, or near and radius, parameters of observation
+    listings into an area: ('bbox', south, west, north, east) or
+    ('near', latitude, longitude, radius). Returns None if neither is
+    given, raises ValueError if malformed or both are given.
+    '''
+
+    if bbox is not None and near is not None:
+        raise ValueError('bbox and near are exclusive')
+
+    if bbox is not None:
+        return ('bbox',) + geo.parse_bbox(bbox)
+
+    if near is not None:
+        return ('near',) + geo.parse_near(near, radius)
+
+    return None
+
+
+def filter_area(query, area, postgis=None):
+    '''
+    filter_area(query, area)
+    filters an observation query to located observations inside area,
+    using the PostGIS index if installed, otherwise geohash ranges.
+    postgis is looked up on the session's database if not given.
+    '''
+
+    if area is None:
+        return query
+
+    kind, *values = area
+    if kind == 'near':
+        latitude, longitude, radius = values
+        south, west, north, east = geo.near_bbox(latitude, longitude, radius)
+    else:
+        south, west, north, east = values
+
+    # exact bounds, checked on the rows the index finds
+    query = query.filter(Observation.latitude.between(south, north),
+                         Observation.longitude.between(west, east))
+
+    if postgis is None:
+        postgis = geo.has_postgis(db.session)
+
+    if postgis:
+        if kind == 'near':
+            return query.filter(text(
+                f'ST_DWithin({geo.POSTGIS_LOCATION}, ST_SetSRID('
+                f'ST_MakePoint(:longitude, :latitude), 4326)::geography, '
+                f':radius)').bindparams(
+                    latitude=latitude, longitude=longitude, radius=radius))
+
+        return query.filter(text(
+            f'{geo.POSTGIS_LOCATION} && ST_MakeEnvelope('
+            f':west, :south, :east, :north, 4326)::geography').bindparams(
+                south=south, west=west, north=north, east=east))
+
+    # one geohash index range per covering cell
+    query = query.filter(or_(*[
+        and_(Observation.geohash >= prefix,
+             Observation.geohash < prefix + geo.END_OF_PREFIX)
+        for prefix in geo.cover(south, west, north, east)]))
+
+    if kind == 'near':
+        # distance on a plane tangent at the center, in degrees of latitude
+        x = (Observation.longitude - longitude) * \
+            math.cos(math.radians(latitude))
+        y = Observation.latitude - latitude
+        query = query.filter(
+            x * x + y * y <= (radius / geo.METERS_PER_DEGREE) ** 2)
+
+    return query
+
+
+@cached(listing_keys)
+def get_observations_page(cursor=None, limit=DEFAULT_LIMIT, fields=None,
+                          area=None):
+    '''
+    Returns a page of formatted observations, newest first, and the next
+    cursor. If area is given only observations inside it are returned.
+    '''
+
+    observations, next_cursor = paginate(
+        filter_area(observations_query(fields), area), OBSERVATION_KEY,
+        cursor=cursor, limit=limit, descending=True)
+
+    return format_plant_observations(observations, fields), next_cursor
+
+
+def iter_observations(cursor=None, fields=None, area=None):
+    '''
+    Yields formatted observations, newest first, starting after cursor.
+    Rows are read from a server-side cursor in batches.
+    '''
+
+    query = order_by_key(filter_area(observations_query(fields), area),
+                         OBSERVATION_KEY, cursor=cursor, descending=True)
+
+    for observation in query.yield_per(STREAM_BATCH_SIZE):
+        yield observation.format(fields)
+
+
+@cached(lambda id, **kwargs: [row_key(Observation.__tablename__, id),
+                              table_key(Plant.__tablename__)])
+def get_observation(id, fields=None):
+    '''
+    Returns formatted observation by id, or None if not found
+    '''
+
+    observation = observations_query(fields).filter_by(id=id).one_or_none()
+
+    if observation is None:
+        return None
+
+    return observation.format(fields)
+
+
+# plant columns read without loading Plant objects
+def plant_rows_query():
+    return db.session.query(
+        Plant.id, Plant.user_id, Plant.name, Plant.latin_name,
+        Plant.description, Plant.image_link)
+
+
+# observation columns read with the plant name and image joined in
+def observation_rows_query():
+    return db.session.query(
+        Observation.id, Observation.user_id, Observation.date,
+        Observation.plant_id, Observation.notes, Observation.latitude,
+        Observation.longitude, Observation.accuracy,
+        Plant.name.label('plant_name'),
+        Plant.image_link.label('plant_image')) \
+        .join(Plant, Plant.id == Observation.plant_id)
+
+
+# format observation rows like Observation.format()
+def format_observation_rows(observations):
+    formatted = []
+    for observation in observations:
+        data = observation._asdict()
+        data['datetime'] = observation.date
+        data['date'] = format_datetime(observation.date)
+        formatted.append(data)
+
+    return formatted
+
+
+# version keys of a user's dashboard. Plant changes by anyone show up in
+# the names and images of the user's observations.
+def dashboard_keys(user_id):
+    return [owner_key(user_id), table_key(Plant.__tablename__)]
+
+
+@cached(dashboard_keys)
+def get_dashboard(user_id):
+    '''
+    Returns the formatted plants and observations added by a user.
+    Reads plant and observation columns directly, with plant names and
+    images joined in, so the whole dashboard takes two queries.
+    '''
+
+    plants = plant_rows_query() \
+        .filter(Plant.user_id == user_id) \
+        .order_by(Plant.id)
+
+    observations = observation_rows_query() \
+        .filter(Observation.user_id == user_id) \
+        .order_by(Observation.date.desc(), Observation.id.desc())
+
+    return ([plant._asdict() for plant in plants],
+            format_observation_rows(observations))
+
+
+@cached(listing_keys)
+def search(q, cursor=None, limit=DEFAULT_LIMIT):
+    '''
+    Returns a page of plants and observations matching q, most relevant
+    first, and the next cursor. Raises ValueError if q is empty or the
+    cursor is malformed.
+    '''
+
+    matches = search_matches(db.session, q)
+    query = db.session.query(matches.c.kind, matches.c.id, matches.c.rank)
+    page, next_cursor = paginate(
+        query, [matches.c.rank, matches.c.kind, matches.c.id],
+        cursor=cursor, limit=limit, descending=True)
+
+    # load matched plants and observations, one query each
+    plant_ids = [match.id for match in page if match.kind == 'plant']
+    observation_ids = [match.id for match in page
+                       if match.kind == 'observation']
+
+    rows = {'plant': {}, 'observation': {}}
+    if plant_ids:
+        rows['plant'] = {plant.id: plant._asdict() for plant in
+                         plant_rows_query().filter(Plant.id.in_(plant_ids))}
+    if observation_ids:
+        observations = observation_rows_query().filter(
+            Observation.id.in_(observation_ids))
+        rows['observation'] = {observation['id']: observation for observation
+                               in format_observation_rows(observations)}
+
+    # return matches in rank order
+    results = []
+    for match in page:
+        results.append({
+            'type': match.kind,
+            'id': match.id,
+            'rank': match.rank,
+            match.kind: rows[match.kind].get(match.id)
+        })
+
+    return results, next_cursor
+
+
+def parse_suggest_limit(limit):
+    '''
+    Parses the limit of plant suggestions, capped at MAX_SUGGESTIONS.
+    Raises ValueError if malformed.
+    '''
+
+    if limit is None:
+        return DEFAULT_SUGGESTIONS
+
+    limit = int(limit)
+    if limit < 1:
+        raise ValueError('limit must be positive')
+
+    return min(limit, MAX_SUGGESTIONS)
+
+
+def suggest_plants(prefix, limit=DEFAULT_SUGGESTIONS):
+    '''
+    Returns plants with a name or latin name word starting with prefix,
+    from the in-memory index. The index is loaded with one query when it
+    doesn't reflect the current Plants table version.
+    '''
+
+    version = version_store.get(table_key(Plant.__tablename__))[0]
+    if plant_suggestions.version != version:
+        rows = db.session.query(Plant.id, Plant.name, Plant.latin_name)
+        plant_suggestions.rebuild(rows, version)
+
+    return plant_suggestions.suggest(prefix, limit)
+
+
+def parse_period(period):
+    '''
+    Parses the period of a timeline, month if not given. Raises
+    ValueError if unknown.
+    '''
+
+    if period is None:
+        return 'month'
+
+    if period not in ROLLUP_PERIODS:
+        raise ValueError('unknown period')
+
+    return period
+
+
+# plant row key covers the plant's observations and so its rollups
+@cached(lambda id, **kwargs: [row_key(Plant.__tablename__, id)])
+def get_plant_timeline(id, period='month'):
+    '''
+    Returns the number of observations of a plant per week or month,
+    oldest first, with the first and last observation in each. Only
+    reads the rollups.
+    '''
+
+    rollups = ObservationRollup.query \
+        .filter_by(plant_id=id, period=period) \
+        .order_by(ObservationRollup.bucket)
+
+    return [rollup.format() for rollup in rollups]
+
+
+def parse_observation_date(value):
+    '''
+    Parses an ISO 8601 or HTTP date string into a naive UTC datetime.
+    Raises ValueError if malformed.
+    '''
+
+    if not isinstance(value, str) or value == '':
+        raise ValueError('malformed date')
+
+    try:
+        date = datetime.fromisoformat(value)
+    except ValueError:
+        # dates sent as JSON encoded datetimes use the HTTP date format
+        date = parse_date(value)
+        if date is None:
+            raise ValueError('malformed date')
+
+    if date.tzinfo is not None:
+        date = date.astimezone(timezone.utc).replace(tzinfo=None)
+
+    return date
+
+
+def parse_plant_id(value):
+    '''
+    Parses a plant id given as an integer or digit string, None if invalid
+    '''
+
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, int):
+        return value
+    if isinstance(value, str) and value.isdigit():
+        return int(value)
+
+    return None
+
+
+def bulk_create_observations(user_id, records):
+    '''
+    Validates observation records and inserts the valid ones in a single
+    transaction. Returns one result per record, in order, with the new
+    observation id or the reason it was rejected.
+    '''
+
+    # look up every referenced plant in one query
+    plant_ids = {parse_plant_id(record.get('plantID'))
+                 for record in records if isinstance(record, dict)}
+    plant_ids.discard(None)
+    existing = set()
+    if plant_ids:
+        existing = {id for (id,) in db.session.query(Plant.id)
+                    .filter(Plant.id.in_(plant_ids))}
+
+    # validate records
+    results = []
+    rows = []
+    for index, record in enumerate(records):
+        result = {'index': index, 'success': False}
+        results.append(result)
+
+        if not isinstance(record, dict):
+            result['error'] = 'observation must be an object'
+            continue
+
+        plant_id = parse_plant_id(record.get('plantID'))
+        if plant_id not in existing:
+            result['error'] = 'plant not found'
+            continue
+
+        try:
+            date = parse_observation_date(record.get('date'))
+        except ValueError:
+            result['error'] = 'invalid date'
+            continue
+
+        notes = record.get('notes')
+        if notes is not None and (not isinstance(notes, str)
+                                  or len(notes) > 2500):
+            result['error'] = 'invalid notes'
+            continue
+
+        try:
+            latitude, longitude, accuracy = geo.validate_location(
+                record.get('latitude'), record.get('longitude'),
+                record.get('accuracy'))
+        except ValueError:
+            result['error'] = 'invalid location'
+            continue
+
+        geohash = None
+        if latitude is not None:
+            geohash = geo.encode(latitude, longitude)
+
+        rows.append((result, [user_id, date, plant_id, notes, latitude,
+                              longitude, accuracy, geohash]))
+
+    # insert valid rows in one transaction
+    try:
+        ids = insert_rows(db.session, Observation.__table__,
+                          ['user_id', 'date', 'plant_id', 'notes',
+                           'latitude', 'longitude', 'accuracy', 'geohash'],
+                          [row for result, row in rows])
+        add_to_rollups([(row[2], row[1]) for result, row in rows])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    for (result, row), id in zip(rows, ids):
+        result['success'] = True
+        result['id'] = id
+
+    # expire cached reads of the new observations and their plants
+    keys = {table_key(Observation.__tablename__)}
+    keys |= {row_key(Observation.__tablename__, id) for id in ids}
+    keys |= {row_key(Plant.__tablename__, row[2]) for result, row in rows}
+    keys.add(owner_key(user_id))
+    version_store.bump(*keys)
+
+    return results
+
+
+# columns of a user loaded into the session profile
+USER_COLUMNS = ['id', 'name', 'username', 'date_added', 'role']
+
+# per-process cache of Auth0 subject -> (Users.id, user row version)
+user_ids = LRUCacheBackend(USER_ID_CACHE_SIZE)
+
+
+def remember_user_id(sub, id):
+    # store the row version so changes to the user invalidate the entry
+    version = version_store.get(row_key(User.__tablename__, id))[0]
+    user_ids.set(sub, (id, version))
+
+
+def get_user_id(sub):
+    '''
+    Returns the Users.id of an Auth0 subject, or None if not found.
+    Served from the per-process cache while the user row is unchanged.
+    Changes made by other workers are only seen when the version
+    counters are shared.
+    '''
+
+    entry = user_ids.get(sub)
+    if entry is not MISSING:
+        id, version = entry
+        if version_store.get(row_key(User.__tablename__, id))[0] == version:
+            return id
+
+    id = db.session.query(User.id).filter(User.user_id == sub).scalar()
+    if id is not None:
+        remember_user_id(sub, id)
+
+    return id
+
+
+def get_user(sub):
+    '''
+    Returns the user row of an Auth0 subject, with USER_COLUMNS, in one
+    query. Returns None if not found.
+    '''
+
+    columns = [getattr(User, name) for name in USER_COLUMNS]
+    user = db.session.query(*columns).filter(
+        User.user_id == sub).one_or_none()
+
+    if user is not None:
+        remember_user_id(sub, user.id)
+
+    return user
+
+
+def create_user(sub, name, username, role):
+    '''
+    Creates the user of an Auth0 subject and returns its row, with
+    USER_COLUMNS. If the user was created concurrently (e.g. two logins
+    racing) the existing row is returned instead.
+    '''
+
+    values = {'user_id': sub, 'name': name, 'username': username,
+              'date_added': datetime.utcnow(), 'role': role}
+    table = User.__table__
+    columns = [table.c[name] for name in USER_COLUMNS]
+
+    user = None
+    try:
+        # INSERT ... ON CONFLICT DO NOTHING returns no row on conflict
+        if is_postgres(db.session):
+            statement = pg_insert(table).values(**values) \
+                .on_conflict_do_nothing(index_elements=['user_id']) \
+                .returning(*columns)
+            user = db.session.execute(statement).first()
+            created = user is not None
+
+        # other databases raise on the unique Users.user_id index
+        else:
+            db.session.execute(table.insert().values(**values))
+            created = True
+
+        db.session.commit()
+    except IntegrityError:
+        db.session.rollback()
+        created = False
+
+    if user is None:
+        user = get_user(sub)
+
+    # expire cached reads of the users table
+    if created:
+        version_store.bump(table_key(User.__tablename__),
+                           row_key(User.__tablename__, user.id))
+        remember_user_id(sub, user.id)
+
+    return user
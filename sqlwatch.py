@@ -0,0 +1,237 @@
+import logging
+import os
+import re
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+'''
+Query Watch
+
+Opt-in detector of query patterns that hurt at scale. Statements are
+grouped per request by fingerprint (the SQL with literals and bound
+parameters normalized), and two problems are reported with the route and
+the application stack that issued the statement:
+
+* N+1: the same fingerprint executed SQL_WATCH_REPEATS times or more in
+  one request, usually a query per row of an earlier result
+* slow: a statement taking longer than SQL_WATCH_SLOW_MS milliseconds
+
+Enabled with SQL_WATCH=log, which logs problems as warnings, or
+SQL_WATCH=strict, which raises QueryProblem when the request (or a
+watching() block) ends, so tests fail on regressions. Raising at the end
+keeps the report from being swallowed by views that catch exceptions.
+'''
+
+
+# default thresholds
+DEFAULT_REPEATS = 10
+DEFAULT_SLOW_MS = 100
+
+# application frames shown in reports
+STACK_LIMIT = 8
+
+# repository root, frames outside it are library code
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+logger = logging.getLogger(__name__)
+
+# normalized away in fingerprints
+STRING = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+# %(name)s, %s, :name (but not ::type casts) and ? parameters
+PARAMETER = re.compile(r'%\(\w+\)s|%s|(?<![:\w]):\w+|\?')
+VALUE_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+VALUE_LISTS = re.compile(r'\(\?\)(?:\s*,\s*\(\?\))+')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryProblem(Exception):
+    '''
+    Raised in strict mode when a request had N+1 or slow queries
+    '''
+
+
+def fingerprint(statement):
+    '''
+    Returns statement with literals and parameters replaced by ?, IN lists
+    and multi-row VALUES collapsed and whitespace normalized, so queries
+    of the same shape share a fingerprint
+    '''
+
+    statement = STRING.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = PARAMETER.sub('?', statement)
+    statement = VALUE_LIST.sub('(?)', statement)
+    statement = VALUE_LISTS.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def application_stack():
+    # innermost application frames, without library and watcher frames
+    frames = [frame for frame in traceback.extract_stack()
+              if frame.filename.startswith(ROOT)
+              and frame.filename != os.path.abspath(__file__)
+              and 'site-packages' not in frame.filename]
+
+    return ''.join(traceback.format_list(frames[-STACK_LIMIT:]))
+
+
+class Scope:
+    '''
+    Statements seen in one request or watching() block
+    '''
+
+    def __init__(self, name, strict, repeats, slow):
+        self.name = name
+        self.strict = strict
+        self.repeats = repeats
+        self.slow = slow
+        self.counts = {}
+        self.problems = []
+
+
+class QueryWatcher:
+    '''
+    Tracks statements of the active scope of each thread
+    '''
+
+    def __init__(self):
+        self.strict = False
+        self.repeats = DEFAULT_REPEATS
+        self.slow = DEFAULT_SLOW_MS / 1000
+        self._local = threading.local()
+        self._listening = False
+        self._lock = threading.Lock()
+
+    def configure(self, strict=False, repeats=DEFAULT_REPEATS,
+                  slow_ms=DEFAULT_SLOW_MS):
+        '''
+        Sets the mode and thresholds of watched requests
+        '''
+
+        self.strict = strict
+        self.repeats = repeats
+        self.slow = slow_ms / 1000
+        self.listen()
+
+    def listen(self):
+        # engine listeners are only added once watching is used
+        with self._lock:
+            if not self._listening:
+                event.listen(Engine, 'before_cursor_execute',
+                             self.before_cursor_execute)
+                event.listen(Engine, 'after_cursor_execute',
+                             self.after_cursor_execute)
+                self._listening = True
+
+    def push(self, name, strict=None):
+        scope = Scope(name, self.strict if strict is None else strict,
+                      self.repeats, self.slow)
+        self._scopes().append(scope)
+        return scope
+
+    def pop(self):
+        '''
+        Ends the current scope, raising QueryProblem if it's strict and
+        had problems
+        '''
+
+        scope = self._scopes().pop()
+        if scope.strict and scope.problems:
+            raise QueryProblem('\n\n'.join(scope.problems))
+
+    def current(self):
+        scopes = self._scopes()
+        return scopes[-1] if scopes else None
+
+    def _scopes(self):
+        if not hasattr(self._local, 'scopes'):
+            self._local.scopes = []
+        return self._local.scopes
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        scope = self.current()
+        if scope is None:
+            return
+
+        conn.info.setdefault('sqlwatch_start', []).append(
+            time.perf_counter())
+
+        # report a repeated shape once, when it reaches the threshold
+        shape = fingerprint(statement)
+        count = scope.counts.get(shape, 0) + 1
+        scope.counts[shape] = count
+        if count == scope.repeats:
+            self.report(scope, f'N+1: statement ran {count} times', shape)
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        scope = self.current()
+        starts = conn.info.get('sqlwatch_start')
+        if scope is None or not starts:
+            return
+
+        elapsed = time.perf_counter() - starts.pop()
+        if elapsed > scope.slow:
+            self.report(scope, f'slow: statement took '
+                               f'{elapsed * 1000:.0f}ms',
+                        fingerprint(statement))
+
+    def report(self, scope, problem, shape):
+        message = (f'{problem} in {scope.name}\n    {shape}\n'
+                   f'{application_stack()}')
+        scope.problems.append(message)
+        logger.warning(message)
+
+
+# process-wide watcher, disabled unless configured
+watcher = QueryWatcher()
+
+
+@contextmanager
+def watching(name='block', strict=True):
+    '''
+    Watches the statements executed in the with block, raising
+    QueryProblem at the end in strict mode
+    '''
+
+    watcher.listen()
+    watcher.push(name, strict)
+    try:
+        yield
+    finally:
+        watcher.pop()
+
+
+def init_app(app):
+    '''
+    Watches every request of app if SQL_WATCH is 'log' or 'strict'
+    '''
+
+    mode = os.getenv('SQL_WATCH', '').lower()
+    if mode not in ('log', 'strict'):
+        return
+
+    watcher.configure(
+        strict=mode == 'strict',
+        repeats=int(os.getenv('SQL_WATCH_REPEATS', DEFAULT_REPEATS)),
+        slow_ms=float(os.getenv('SQL_WATCH_SLOW_MS', DEFAULT_SLOW_MS)))
+
+    @app.before_request
+    def watch_request():
+        route = request.url_rule.rule if request.url_rule else request.path
+        g.sqlwatch_scope = watcher.push(f'{request.method} {route}')
+
+    @app.teardown_request
+    def end_watch(error=None):
+        # streamed responses end their request after the body is sent.
+        # Skipped if an earlier before_request answered the request.
+        if g.pop('sqlwatch_scope', None) is not None:
+            watcher.pop()
@@ -0,0 +1,155 @@
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+
+'''
+Plant Name Suggestions
+
+In-memory prefix index of plant names and latin names for type-ahead.
+Every word start of a normalized name is kept in one sorted list, so a
+prefix lookup is a binary search followed by a short scan and never
+touches the database.
+
+The index is loaded from the database on first use and updated in place
+by the Plant insert/update/delete methods. It remembers the version of
+the Plants table it reflects, so writes made by other worker processes
+are picked up by reloading it.
+'''
+
+
+# number of suggestions returned by default, and at most
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+
+
+def normalize(text):
+    '''
+    Normalizes text for prefix matching: accents removed, case folded,
+    punctuation dropped and words separated by single spaces
+    '''
+
+    text = unicodedata.normalize('NFKD', text or '')
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.findall(r'\w+', text.casefold()))
+
+
+def name_terms(*names):
+    # every word start of each name, so 'beard' finds 'Harrington's
+    # beardtongue'
+    terms = set()
+    for name in names:
+        words = normalize(name).split(' ')
+        for i in range(len(words)):
+            term = ' '.join(words[i:])
+            if term:
+                terms.add(term)
+
+    return terms
+
+
+class SuggestIndex:
+    '''
+    Sorted index of (term, plant id) pairs with the names of each plant
+    '''
+
+    def __init__(self):
+        # version of the Plants table the index reflects, None until loaded
+        self.version = None
+        self._entries = []
+        self._plants = {}
+        self._lock = threading.Lock()
+
+    def rebuild(self, rows, version):
+        '''
+        Replaces the index with rows of (id, name, latin_name) read at
+        the given Plants table version
+        '''
+
+        plants = {}
+        entries = []
+        for id, name, latin_name in rows:
+            terms = name_terms(name, latin_name)
+            plants[id] = (terms, name, latin_name)
+            entries.extend((term, id) for term in terms)
+        entries.sort()
+
+        with self._lock:
+            self._plants = plants
+            self._entries = entries
+            self.version = version
+
+    def update(self, id, name, latin_name, version):
+        '''
+        Adds or replaces a plant after a write that moved the Plants table
+        to version. If other writes happened since the index was loaded
+        it is marked stale, to be reloaded on the next lookup.
+        '''
+
+        with self._lock:
+            self._remove(id)
+
+            terms = name_terms(name, latin_name)
+            self._plants[id] = (terms, name, latin_name)
+            for term in terms:
+                insort(self._entries, (term, id))
+
+            self._advance(version)
+
+    def remove(self, id, version):
+        '''
+        Removes a deleted plant, see update()
+        '''
+
+        with self._lock:
+            self._remove(id)
+            self._advance(version)
+
+    def suggest(self, prefix, limit=DEFAULT_SUGGESTIONS):
+        '''
+        Returns up to limit plants with a name or latin name word starting
+        with prefix, as dicts of id, name and latin_name
+        '''
+
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+
+        results = []
+        seen = set()
+        with self._lock:
+            # first entry at or after prefix, scan while it still matches
+            i = bisect_left(self._entries, (prefix,))
+            while i < len(self._entries) and len(results) < limit:
+                term, id = self._entries[i]
+                if not term.startswith(prefix):
+                    break
+                if id not in seen:
+                    seen.add(id)
+                    terms, name, latin_name = self._plants[id]
+                    results.append({'id': id, 'name': name,
+                                    'latin_name': latin_name})
+                i += 1
+
+        return results
+
+    def __len__(self):
+        return len(self._plants)
+
+    def _remove(self, id):
+        terms, name, latin_name = self._plants.pop(id, (set(), None, None))
+        for term in terms:
+            i = bisect_left(self._entries, (term, id))
+            del self._entries[i]
+
+    def _advance(self, version):
+        # only this write happened since the last known version
+        if self.version is not None and self.version + 1 == version:
+            self.version = version
+        else:
+            self.version = None
+
+
+# process-wide plant name index
+plant_suggestions = SuggestIndex()
@@ -1,11 +1,45 @@
 import os
+import sys
+import asyncio
 import datetime
 import unittest
 import json
+import tempfile
+import gzip
+import subprocess
+import threading
+from unittest import mock
+from flask import Response
+from flask.testing import EnvironBuilder
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine, func, text
+from sqlalchemy.orm import Query
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+# fail requests with N+1 or very slow queries
+os.environ.setdefault('SQL_WATCH', 'strict')
+os.environ.setdefault('SQL_WATCH_SLOW_MS', '1000')
 
 from app import create_app
 from models import setup_db, Plant, Observation, User
+import services
+from auth.jwks import JWKSCache
+from auth.token_cache import TokenCache
+from auth.management import ManagementClient
+from versions import (VersionStore, MemoryVersionBackend,
+                      SharedFileVersionBackend, version_store,
+                      create_backend)
+from cache import LRUCacheBackend, ReadThroughCache, cached
+from suggest import SuggestIndex
+from metrics import MetricsRegistry
+from sqlwatch import QueryProblem, fingerprint, watcher, watching
+import geo
+from asgi import ReadAPI, EngineDatabase, AsyncpgDatabase, compile_query
+from api import StreamEnvelope
 
 
 class PlantTestCase(unittest.TestCase):
@@ -149,6 +183,90 @@ class PlantTestCase(unittest.TestCase):
         # check that data returned for plants
         self.assertTrue(data['plants'])
 
+    def test_get_plants_paginated(self):
+        """Tests GET plants follows cursor to next page"""
+
+        # create two plants so there is more than one page
+        self.create_test_plant(self.ADMIN_ID)
+        self.create_test_plant(self.ADMIN_ID)
+
+        # get first page with one plant per page
+        response = self.client().get('/api/plants?limit=1')
+        data = json.loads(response.data)
+
+        # check status code and that next page link returned
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(data['plants']), 1)
+        self.assertTrue(data['next'])
+
+        # get next page and load data
+        next_response = self.client().get(data['next'])
+        next_data = json.loads(next_response.data)
+
+        # check next page continues after first page
+        self.assertEqual(next_response.status_code, 200)
+        self.assertEqual(len(next_data['plants']), 1)
+        self.assertGreater(next_data['plants'][0]['id'],
+                           data['plants'][0]['id'])
+
+    def test_get_plants_bad_cursor(self):
+        """Tests GET plants with malformed cursor"""
+
+        # get response with malformed cursor and load data
+        response = self.client().get('/api/plants?cursor=notacursor')
+        data = json.loads(response.data)
+
+        # check status code and message
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data['success'], False)
+        self.assertEqual(data['message'], 'bad request')
+
+    def test_get_plants_sparse_fields(self):
+        """Tests GET plants returns only requested fields"""
+
+        # create a new plant to ensure database isn't empty
+        self.create_test_plant(self.ADMIN_ID)
+
+        # get response with fields and load data
+        response = self.client().get('/api/plants?fields=id,name')
+        data = json.loads(response.data)
+
+        # check only requested fields returned, without observations
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(data['plants'][0].keys()), ['id', 'name'])
+
+        # check observations embedded when included
+        response = self.client().get(
+            '/api/plants?fields=id&include=observations')
+        data = json.loads(response.data)
+        self.assertIn('plant_observations', data['plants'][0])
+
+        # check unknown field is a bad request
+        response = self.client().get('/api/plants?fields=nome')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_plant_not_modified(self):
+        """Tests conditional GET plant returns 304 until plant changes"""
+
+        # create a new plant and get its ETag
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        response = self.client().get('/api/plants/{}'.format(plant_id))
+        etag = response.headers['ETag']
+
+        # check unchanged plant returns 304
+        response = self.client().get('/api/plants/{}'.format(plant_id),
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
+        # add an observation to the plant
+        self.create_test_observation(plant_id, self.PUBLIC_ID)
+
+        # check changed plant returns 200 with a new ETag
+        response = self.client().get('/api/plants/{}'.format(plant_id),
+                                     headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+
     def test_post_plant_success(self):
         """Tests POST new plant success"""
 
@@ -289,6 +407,31 @@ class PlantTestCase(unittest.TestCase):
         self.assertEqual(data['plant_name'], self.test_plant['name'])
         self.assertEqual(data['plant_id'], plant_id)
 
+    def test_delete_plant_with_observations(self):
+        """Tests DELETE plant also deletes its observations"""
+
+        # create a plant with observations
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        observation_ids = [
+            self.create_test_observation(plant_id, self.PUBLIC_ID)
+            for i in range(3)]
+
+        # get headers using ADMIN token
+        headers = self.create_auth_headers(token=self.ADMIN_ROLE_TOKEN)
+
+        # delete the plant and store response
+        response = self.client().delete('/api/plants/{}/edit'.format(plant_id),
+                                        headers=headers)
+
+        # check plant deleted
+        self.assertEqual(response.status_code, 200)
+
+        # check observations deleted with it
+        for observation_id in observation_ids:
+            response = self.client().get(
+                '/api/observations/{}'.format(observation_id))
+            self.assertEqual(response.status_code, 404)
+
     # OBSERVATION tests
 
     def test_get_observations_failure(self):
@@ -374,6 +517,64 @@ class PlantTestCase(unittest.TestCase):
         self.assertEqual(data['success'], False)
         self.assertEqual(data['message'], 'unprocessable')
 
+    def test_post_bulk_observations(self):
+        """Tests POST bulk observations with per-row results"""
+
+        # get headers using PUBLIC token
+        headers = self.create_auth_headers(token=self.PUBLIC_ROLE_TOKEN)
+
+        # create new plant for observations
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+
+        # two valid observations and one for a missing plant
+        observations = [
+            {'date': '2020-01-16 08:14:02', 'plantID': plant_id,
+             'notes': 'first'},
+            {'date': '2020-01-17 08:14:02', 'plantID': plant_id,
+             'notes': None},
+            {'date': '2020-01-18 08:14:02', 'plantID': 100000,
+             'notes': 'missing plant'}
+        ]
+
+        # get response and load data
+        response = self.client().post('/api/observations/bulk',
+                                      json=observations,
+                                      headers=headers)
+        data = json.loads(response.data)
+
+        # check valid observations created and invalid one reported
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 2)
+        self.assertTrue(data['results'][0]['id'])
+        self.assertEqual(data['results'][2]['success'], False)
+
+    def test_post_bulk_observations_gzip_ndjson(self):
+        """Tests POST bulk observations as gzipped NDJSON"""
+
+        # get headers using PUBLIC token
+        headers = self.create_auth_headers(token=self.PUBLIC_ROLE_TOKEN)
+        headers['Content-Encoding'] = 'gzip'
+
+        # create new plant for observations
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+
+        # compress one observation per line
+        lines = [json.dumps({'date': '2020-01-16 08:14:02',
+                             'plantID': plant_id, 'notes': str(i)})
+                 for i in range(3)]
+        body = gzip.compress('\n'.join(lines).encode())
+
+        # get response and load data
+        response = self.client().post('/api/observations/bulk',
+                                      data=body,
+                                      content_type='application/x-ndjson',
+                                      headers=headers)
+        data = json.loads(response.data)
+
+        # check all observations created
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 3)
+
     def test_patch_observation_success(self):
         """Tests PATCH observation success"""
 
@@ -475,6 +676,973 @@ class PlantTestCase(unittest.TestCase):
         # check status code
         self.assertEqual(response.status_code, 404)
 
+    # USER tests
+
+    def test_create_user_once(self):
+        """Tests creating an existing user returns the existing row"""
+
+        sub = 'auth0|' + os.urandom(8).hex()
+
+        with self.app.app_context():
+            # create user twice
+            first = services.create_user(sub, 'Test', 'test', 'Public')
+            second = services.create_user(sub, 'Test', 'test', 'Public')
+
+            # check only one row created, and its id is cached
+            self.assertEqual(first.id, second.id)
+            self.assertEqual(User.query.filter_by(user_id=sub).count(), 1)
+            self.assertEqual(services.get_user_id(sub), first.id)
+
+            # check deleting the user invalidates the cached id
+            User.query.get(first.id).delete()
+            self.assertIsNone(services.get_user_id(sub))
+
+    def test_dashboard_invalidated_by_user_writes(self):
+        """Tests cached dashboard changes when user adds an observation"""
+
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+
+        with self.app.app_context():
+            # load dashboard, then add an observation
+            plants, observations = services.get_dashboard(self.PUBLIC_ID)
+            observation_id = self.create_test_observation(plant_id,
+                                                          self.PUBLIC_ID)
+            plants, observations = services.get_dashboard(self.PUBLIC_ID)
+
+        # check new observation shown with its plant name
+        observation = [observation for observation in observations
+                       if observation['id'] == observation_id][0]
+        self.assertEqual(observation['plant_name'], self.test_plant['name'])
+
+    def test_dashboard_in_new_process(self):
+        """Tests dashboard loads in a process that hasn't queried yet"""
+
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        self.create_test_observation(plant_id, self.PUBLIC_ID)
+
+        # load dashboard and search as the first queries of a new worker
+        script = (
+            'import sys\n'
+            'from app import create_app\n'
+            'from models import setup_db\n'
+            'import services\n'
+            'app = create_app()\n'
+            'setup_db(app, sys.argv[1])\n'
+            'with app.app_context():\n'
+            '    plants, observations = services.get_dashboard(\n'
+            '        int(sys.argv[2]))\n'
+            '    services.search(sys.argv[3])\n'
+            '    print(len(observations))\n')
+        result = subprocess.run(
+            [sys.executable, '-c', script, self.database_path,
+             str(self.PUBLIC_ID), self.test_plant['name']],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True)
+
+        # check queries succeeded and found the observation
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertGreaterEqual(int(result.stdout.split()[-1]), 1)
+
+    def test_get_observations_in_area(self):
+        """Tests GET observations filtered by bbox and near"""
+
+        # create observations inside and outside Boulder
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        now = datetime.datetime.now()
+        inside = Observation(user_id=self.PUBLIC_ID, date=now,
+                             plant_id=plant_id, notes='inside',
+                             latitude=40.015, longitude=-105.27, accuracy=5)
+        inside.insert()
+        outside = Observation(user_id=self.PUBLIC_ID, date=now,
+                              plant_id=plant_id, notes='outside',
+                              latitude=39.74, longitude=-104.99)
+        outside.insert()
+
+        for query in ['bbox=-105.3,40.0,-105.2,40.1',
+                      'near=40.0151,-105.2701&radius=100']:
+            response = self.client().get('/api/observations?' + query)
+            data = json.loads(response.data)
+
+            # check only the observation inside the area returned
+            self.assertEqual(response.status_code, 200)
+            ids = [observation['id'] for observation in data['observations']]
+            self.assertIn(inside.id, ids)
+            self.assertNotIn(outside.id, ids)
+
+    def test_get_observations_bad_area(self):
+        """Tests GET observations with malformed bbox"""
+
+        response = self.client().get('/api/observations?bbox=1,2,3')
+
+        # check status code
+        self.assertEqual(response.status_code, 400)
+
+    # STATS tests
+
+    def test_plant_timeline_follows_observation_writes(self):
+        """Tests GET plant timeline counts reflect inserts and deletes"""
+
+        # create two observations in the same month
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        observations = []
+        for day in [3, 20]:
+            observation = Observation(
+                user_id=self.PUBLIC_ID, plant_id=plant_id, notes='',
+                date=datetime.datetime(2020, 6, day, 12))
+            observation.insert()
+            observations.append(observation.id)
+
+        # check month counted twice, then once after a delete
+        url = '/api/stats/plants/{}/timeline'.format(plant_id)
+        data = json.loads(self.client().get(url).data)
+        self.assertEqual(data['timeline'][0]['bucket'], '2020-06-01')
+        self.assertEqual(data['timeline'][0]['count'], 2)
+
+        Observation.query.get(observations[0]).delete()
+        data = json.loads(self.client().get(url + '?period=month').data)
+        self.assertEqual(data['timeline'][0]['count'], 1)
+        self.assertEqual(data['timeline'][0]['first_seen'],
+                         'Sat, 20 Jun 2020 12:00:00 GMT')
+
+        # check weekly timeline has a bucket starting on Monday
+        data = json.loads(self.client().get(url + '?period=week').data)
+        self.assertEqual(data['timeline'][0]['bucket'], '2020-06-15')
+
+    def test_plant_timeline_follows_observation_edits(self):
+        """Tests PATCH observation moves it between timeline buckets"""
+
+        # create observation in June
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        observation = Observation(
+            user_id=self.PUBLIC_ID, plant_id=plant_id, notes='',
+            date=datetime.datetime(2020, 6, 3, 12))
+        observation.insert()
+        id = observation.id
+
+        # move observation to August and load timeline
+        response = self.client().patch(
+            '/api/observations/{}/edit'.format(id),
+            json={'date': '2020-08-10 12:00:00', 'notes': 'moved'},
+            headers=self.create_auth_headers(token=self.PUBLIC_ROLE_TOKEN))
+        self.assertEqual(response.status_code, 200)
+
+        url = '/api/stats/plants/{}/timeline?period=month'.format(plant_id)
+        data = json.loads(self.client().get(url).data)
+
+        # check observation only counted once, in its new month
+        self.assertEqual(
+            [(bucket['bucket'], bucket['count'])
+             for bucket in data['timeline']],
+            [('2020-08-01', 1)])
+
+    # SEARCH tests
+
+    def test_search(self):
+        """Tests GET search finds plant by name"""
+
+        # create plant with a unique word in its name
+        word = 'columbine' + os.urandom(4).hex()
+        plant = Plant(user_id=self.ADMIN_ID, name='Blue ' + word,
+                      latin_name='Aquilegia', description='Test plant',
+                      image_link='test.jpg')
+        plant.insert()
+
+        # search for the word and load data
+        response = self.client().get('/api/search?q={}'.format(word))
+        data = json.loads(response.data)
+
+        # check plant is the top result
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['results'][0]['type'], 'plant')
+        self.assertEqual(data['results'][0]['id'], plant.id)
+
+    def test_search_without_query(self):
+        """Tests GET search without search terms fails"""
+
+        response = self.client().get('/api/search')
+
+        # check status code
+        self.assertEqual(response.status_code, 400)
+
+    def test_metrics(self):
+        """Tests GET metrics reports requests by route"""
+
+        # requests are recorded once the response is closed
+        client = self.client()
+        client.get('/api/plants').close()
+        response = client.get('/metrics')
+        text = response.get_data(as_text=True)
+
+        # check status code and request counted under route template
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', text)
+        self.assertIn('http_requests_total{method="GET",route="/api/plants"',
+                      text)
+        self.assertIn('http_request_db_statements_total{method="GET",'
+                      'route="/api/plants"}', text)
+
+
+class JWKSCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        """Write a local JWKS file and create cache with a fake clock."""
+        self.now = 0
+        self.jwks_file = tempfile.NamedTemporaryFile('w', suffix='.json',
+                                                     delete=False)
+        self.jwks_file.close()
+        self.write_keys('kid-1')
+        self.cache = JWKSCache('file://' + self.jwks_file.name,
+                               default_ttl=60, stale_ttl=60,
+                               min_refetch_interval=10,
+                               clock=lambda: self.now)
+
+    def tearDown(self):
+        """Executed after reach test"""
+        os.remove(self.jwks_file.name)
+
+    # writes JWKS file containing the given key ids
+    def write_keys(self, *kids):
+        keys = [{'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'n', 'e': 'e'}
+                for kid in kids]
+        with open(self.jwks_file.name, 'w') as f:
+            json.dump({'keys': keys}, f)
+
+    def test_keys_cached(self):
+        """Tests keys are fetched once while fresh"""
+
+        # look up key twice
+        self.assertEqual(self.cache.get_key('kid-1')['kid'], 'kid-1')
+        self.assertEqual(self.cache.get_key('kid-1')['kid'], 'kid-1')
+
+        # check JWKS only fetched once
+        self.assertEqual(self.cache.fetch_count, 1)
+
+    def test_unknown_kid_refetched_once(self):
+        """Tests unknown kid triggers a single rate limited refetch"""
+
+        # load keys, then rotate in a new key
+        self.cache.get_key('kid-1')
+        self.write_keys('kid-1', 'kid-2')
+
+        # refetch not allowed right after a fetch
+        self.assertIsNone(self.cache.get_key('kid-2'))
+        self.assertEqual(self.cache.fetch_count, 1)
+
+        # unknown kid refetches once the interval has passed
+        self.now = 10
+        self.assertEqual(self.cache.get_key('kid-2')['kid'], 'kid-2')
+        self.assertIsNone(self.cache.get_key('kid-3'))
+        self.assertEqual(self.cache.fetch_count, 2)
+
+    def test_expired_keys_refetched(self):
+        """Tests keys past their stale window are refetched"""
+
+        # load keys, then let them expire completely
+        self.cache.get_key('kid-1')
+        self.write_keys('kid-2')
+        self.now = 121
+
+        # check new keys are fetched before answering
+        self.assertIsNone(self.cache.get_key('kid-1'))
+        self.assertEqual(self.cache.get_key('kid-2')['kid'], 'kid-2')
+
+
+class TokenCacheTestCase(unittest.TestCase):
+    """This class represents the verified token cache test case"""
+
+    def setUp(self):
+        """Create cache with a fake clock."""
+        self.now = 1000
+        self.cache = TokenCache(maxsize=2, max_age=300,
+                                clock=lambda: self.now)
+
+    def test_hit_and_miss(self):
+        """Tests cached payload returned and counted"""
+
+        # miss before token is cached
+        self.assertIsNone(self.cache.get('token'))
+
+        # hit after token is cached
+        self.cache.set('token', {'sub': 'user', 'exp': 1100}, kid='kid-1')
+        self.assertEqual(self.cache.get('token')['sub'], 'user')
+
+        # check counters
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_expires_at_exp(self):
+        """Tests entries expire at the token exp claim"""
+
+        self.cache.set('token', {'sub': 'user', 'exp': 1100})
+
+        # check entry gone once exp reached
+        self.now = 1100
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_rotated_kid_and_invalidate(self):
+        """Tests entries dropped when key rotated out or invalidated"""
+
+        self.cache.set('token', {'sub': 'user', 'exp': 1100}, kid='kid-1')
+        self.cache.set('other', {'sub': 'user', 'exp': 1100}, kid='kid-1')
+
+        # check entry dropped when its kid is no longer valid
+        self.assertIsNone(self.cache.get('token', valid_kids={'kid-2'}))
+
+        # check entry dropped when invalidated
+        self.cache.invalidate('other')
+        self.assertIsNone(self.cache.get('other'))
+
+    def test_lru_eviction(self):
+        """Tests least recently used entry evicted when full"""
+
+        self.cache.set('first', {'exp': 1100})
+        self.cache.set('second', {'exp': 1100})
+
+        # use first token so second is least recently used
+        self.cache.get('first')
+        self.cache.set('third', {'exp': 1100})
+
+        # check second token evicted
+        self.assertIsNone(self.cache.get('second'))
+        self.assertIsNotNone(self.cache.get('first'))
+        self.assertIsNotNone(self.cache.get('third'))
+
+
+class FakeResponse:
+    """Response of the fake management API session"""
+
+    def __init__(self, status_code, data=None):
+        self.status_code = status_code
+        self.data = data
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception('HTTP {}'.format(self.status_code))
+
+
+class FakeSession:
+    """Records management API calls and answers them from a script"""
+
+    def __init__(self, statuses=None):
+        self.statuses = list(statuses or [])
+        self.token_fetches = 0
+        self.requests = []
+
+    def post(self, url, data, timeout):
+        self.token_fetches += 1
+        return FakeResponse(200, {
+            'access_token': 'token-{}'.format(self.token_fetches),
+            'expires_in': 3600})
+
+    def request(self, method, url, headers, timeout, **kwargs):
+        self.requests.append((method, url, headers['Authorization']))
+        status = self.statuses.pop(0) if self.statuses else 200
+        return FakeResponse(status, {'user_id': 'auth0|1'})
+
+
+class ManagementClientTestCase(unittest.TestCase):
+    """This class represents the Auth0 management API client test case"""
+
+    def setUp(self):
+        """Create client with a fake session and clock."""
+        self.now = 1000
+        self.client = ManagementClient('tenant.invalid', 'id', 'secret',
+                                       leeway=60, clock=lambda: self.now)
+        self.session = FakeSession()
+        self.client.session = self.session
+
+    def test_pooled_session(self):
+        """Tests calls share a session with a connection pool"""
+
+        client = ManagementClient('tenant.invalid', 'id', 'secret',
+                                  pool_maxsize=7)
+
+        # check HTTPS requests go through the pooled adapter
+        adapter = client.session.get_adapter('https://tenant.invalid/')
+        self.assertEqual(adapter._pool_maxsize, 7)
+
+    def test_token_reused_until_expiry(self):
+        """Tests token fetched once, then again once expired"""
+
+        # several calls while token is fresh
+        for i in range(3):
+            self.client.get_user('auth0|1')
+        self.assertEqual(self.session.token_fetches, 1)
+
+        # check token still used just before leeway
+        self.now = 1000 + 3600 - 61
+        self.client.get_user('auth0|1')
+        self.assertEqual(self.session.token_fetches, 1)
+
+        # check new token fetched once within leeway of expiry
+        self.now = 1000 + 3600 - 60
+        self.client.get_user('auth0|1')
+        self.assertEqual(self.session.token_fetches, 2)
+        self.assertEqual(self.session.requests[-1][2], 'Bearer token-2')
+
+    def test_clear_token(self):
+        """Tests cleared token is fetched again"""
+
+        self.client.get_token()
+        self.client.clear_token()
+
+        # check new token fetched
+        self.assertEqual(self.client.get_token(), 'token-2')
+
+    def test_retry_once_after_unauthorized(self):
+        """Tests a 401 is retried once with a new token"""
+
+        # first call revoked, retry succeeds
+        self.session.statuses = [401, 200]
+        self.assertEqual(self.client.get_user('auth0|1')['user_id'],
+                         'auth0|1')
+        self.assertEqual(
+            [auth for method, url, auth in self.session.requests],
+            ['Bearer token-1', 'Bearer token-2'])
+
+        # check second 401 not retried again
+        self.session.statuses = [401, 401, 200]
+        with self.assertRaises(Exception):
+            self.client.assign_roles('auth0|1', ['role'])
+        self.assertEqual(len(self.session.requests), 4)
+        self.assertEqual(self.session.statuses, [200])
+
+    def test_stats(self):
+        """Tests calls counted and timed per call name"""
+
+        observed = []
+        self.client.observer = lambda name, seconds: observed.append(name)
+
+        self.client.get_user('auth0|1')
+        self.client.get_user('auth0|1')
+        self.client.assign_roles('auth0|1', ['role'])
+
+        # check counters per call name, token fetch included
+        stats = self.client.stats()
+        self.assertEqual(stats['token']['count'], 1)
+        self.assertEqual(stats['get_user']['count'], 2)
+        self.assertEqual(stats['assign_roles']['count'], 1)
+        self.assertGreaterEqual(stats['get_user']['max_time'], 0)
+        self.assertGreaterEqual(stats['get_user']['total_time'],
+                                stats['get_user']['max_time'])
+
+        # check observer called for each call
+        self.assertEqual(observed,
+                         ['token', 'get_user', 'get_user', 'assign_roles'])
+
+
+class VersionStoreTestCase(unittest.TestCase):
+    """This class represents the version counter test case"""
+
+    def test_etag_changes_on_bump(self):
+        """Tests ETag only changes when a dependency is bumped"""
+
+        store = VersionStore(MemoryVersionBackend())
+        etag = store.etag('/api/plants/1', 'Plants:1')
+
+        # unrelated key doesn't change ETag
+        store.bump('Plants:2')
+        self.assertEqual(store.etag('/api/plants/1', 'Plants:1'), etag)
+
+        # dependency changes ETag
+        store.bump('Plants:1')
+        self.assertNotEqual(store.etag('/api/plants/1', 'Plants:1'), etag)
+
+    def test_shared_file_backend(self):
+        """Tests counters are shared through the counters file"""
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'versions')
+
+            # two backends stand in for two worker processes
+            first = VersionStore(SharedFileVersionBackend(path, slots=64))
+            second = VersionStore(SharedFileVersionBackend(path, slots=64))
+
+            first.bump('Plants', 'Plants')
+            self.assertEqual(second.get('Plants'), [2])
+            self.assertEqual(first.etag('/api/plants', 'Plants'),
+                             second.etag('/api/plants', 'Plants'))
+
+    def test_shared_file_backend_in_forked_workers(self):
+        """Tests workers forked after opening the file don't lose bumps"""
+
+        bumps = 20000
+
+        with tempfile.TemporaryDirectory() as directory:
+            # opened before forking, like a preloaded app
+            store = VersionStore(SharedFileVersionBackend(
+                os.path.join(directory, 'versions'), slots=64))
+            start_read, start_write = os.pipe()
+
+            # workers bump the same key at the same time
+            pids = []
+            for worker in range(4):
+                pid = os.fork()
+                if pid == 0:
+                    try:
+                        os.read(start_read, 1)
+                        for i in range(bumps):
+                            store.bump('Plants')
+                    finally:
+                        os._exit(0)
+                pids.append(pid)
+
+            os.write(start_write, b'.' * len(pids))
+            for pid in pids:
+                os.waitpid(pid, 0)
+            os.close(start_read)
+            os.close(start_write)
+
+            # check every bump counted
+            self.assertEqual(store.get('Plants'), [4 * bumps])
+
+    def test_memory_backend_warns_with_several_workers(self):
+        """Tests several workers without shared counters log a warning"""
+
+        environ = {'WEB_CONCURRENCY': '4', 'VERSION_COUNTERS_PATH': '',
+                   'REDIS_URL': ''}
+        with mock.patch.dict(os.environ, environ):
+            with self.assertLogs('versions', 'WARNING'):
+                backend = create_backend()
+
+        self.assertIsInstance(backend, MemoryVersionBackend)
+
+    def test_etag_async_reads_blocking_backend_off_loop(self):
+        """Tests shared counters are read outside the event loop thread"""
+
+        threads = []
+
+        # record the thread reading the counters
+        class RecordingBackend(SharedFileVersionBackend):
+            def get_many(self, keys):
+                threads.append(threading.current_thread())
+                return super().get_many(keys)
+
+        with tempfile.TemporaryDirectory() as directory:
+            store = VersionStore(RecordingBackend(
+                os.path.join(directory, 'versions'), slots=64))
+            etag = asyncio.run(store.etag_async('/api/plants', 'Plants'))
+
+            self.assertEqual(etag, store.etag('/api/plants', 'Plants'))
+
+        self.assertIsNot(threads[0], threading.main_thread())
+
+
+class StreamEnvelopeTestCase(unittest.TestCase):
+    """This class represents the streamed listing envelope test case"""
+
+    def test_chunks_join_to_envelope(self):
+        """Tests chunks of a large listing join to one JSON envelope"""
+
+        # items big enough to fill several chunks
+        envelope = StreamEnvelope('plants')
+        chunks = []
+        for id in range(3):
+            chunk = envelope.add(json.dumps({'id': id, 'name': 'x' * 40000}))
+            if chunk is not None:
+                chunks.append(chunk)
+        chunks.append(envelope.close())
+
+        # check listing sent in pieces that decode as a whole
+        self.assertGreater(len(chunks), 1)
+        data = json.loads(''.join(chunks))
+        self.assertEqual(data['next'], None)
+        self.assertEqual([plant['id'] for plant in data['plants']],
+                         [0, 1, 2])
+
+
+class ReadThroughCacheTestCase(unittest.TestCase):
+    """This class represents the read-through cache test case"""
+
+    def test_hit_ratio_and_eviction(self):
+        """Tests cache counts hits and evicts least recently used"""
+
+        # shared backend replaced by a local stand-in
+        cache = ReadThroughCache(LRUCacheBackend(max_entries=1),
+                                 shared=LRUCacheBackend(max_entries=10))
+
+        cache.get_or_set('first', lambda: 1)
+        cache.get_or_set('second', lambda: 2)
+
+        # first evicted locally but still found in shared backend
+        self.assertEqual(cache.get_or_set('first', lambda: None), 1)
+
+        stats = cache.stats()
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_async_lookup_reads_shared_backend_off_loop(self):
+        """Tests shared backend is called outside the event loop thread"""
+
+        threads = []
+
+        # shared backend replaced by a local stand-in recording its thread
+        class RecordingBackend(LRUCacheBackend):
+            def get(self, key):
+                threads.append(threading.current_thread())
+                return super().get(key)
+
+            def set(self, key, value):
+                threads.append(threading.current_thread())
+                super().set(key, value)
+
+        cache = ReadThroughCache(LRUCacheBackend(max_entries=1),
+                                 shared=RecordingBackend(max_entries=10))
+
+        async def store_and_lookup():
+            await cache.store_async('first', 1)
+            await cache.store_async('second', 2)
+            return await cache.lookup_async('first')
+
+        # first evicted locally but still found in shared backend
+        self.assertEqual(asyncio.run(store_and_lookup()), 1)
+        self.assertEqual(len(threads), 3)
+        self.assertNotIn(threading.main_thread(), threads)
+
+    def test_cached_invalidated_by_bump(self):
+        """Tests cached result recomputed once its version is bumped"""
+
+        calls = []
+
+        @cached(lambda id: ['Test:{}'.format(id)])
+        def get_thing(id):
+            calls.append(id)
+            return id
+
+        # second call served from cache
+        get_thing(1)
+        get_thing(1)
+        self.assertEqual(calls, [1])
+
+        # bumping the row's version invalidates it
+        version_store.bump('Test:1')
+        get_thing(1)
+        self.assertEqual(calls, [1, 1])
+
+
+class SuggestIndexTestCase(unittest.TestCase):
+    """This class represents the plant name suggestion index test case"""
+
+    def setUp(self):
+        """Create index of a few plants."""
+        self.index = SuggestIndex()
+        self.index.rebuild([
+            (1, 'Harrington\u2019s beardtongue', 'Penstemon harringtonii'),
+            (2, 'Colorado blue columbine', 'Aquilegia c\u00e6rulea'),
+            (3, 'Bear Paw', 'Ursus planta'),
+        ], version=0)
+
+    def test_prefix_of_any_word(self):
+        """Tests prefix matches any word, ignoring case and punctuation"""
+
+        # check match is case insensitive and finds later words
+        ids = [plant['id'] for plant in self.index.suggest('BEAR')]
+        self.assertEqual(sorted(ids), [1, 3])
+
+        # check curly and straight apostrophes match
+        ids = [plant['id'] for plant in self.index.suggest('harrington\'s')]
+        self.assertEqual(ids, [1])
+
+    def test_limit(self):
+        """Tests suggestions capped at limit"""
+
+        # check only one of the matching plants returned
+        self.assertEqual(len(self.index.suggest('b', limit=1)), 1)
+
+    def test_incremental_update_and_remove(self):
+        """Tests updated and removed plants change suggestions"""
+
+        # rename a plant
+        self.index.update(3, 'Sky pilot', 'Polemonium viscosum', version=1)
+
+        # check version followed and only new name matches
+        self.assertEqual(self.index.version, 1)
+        self.assertEqual(self.index.suggest('bear paw'), [])
+        self.assertEqual(self.index.suggest('sky')[0]['id'], 3)
+
+        # check removed plant no longer suggested
+        self.index.remove(2, version=2)
+        self.assertEqual(self.index.suggest('columbine'), [])
+
+    def test_missed_write_marks_stale(self):
+        """Tests a skipped version marks the index stale"""
+
+        # another process wrote version 1, this write is version 2
+        self.index.update(4, 'Alpine sunflower', 'Hymenoxys', version=2)
+
+        # check index needs a rebuild
+        self.assertIsNone(self.index.version)
+
+
+class GeohashTestCase(unittest.TestCase):
+    """This class represents the geohash test case"""
+
+    def test_encode(self):
+        """Tests geohash of a known point"""
+
+        # check encoded to full precision
+        self.assertEqual(geo.encode(57.64911, 10.40744, 11), 'u4pruydqqvj')
+
+    def test_cover_contains_points_in_box(self):
+        """Tests cover of a box contains the points in it"""
+
+        # cover a box
+        south, west, north, east = 39.9, -105.3, 40.1, -105.1
+        prefixes = geo.cover(south, west, north, east)
+
+        # check cover is bounded and contains corners and center
+        self.assertLessEqual(len(prefixes), geo.MAX_COVER_CELLS)
+        for latitude, longitude in [(south, west), (north, east),
+                                    (40.0, -105.2)]:
+            geohash = geo.encode(latitude, longitude)
+            self.assertTrue(any(geohash.startswith(prefix)
+                                for prefix in prefixes))
+
+    def test_parse_area(self):
+        """Tests parsing and validating area args"""
+
+        # check bbox parsed to south, west, north, east
+        self.assertEqual(geo.parse_bbox('-105.3,39.9,-105.1,40.1'),
+                         (39.9, -105.3, 40.1, -105.1))
+
+        # check radius too large raises
+        with self.assertRaises(ValueError):
+            geo.parse_near('40,-105', '1000000')
+
+        # check half a location raises
+        with self.assertRaises(ValueError):
+            geo.validate_location(40, None)
+
+
+class MetricsTestCase(unittest.TestCase):
+    """This class represents the metrics registry test case"""
+
+    def test_workers_summed(self):
+        """Tests metrics summed across worker processes"""
+
+        # record metrics in this worker
+        directory = tempfile.mkdtemp()
+        registry = MetricsRegistry(directory)
+        labels = {'route': '/plants', 'method': 'GET'}
+        registry.inc('http_requests_total', dict(labels, status='200'))
+        registry.observe('http_request_duration_seconds', labels, 0.02)
+
+        # another worker's snapshot file
+        other = MetricsRegistry()
+        other.inc('http_requests_total', dict(labels, status='200'), 2)
+        other.observe('http_request_duration_seconds', labels, 20)
+        with open(os.path.join(directory, 'worker-0.json'), 'w') as f:
+            json.dump(other.snapshot(), f)
+
+        # check counters and histograms include both workers
+        text = registry.render()
+        self.assertIn('http_requests_total{method="GET",route="/plants",'
+                      'status="200"} 3', text)
+        self.assertIn('http_request_duration_seconds_bucket{method="GET",'
+                      'route="/plants",le="0.025"} 1', text)
+        self.assertIn('http_request_duration_seconds_count{method="GET",'
+                      'route="/plants"} 2', text)
+
+
+class QueryWatchTestCase(unittest.TestCase):
+    """This class represents the query watch test case"""
+
+    def setUp(self):
+        """Create an in-memory database engine."""
+        self.engine = create_engine('sqlite://')
+
+    def test_fingerprint(self):
+        """Tests literals and IN lists normalized in fingerprints"""
+
+        # check literals replaced and whitespace collapsed
+        self.assertEqual(
+            fingerprint("SELECT * FROM t WHERE id IN (1, 2, 3)\n"
+                        "AND name = 'it''s'"),
+            'SELECT * FROM t WHERE id IN (?) AND name = ?')
+
+    def test_repeated_statement_raises(self):
+        """Tests a statement repeated too often raises"""
+
+        # run the same statement up to the repeat threshold
+        with self.assertRaises(QueryProblem):
+            with watching('test'):
+                for id in range(watcher.repeats):
+                    self.engine.execute('SELECT ?', id)
+
+    def test_few_repeats_pass(self):
+        """Tests a statement repeated below the threshold passes"""
+
+        # run the same statement one less than the threshold
+        with watching('test'):
+            for id in range(watcher.repeats - 1):
+                self.engine.execute('SELECT ?', id)
+
+
+class ASGITestClient:
+    """Sends Flask test client style requests through an ASGI app"""
+
+    def __init__(self, asgi_app, loop):
+        self.asgi_app = asgi_app
+        self.loop = loop
+
+    def open(self, path, method='GET', **kwargs):
+        # build the request like the Flask test client
+        builder = EnvironBuilder(self.asgi_app.flask_app, path,
+                                 method=method, **kwargs)
+        environ = builder.get_environ()
+        body = environ['wsgi.input'].read()
+
+        # werkzeug also copies the content headers into HTTP_ keys, only
+        # send them once
+        content = ('CONTENT_TYPE', 'CONTENT_LENGTH')
+        headers = [(name[5:].replace('_', '-').lower(), value)
+                   for name, value in environ.items()
+                   if name.startswith('HTTP_') and name[5:] not in content]
+        headers += [(name.replace('_', '-').lower(), environ[name])
+                    for name in content if environ.get(name)]
+
+        scope = {
+            'type': 'http',
+            'http_version': '1.1',
+            'method': method,
+            'scheme': 'http',
+            'path': environ['PATH_INFO'].encode('latin-1').decode(),
+            'root_path': '',
+            'query_string': environ['QUERY_STRING'].encode('latin-1'),
+            'headers': [(name.encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers],
+            'server': ('localhost', 80),
+            'client': ('127.0.0.1', 0),
+        }
+        messages = []
+
+        async def receive():
+            return {'type': 'http.request', 'body': body,
+                    'more_body': False}
+
+        async def send(message):
+            messages.append(message)
+
+        self.loop.run_until_complete(self.asgi_app(scope, receive, send))
+
+        return Response(b''.join(message.get('body', b'')
+                                 for message in messages[1:]),
+                        status=messages[0]['status'],
+                        headers=[(name.decode('latin-1'),
+                                  value.decode('latin-1'))
+                                 for name, value in messages[0]['headers']])
+
+    def get(self, path, **kwargs):
+        return self.open(path, 'GET', **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.open(path, 'POST', **kwargs)
+
+    def patch(self, path, **kwargs):
+        return self.open(path, 'PATCH', **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.open(path, 'DELETE', **kwargs)
+
+
+class ASGIPlantTestCase(PlantTestCase):
+    """Runs the plant survey tests against the ASGI app on the engine"""
+
+    def setUp(self):
+        super().setUp()
+        self.loop = asyncio.new_event_loop()
+        self.asgi_app = ReadAPI(self.app)
+        self.asgi_app.database = self.create_database()
+        self.client = lambda: ASGITestClient(self.asgi_app, self.loop)
+
+    def create_database(self):
+        return EngineDatabase(self.app, self.asgi_app.executor)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.asgi_app.database.close())
+        self.loop.close()
+        self.asgi_app.executor.shutdown()
+        super().tearDown()
+
+    def test_responses_match_flask(self):
+        """Tests read routes answer like the Flask app"""
+
+        # create a plant with an observation
+        plant_id = self.create_test_plant(self.ADMIN_ID)
+        observation_id = self.create_test_observation(plant_id,
+                                                      self.PUBLIC_ID)
+
+        for path in ['/api/plants?limit=1',
+                     '/api/plants?fields=id,name&include=observations',
+                     '/api/plants?stream=true',
+                     '/api/plants/{}'.format(plant_id),
+                     '/api/observations?fields=plant_name,date',
+                     '/api/observations?stream=1&limit=1',
+                     '/api/observations/{}'.format(observation_id),
+                     '/api/observations/1000000',
+                     '/api/plants?cursor=notacursor']:
+            expected = self.app.test_client().get(path)
+            response = self.client().get(path)
+
+            # check status, body and ETag are the same
+            self.assertEqual(response.status_code, expected.status_code)
+            self.assertEqual(response.data, expected.data)
+            self.assertEqual(response.headers.get('ETag'),
+                             expected.headers.get('ETag'))
+
+
+@unittest.skipIf(asyncpg is None, 'asyncpg is not installed')
+class AsyncpgPlantTestCase(ASGIPlantTestCase):
+    """Runs the plant survey tests against the ASGI app on asyncpg"""
+
+    def create_database(self):
+        return AsyncpgDatabase(self.database_path)
+
+    def test_pgbouncer_sets_local_statement_timeout(self):
+        """Tests statement timeout is set per transaction for PgBouncer"""
+
+        environ = {'DB_PGBOUNCER': 'true', 'DB_STATEMENT_TIMEOUT': '1234'}
+        with mock.patch.dict(os.environ, environ):
+            database = AsyncpgDatabase(self.database_path)
+
+            async def read_timeout():
+                await database.connect()
+                try:
+                    rows = await database.fetch(Query(
+                        [func.current_setting('statement_timeout')
+                         .label('timeout')]))
+                finally:
+                    await database.close()
+                return rows[0]['timeout']
+
+            # check timeout set by SET LOCAL, not as a startup option
+            self.assertEqual(self.loop.run_until_complete(read_timeout()),
+                             '1234ms')
+
+
+class CompileQueryTestCase(unittest.TestCase):
+    """This class represents the asyncpg statement rewrite test case"""
+
+    def test_numeric_parameters(self):
+        """Tests parameters become $n placeholders in order"""
+
+        query = Query([Plant.id]).filter(
+            Plant.name == 'a:1 b', Plant.id.in_([3, 4]),
+            text('CAST("Plants".id AS text)::int > :low').bindparams(low=2))
+        statement, parameters = compile_query(query)
+
+        # check placeholders numbered like their parameters, casts kept
+        self.assertIn('"Plants".name = $1', statement)
+        self.assertIn('"Plants".id IN ($2, $3)', statement)
+        self.assertIn('::int > $4', statement)
+        self.assertEqual(parameters, ['a:1 b', 3, 4, 2])
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":
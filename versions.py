@@ -0,0 +1,258 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from functools import partial
+from dotenv import load_dotenv, find_dotenv
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+# set up environment variables using dotenv
+ENV_FILE = find_dotenv()
+if ENV_FILE:
+    load_dotenv(ENV_FILE)
+
+
+'''
+Version Counters
+
+Cheap counters per table and per row, bumped by the model write methods.
+Reads derive ETags from them without touching the database, so a client
+that already has the current representation gets a 304.
+
+Keys are table names ('Plants') or table names with a row id
+('Plants:6'). A plant row key also covers the plant's observations, and
+a user's owner key ('Users:3:rows') covers the plants and observations
+the user added.
+
+Caches and ETags are only invalidated across worker processes when the
+workers share their counters through VERSION_COUNTERS_PATH or REDIS_URL.
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def table_key(table):
+    return table
+
+
+def row_key(table, id):
+    return f'{table}:{id}'
+
+
+def owner_key(user_id):
+    return f'Users:{user_id}:rows'
+
+
+class MemoryVersionBackend:
+    '''
+    Counters held in process memory.
+    Only correct when a single worker process serves requests.
+    '''
+
+    # reads never wait on I/O
+    blocking = False
+
+    def __init__(self):
+        # epoch changes on restart so old ETags never match new counters
+        self.epoch = os.urandom(8).hex()
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def incr(self, keys):
+        with self._lock:
+            for key in keys:
+                self._counters[key] = self._counters.get(key, 0) + 1
+
+    def get_many(self, keys):
+        return [self._counters.get(key, 0) for key in keys]
+
+
+class SharedFileVersionBackend:
+    '''
+    Counters in a memory-mapped file shared by all worker processes on a
+    host. Keys are hashed into a fixed number of slots. Two keys sharing a
+    slot only cause extra cache misses, never stale reads. The file is
+    reopened after a fork, since flock locks are shared by every process
+    holding the same open file.
+    '''
+
+    # reads may fault in pages of the file
+    blocking = True
+
+    # file starts with an 8 byte epoch, then one 8 byte counter per slot
+    HEADER_SIZE = 8
+    COUNTER = struct.Struct('<Q')
+
+    def __init__(self, path, slots=65536):
+        self.path = path
+        self.slots = slots
+        self.size = self.HEADER_SIZE + slots * self.COUNTER.size
+        self._open()
+
+    def _open(self):
+        # open file and locks belong to the process that opened them
+        self._pid = os.getpid()
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._lock = threading.Lock()
+
+        # the first process to open the file sizes it and sets the epoch
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if os.fstat(self._fd).st_size < self.size:
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, os.urandom(self.HEADER_SIZE), 0)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+        self._map = mmap.mmap(self._fd, self.size)
+
+    def _reopen_after_fork(self):
+        # a forked worker shares the parent's open file, and so its
+        # flock, with every other worker forked from the same parent
+        if os.getpid() != self._pid:
+            self._map.close()
+            os.close(self._fd)
+            self._open()
+
+    @property
+    def epoch(self):
+        self._reopen_after_fork()
+        return self._map[:self.HEADER_SIZE].hex()
+
+    def _offset(self, key):
+        digest = hashlib.blake2b(key.encode(), digest_size=8).digest()
+        slot = int.from_bytes(digest, 'little') % self.slots
+        return self.HEADER_SIZE + slot * self.COUNTER.size
+
+    def incr(self, keys):
+        self._reopen_after_fork()
+
+        # thread lock, then file lock for other processes
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                for key in keys:
+                    offset = self._offset(key)
+                    value = self.COUNTER.unpack_from(self._map, offset)[0]
+                    self.COUNTER.pack_into(self._map, offset, value + 1)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def get_many(self, keys):
+        self._reopen_after_fork()
+        return [self.COUNTER.unpack_from(self._map, self._offset(key))[0]
+                for key in keys]
+
+
+class RedisVersionBackend:
+    '''
+    Counters in Redis, shared by every process using the same server.
+    Needed when a shared cache backend is used across hosts.
+    '''
+
+    # reads are round trips to the server
+    blocking = True
+
+    def __init__(self, client, prefix='version:'):
+        self.client = client
+        self.prefix = prefix
+
+        # first process to start sets the epoch
+        self.client.set(prefix + 'epoch', os.urandom(8).hex(), nx=True)
+        self.epoch = self.client.get(prefix + 'epoch').decode()
+
+    def incr(self, keys):
+        pipeline = self.client.pipeline()
+        for key in keys:
+            pipeline.incr(self.prefix + key)
+        pipeline.execute()
+
+    def get_many(self, keys):
+        values = self.client.mget([self.prefix + key for key in keys])
+        return [int(value) if value is not None else 0 for value in values]
+
+
+class VersionStore:
+    '''
+    Bumps and reads version counters through a backend
+    '''
+
+    def __init__(self, backend=None):
+        self.backend = backend or MemoryVersionBackend()
+
+    def bump(self, *keys):
+        '''
+        Increments the counters of the given keys
+        '''
+
+        if keys:
+            self.backend.incr(keys)
+
+    def get(self, *keys):
+        '''
+        Returns the current counters of the given keys
+        '''
+
+        return self.backend.get_many(keys)
+
+    def etag(self, scope, *keys):
+        '''
+        Returns an ETag value for a representation identified by scope
+        (e.g. the request path) that depends on the given keys
+        '''
+
+        versions = self.get(*keys)
+        parts = [self.backend.epoch, scope]
+        parts += [f'{key}={version}' for key, version in zip(keys, versions)]
+
+        return hashlib.sha1('\n'.join(parts).encode()).hexdigest()
+
+    async def etag_async(self, scope, *keys):
+        '''
+        Returns etag(scope, *keys) from a coroutine, reading a blocking
+        backend in the event loop's default executor
+        '''
+
+        if not self.backend.blocking:
+            return self.etag(scope, *keys)
+
+        return await asyncio.get_running_loop().run_in_executor(
+            None, partial(self.etag, scope, *keys))
+
+
+def create_backend():
+    '''
+    Uses Redis if REDIS_URL is set and redis is installed, the shared file
+    backend if VERSION_COUNTERS_PATH is set, otherwise process memory.
+    Warns when process memory is used with more than one worker
+    '''
+
+    redis_url = os.getenv('REDIS_URL')
+    if redis_url and redis is not None:
+        return RedisVersionBackend(redis.Redis.from_url(redis_url))
+
+    path = os.getenv('VERSION_COUNTERS_PATH')
+    if path:
+        return SharedFileVersionBackend(path)
+
+    # writes in one worker wouldn't invalidate the others' caches and ETags
+    workers = int(os.getenv('WEB_CONCURRENCY', 1))
+    if workers > 1:
+        logger.warning(
+            f'WEB_CONCURRENCY={workers} but version counters are kept in '
+            'process memory, set VERSION_COUNTERS_PATH or REDIS_URL to '
+            'share them between workers')
+
+    return MemoryVersionBackend()
+
+
+# process-wide version store
+version_store = VersionStore(create_backend())